@@ -1,8 +1,26 @@
+-- Space of removed assets can be given back with PRAGMA incremental_vacuum
+-- Must come before the first table
+PRAGMA auto_vacuum = INCREMENTAL;
+
 -- Assets and attachments
+-- Unreferenced assets are removed by the collector (see database/asset_gc.py)
+-- AUTOINCREMENT: ids of removed assets are never given to new ones, /a/<id> is cached for good
 CREATE TABLE Assets (
-    id INTEGER PRIMARY KEY,
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
     filename TEXT NOT NULL,
-    value BLOB NOT NULL
+    value BLOB NOT NULL,
+    created INTEGER NOT NULL DEFAULT 0,
+    content_type TEXT  -- Sniffed at upload, NULL for older assets
+);
+
+-- Downscaled copies of image assets, made on first request (see util/uploads.py)
+-- An empty content_type (and value) marks an asset Pillow could not read, served as it is
+CREATE TABLE AssetVariants (
+    asset_id INTEGER NOT NULL REFERENCES Assets(id) ON DELETE CASCADE,
+    variant TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (asset_id, variant)
 );
 
 -- User Data
@@ -36,7 +54,15 @@ CREATE TABLE Challenges (
     body TEXT NOT NULL,
     category_id INTEGER NOT NULL REFERENCES ChallengeCategories(id) ON DELETE CASCADE,
     author_id INTEGER NOT NULL REFERENCES Users(id),
-    accepts_submissions INTEGER NOT NULL DEFAULT 1
+    accepts_submissions INTEGER NOT NULL DEFAULT 1,
+
+    -- Maintained by the challenge_activity_* triggers below
+    comment_count INTEGER NOT NULL DEFAULT 0,
+    submission_count INTEGER NOT NULL DEFAULT 0,
+    last_activity INTEGER NOT NULL DEFAULT 0,
+
+    -- Shortened body for feed rows, NULL when the body is shown in full
+    body_preview TEXT
 );
 
 CREATE TABLE Submissions (
@@ -45,7 +71,7 @@ CREATE TABLE Submissions (
     challenge_id INTEGER NOT NULL REFERENCES Challenges(id) ON DELETE CASCADE,
     title TEXT NOT NULL,
     body TEXT NOT NULL,
-    solution_asset_id INTEGER NOT NULL REFERENCES Assets(id) ON DELETE CASCADE,
+    solution_asset_id INTEGER NOT NULL REFERENCES Assets(id),
     author_id INTEGER NOT NULL
 );
 
@@ -102,3 +128,275 @@ WHERE submission_id IS NOT NULL;
 CREATE INDEX challenge_id_to_author_id ON Challenges(author_id);
 CREATE INDEX comment_id_to_author_id ON Comments(author_id);
 CREATE INDEX submission_id_to_author_id ON Submissions(author_id);
+
+-- Find references to assets, for the asset collector
+CREATE INDEX profiles_image_asset_id ON Profiles(image_asset_id)
+WHERE image_asset_id IS NOT NULL;
+CREATE INDEX profiles_banner_asset_id ON Profiles(banner_asset_id)
+WHERE banner_asset_id IS NOT NULL;
+CREATE INDEX submissions_solution_asset_id ON Submissions(solution_asset_id);
+
+-- Find comments and submissions of a challenge
+CREATE INDEX comments_challenge_id ON Comments(challenge_id);
+CREATE INDEX submissions_challenge_id ON Submissions(challenge_id);
+
+-- Precomputed ranking of challenges (see database/ranking.py)
+-- hot = log10(max(votes + replies / 2, 1)) + created / 45000
+CREATE TABLE ChallengeScores (
+    challenge_id INTEGER PRIMARY KEY REFERENCES Challenges(id) ON DELETE CASCADE,
+    category_id INTEGER NOT NULL,
+    created INTEGER NOT NULL,
+    votes INTEGER NOT NULL DEFAULT 0,
+    replies INTEGER NOT NULL DEFAULT 0,
+    hot REAL NOT NULL DEFAULT 0
+);
+
+-- Page through the feed by hotness or by votes, optionally per category
+CREATE INDEX challenge_scores_hot ON ChallengeScores(hot DESC);
+CREATE INDEX challenge_scores_category_hot ON ChallengeScores(category_id, hot DESC);
+CREATE INDEX challenge_scores_votes ON ChallengeScores(votes DESC, created DESC);
+CREATE INDEX challenge_scores_category_votes
+ON ChallengeScores(category_id, votes DESC, created DESC);
+CREATE INDEX challenge_scores_created ON ChallengeScores(created);
+
+-- Challenges with new activity, waiting for their score to be recomputed
+CREATE TABLE ChallengeScoresDirty (
+    challenge_id INTEGER PRIMARY KEY
+);
+
+CREATE TRIGGER challenge_scores_challenge_insert AFTER INSERT ON Challenges
+BEGIN
+    INSERT INTO ChallengeScores (challenge_id, category_id, created, hot)
+    VALUES (NEW.id, NEW.category_id, NEW.created, NEW.created / 45000.0);
+END;
+
+CREATE TRIGGER challenge_scores_challenge_category AFTER UPDATE OF category_id ON Challenges
+BEGIN
+    UPDATE ChallengeScores SET category_id = NEW.category_id
+    WHERE challenge_id = NEW.id;
+END;
+
+CREATE TRIGGER challenge_scores_vote_insert AFTER INSERT ON Votes
+WHEN NEW.challenge_id IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (NEW.challenge_id);
+END;
+
+CREATE TRIGGER challenge_scores_vote_delete AFTER DELETE ON Votes
+WHEN OLD.challenge_id IS NOT NULL
+BEGIN
+    INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (OLD.challenge_id);
+END;
+
+CREATE TRIGGER challenge_scores_comment_insert AFTER INSERT ON Comments
+BEGIN
+    INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (NEW.challenge_id);
+END;
+
+CREATE TRIGGER challenge_scores_comment_delete AFTER DELETE ON Comments
+BEGIN
+    INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (OLD.challenge_id);
+END;
+
+CREATE TRIGGER challenge_scores_submission_insert AFTER INSERT ON Submissions
+BEGIN
+    INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (NEW.challenge_id);
+END;
+
+CREATE TRIGGER challenge_scores_submission_delete AFTER DELETE ON Submissions
+BEGIN
+    INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (OLD.challenge_id);
+END;
+
+-- Reply counters and last activity of challenges
+-- Check them with `flask check-counters` (see app.py)
+CREATE TRIGGER challenge_activity_challenge_insert AFTER INSERT ON Challenges
+BEGIN
+    UPDATE Challenges SET last_activity = NEW.created WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER challenge_activity_comment_insert AFTER INSERT ON Comments
+BEGIN
+    UPDATE Challenges SET
+        comment_count = comment_count + 1,
+        last_activity = MAX(last_activity, NEW.created)
+    WHERE id = NEW.challenge_id;
+END;
+
+CREATE TRIGGER challenge_activity_comment_delete AFTER DELETE ON Comments
+BEGIN
+    UPDATE Challenges SET
+        comment_count = comment_count - 1,
+        last_activity = MAX(
+            Challenges.created,
+            COALESCE((SELECT MAX(Comments.created) FROM Comments
+                      WHERE Comments.challenge_id = OLD.challenge_id), 0),
+            COALESCE((SELECT MAX(Submissions.created) FROM Submissions
+                      WHERE Submissions.challenge_id = OLD.challenge_id), 0))
+    WHERE id = OLD.challenge_id;
+END;
+
+CREATE TRIGGER challenge_activity_submission_insert AFTER INSERT ON Submissions
+BEGIN
+    UPDATE Challenges SET
+        submission_count = submission_count + 1,
+        last_activity = MAX(last_activity, NEW.created)
+    WHERE id = NEW.challenge_id;
+END;
+
+CREATE TRIGGER challenge_activity_submission_delete AFTER DELETE ON Submissions
+BEGIN
+    UPDATE Challenges SET
+        submission_count = submission_count - 1,
+        last_activity = MAX(
+            Challenges.created,
+            COALESCE((SELECT MAX(Comments.created) FROM Comments
+                      WHERE Comments.challenge_id = OLD.challenge_id), 0),
+            COALESCE((SELECT MAX(Submissions.created) FROM Submissions
+                      WHERE Submissions.challenge_id = OLD.challenge_id), 0))
+    WHERE id = OLD.challenge_id;
+END;
+
+-- Challenge counts per category, for page counts without COUNT(*) over the feed
+CREATE TABLE ChallengeCounts (
+    category_id INTEGER PRIMARY KEY,
+    challenges INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER challenge_counts_insert AFTER INSERT ON Challenges
+BEGIN
+    INSERT INTO ChallengeCounts (category_id, challenges) VALUES (NEW.category_id, 1)
+    ON CONFLICT (category_id) DO UPDATE SET challenges = challenges + 1;
+END;
+
+CREATE TRIGGER challenge_counts_delete AFTER DELETE ON Challenges
+BEGIN
+    UPDATE ChallengeCounts SET challenges = challenges - 1
+    WHERE category_id = OLD.category_id;
+END;
+
+CREATE TRIGGER challenge_counts_category AFTER UPDATE OF category_id ON Challenges
+WHEN NEW.category_id != OLD.category_id
+BEGIN
+    UPDATE ChallengeCounts SET challenges = challenges - 1
+    WHERE category_id = OLD.category_id;
+    INSERT INTO ChallengeCounts (category_id, challenges) VALUES (NEW.category_id, 1)
+    ON CONFLICT (category_id) DO UPDATE SET challenges = challenges + 1;
+END;
+
+-- Last change of every user, challenge, comment and submission, one row each
+-- Workers drop their cached copies of what changed (see database/coherence.py)
+CREATE TABLE ChangeLog (
+    entity TEXT NOT NULL,
+    entity_id INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (entity, entity_id)
+) WITHOUT ROWID;
+
+CREATE INDEX change_log_version ON ChangeLog(version);
+
+CREATE TRIGGER change_log_user_update AFTER UPDATE ON Users
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('user', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_user_delete AFTER DELETE ON Users
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('user', OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_profile_update AFTER UPDATE ON Profiles
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('user', NEW.user_id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_challenge_insert AFTER INSERT ON Challenges
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('challenge', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_challenge_update AFTER UPDATE ON Challenges
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('challenge', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_challenge_delete AFTER DELETE ON Challenges
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('challenge', OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_comment_insert AFTER INSERT ON Comments
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('comment', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_comment_update AFTER UPDATE ON Comments
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('comment', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_comment_delete AFTER DELETE ON Comments
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('comment', OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_submission_insert AFTER INSERT ON Submissions
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('submission', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_submission_update AFTER UPDATE ON Submissions
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('submission', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_submission_delete AFTER DELETE ON Submissions
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES ('submission', OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_vote_insert AFTER INSERT ON Votes
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES (CASE WHEN NEW.challenge_id IS NOT NULL THEN 'challenge'
+                 WHEN NEW.comment_id IS NOT NULL THEN 'comment'
+                 ELSE 'submission' END,
+            COALESCE(NEW.challenge_id, NEW.comment_id, NEW.submission_id),
+            (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
+
+CREATE TRIGGER change_log_vote_delete AFTER DELETE ON Votes
+BEGIN
+    INSERT INTO ChangeLog (entity, entity_id, version)
+    VALUES (CASE WHEN OLD.challenge_id IS NOT NULL THEN 'challenge'
+                 WHEN OLD.comment_id IS NOT NULL THEN 'comment'
+                 ELSE 'submission' END,
+            COALESCE(OLD.challenge_id, OLD.comment_id, OLD.submission_id),
+            (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+    ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+END;
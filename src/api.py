@@ -1,5 +1,4 @@
-from flask import redirect, request, session
-from werkzeug.security import check_password_hash, generate_password_hash
+from flask import current_app, jsonify, redirect, request, session
 from database.types import (
     ChallengeNotFoundException,
     CommentNotFoundException,
@@ -9,8 +8,13 @@ from database.types import (
 from database.abstract import ProfileEditable, UserNotFoundException
 from util.includes import includes
 from util.password import is_good_password
-from util.get_db import get_db
-from util.has_permission import has_permission
+from util.get_db import get_categories, get_db
+from util.has_permission import has_permission, required_author
+from util.hasher import get_hasher
+from util.jobs import get_job_queue
+from util.uploads import prepare_image, prepare_script
+from util.rate_limit import get_rate_limiter
+from util.session import get_session_store
 
 
 def api_login():  # MARK: Login & Register
@@ -20,6 +24,13 @@ def api_login():  # MARK: Login & Register
     username = request.form["username"]
     password = request.form["password"]
 
+    # Throttle attempts before doing any database or hashing work
+    if (
+        not get_rate_limiter("login_address").allow(str(request.remote_addr)) or
+        not get_rate_limiter("login_user").allow(username.lower())
+    ):
+        return redirect("/login?throttled")
+
     # Attempt to get user
     try:
         user = get_db().get_user(username)
@@ -27,7 +38,16 @@ def api_login():  # MARK: Login & Register
         return redirect("/login?fail")
 
     # Check password
-    if check_password_hash(user.password_hash, password):
+    password_hash = get_db().get_password_hash(username)
+    if get_hasher().verify(password_hash, password):
+        # Upgrade the stored hash, if the hash parameters have changed
+        if get_hasher().needs_rehash(password_hash):
+            get_db().edit_user(username, {
+                "username": username,
+                "password_hash": get_hasher().hash(password),
+                "require_new_password": user.require_new_password
+            })
+
         session["user"] = user.to_dict()
         return redirect("/")
 
@@ -52,7 +72,7 @@ def api_register():
 
     try:
         # Create user
-        user = get_db().create_user(username, generate_password_hash(password))
+        user = get_db().create_user(username, get_hasher().hash(password))
         session["user"] = user.to_dict()
         return redirect("/")
 
@@ -87,10 +107,13 @@ def api_change_password():  # MARK: User settings
         # Change password
         get_db().edit_user(username, {
             "username": username,
-            "password_hash": generate_password_hash(password),
+            "password_hash": get_hasher().hash(password),
             "require_new_password": False
         })
 
+        # Log out every session of the user
+        get_session_store().invalidate_user(get_db().get_user(username).id)
+
         # Admin does not get logged out
         if "u" in request.args:
             return redirect(f"/u/{username}")
@@ -119,6 +142,10 @@ def api_require_password_change():
 
     try:
         get_db().set_user_new_password_required(username, required)
+
+        # Update the user record in the sessions of the user
+        user = get_db().get_user(username)
+        get_session_store().refresh_user(user.id, user.to_dict())
         return redirect(f"/u/{username}/settings")
 
     except UserNotFoundException:
@@ -146,13 +173,17 @@ def api_profile_edit():  # MARK: Profiles
         image_file_id = user.profile.image_asset.id if user.profile.image_asset else None
         banner_file_id = user.profile.banner_asset.id if user.profile.banner_asset else None
         if image_file:
-            new_image = get_db().create_asset(image_file.filename,
-                                              image_file.stream.read())
-            image_file_id = new_image.id
+            image = prepare_image(image_file, "avatar")
+            image_file_id = get_db().create_asset_from_stream(image.filename,
+                                                              image.content_type,
+                                                              image.stream,
+                                                              image.size)
         if banner_file:
-            new_banner = get_db().create_asset(banner_file.filename,
-                                               banner_file.stream.read())
-            banner_file_id = new_banner.id
+            banner = prepare_image(banner_file, "banner")
+            banner_file_id = get_db().create_asset_from_stream(banner.filename,
+                                                               banner.content_type,
+                                                               banner.stream,
+                                                               banner.size)
 
         # Perform edits
         new_profile: ProfileEditable = {
@@ -162,12 +193,16 @@ def api_profile_edit():  # MARK: Profiles
         }
         get_db().edit_profile(user_id, new_profile)
 
-        # Delete old assets, if necessary
+        # Delete old assets in the background, if necessary
         # Must be after edit_profile to ensure asset is no longer referenced
         if user.profile.banner_asset and banner_file:
-            get_db().remove_asset(user.profile.banner_asset.id)
+            get_job_queue().enqueue("remove_asset", asset_id=user.profile.banner_asset.id)
         if user.profile.image_asset and image_file:
-            get_db().remove_asset(user.profile.image_asset.id)
+            get_job_queue().enqueue("remove_asset", asset_id=user.profile.image_asset.id)
+
+        # Small variants for the feeds, made ahead of the first request
+        if image_file:
+            get_job_queue().enqueue("make_asset_variants", asset_id=image_file_id)
 
         # Refresh session
         session["user"] = get_db().get_user(username).to_dict()
@@ -194,7 +229,7 @@ def api_post_challenge():  # MARK: Post Challenge
         return "Invalid data.", 400
 
     # Check challenge category is valid
-    categories = get_db().get_categories()
+    categories = get_categories()
     if not any(category.id == category_id for category in categories):
         return "Invalid category.", 400
 
@@ -222,23 +257,20 @@ def api_edit_challenge():  # MARK: Edit Challenge
 
     try:
         # Check challenge category is valid
-        categories = get_db().get_categories()
+        categories = get_categories()
         if not any(category.id == category_id for category in categories):
             return "Invalid category.", 400
 
-        # Check permission
-        challenge = get_db().get_challenge(session["user"]["id"], challenge_id)
-        if not has_permission(session["user"], "edit", "challenge", challenge.author_id):
-            return "Permission denied.", 401
-
-        # Edit challenge post
+        # Edit challenge post, the update itself checks the permission
         # TODO: Add edited date?
-        get_db().edit_challenge(challenge_id, {
+        if not get_db().edit_challenge(challenge_id, {
             "body": body,
             "category_id": category_id,
             "title": title,
             "accepts_submissions": accepts_submissions
-        })
+        }, required_author(session["user"], "edit", "challenge")):
+            get_db().get_owner("challenge", challenge_id)  # Raises when it does not exist
+            return "Permission denied.", 401
         return redirect(f"/chall/{challenge_id}")
 
     except ChallengeNotFoundException:
@@ -255,14 +287,11 @@ def api_delete_challenge():  # MARK: Delete Challenge
     challenge_id = request.form["id"]
 
     try:
-        challenge = get_db().get_challenge(session["user"]["id"], challenge_id)
-
-        # Check permission
-        if not has_permission(session["user"], "delete", "challenge", challenge.author_id):
+        # Delete challenge, the delete itself checks the permission
+        if not get_db().remove_challenge(challenge_id,
+                                         required_author(session["user"], "delete", "challenge")):
+            get_db().get_owner("challenge", challenge_id)  # Raises when it does not exist
             return "Permission denied.", 401
-
-        # Delete challenge
-        get_db().remove_challenge(challenge_id)
         return redirect("/")
 
     except ChallengeNotFoundException:
@@ -276,16 +305,27 @@ def api_vote(target_type, target_id):  # MARK: Vote
     if "vote_action" not in request.form.keys() or "from_page" not in request.form.keys():
         return "Incomplete data.", 400
 
+    if target_type not in ("challenge", "comment", "submission"):
+        return "Unknown target type.", 400
+
     user_id = session["user"]["id"]
-    vote_action = request.form["vote_action"]
+    voted = request.form["vote_action"] == "1"
     from_page = request.form["from_page"]
 
     # FIXME: Does not check target exists, so we might create "ghost" votes.
     #       I don't see why that is an issue though.
-    if vote_action == "1":
-        get_db().vote_for(target_type, target_id, user_id)
+    vote_buffer = current_app.extensions.get("vote_buffer")
+    if vote_buffer:
+        # Written later in a batch, the state reflects the pending vote
+        vote_buffer.set(target_type, target_id, user_id, voted)
+        state = vote_buffer.apply_pending(target_type, target_id, user_id,
+                                          get_db().get_vote_state(target_type, target_id, user_id))
     else:
-        get_db().remove_vote_from(target_type, target_id, user_id)
+        state = get_db().set_vote(target_type, target_id, user_id, voted)
+
+    # Requests made with fetch only need the new state
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(state.to_dict())
 
     # Redirect back
     # Needs separate rules for each place the request can be from.
@@ -332,15 +372,15 @@ def api_edit_comment():
 
     try:
         # Check permission
-        comment = get_db().get_comment(session["user"]["id"], comment_id)
-        if not has_permission(session["user"], "edit", "comment", comment.author_id):
+        owner = get_db().get_owner("comment", comment_id)
+        if not has_permission(session["user"], "edit", "comment", owner.author_id):
             return "Permission denied.", 401
 
         # TODO: Add edited date?
         get_db().edit_comment(comment_id, {
             "body": body
-        })
-        return redirect(f"/chall/{comment.challenge_id}/#com-{comment_id}")
+        }, required_author(session["user"], "edit", "comment"))
+        return redirect(f"/chall/{owner.challenge_id}/#com-{comment_id}")
 
     except CommentNotFoundException:
         return "Comment does not exist.", 400
@@ -356,15 +396,15 @@ def api_delete_comment():
     comment_id = request.form["id"]
 
     try:
-        comment = get_db().get_comment(session["user"]["id"], comment_id)
+        owner = get_db().get_owner("comment", comment_id)
 
         # Check permission
-        if not has_permission(session["user"], "delete", "comment", comment.author_id):
+        if not has_permission(session["user"], "delete", "comment", owner.author_id):
             return "Permission denied.", 401
 
-        # Delete challenge
-        get_db().remove_comment(comment.id)
-        return redirect(f"/chall/{comment.challenge_id}")
+        # Delete comment
+        get_db().remove_comment(comment_id, required_author(session["user"], "delete", "comment"))
+        return redirect(f"/chall/{owner.challenge_id}")
 
     except CommentNotFoundException:
         return "Challenge does not exit.", 400
@@ -384,9 +424,7 @@ def api_post_submission():  # MARK: Submissions
     challenge_id = request.form["challenge_id"]
     title = request.form["title"]
     body = request.form["body"]
-    script = request.files["script"]
-    script_name = script.filename + \
-        ".js" if not script.filename.endswith(".js") else script.filename
+    script = prepare_script(request.files["script"])
 
     try:
         # Verify challenge accepts submissions
@@ -394,15 +432,17 @@ def api_post_submission():  # MARK: Submissions
             return "Challenge does not accept submissions.", 401
 
         # Create asset for submission
-        script_asset = get_db().create_asset(script_name,
-                                             script.stream.read())
+        script_asset_id = get_db().create_asset_from_stream(script.filename,
+                                                            script.content_type,
+                                                            script.stream,
+                                                            script.size)
 
         # Create submission
         submission_id = get_db().create_submission(challenge_id,
                                                    title,
                                                    body,
                                                    user_id,
-                                                   script_asset.id if script_asset else None)
+                                                   script_asset_id)
 
         return redirect(f"/chall/{challenge_id}/#s-{submission_id}")
 
@@ -422,35 +462,36 @@ def api_edit_submission():
     body = request.form["body"]
 
     # Script replacement is optional, maintain original if not present
-    script, script_name = None, None
-    if "script" in request.files.keys():
-        script = request.files["script"]
-        script_name = script.filename + \
-            ".js" if not script.filename.endswith(".js") else script.filename
+    script = None
+    if "script" in request.files.keys() and request.files["script"]:
+        script = prepare_script(request.files["script"])
 
     try:
         # Check permission
-        submission = get_db().get_submission(
-            session["user"]["id"], submission_id)
-        if not has_permission(session["user"], "edit", "submission", submission.author_id):
+        owner = get_db().get_owner("submission", submission_id)
+        if not has_permission(session["user"], "edit", "submission", owner.author_id):
             return "Permission denied.", 401
 
+        # Store the new script first, the submission is then pointed at it
+        script_id = owner.asset_id
+        if script:
+            script_id = get_db().create_asset_from_stream(script.filename,
+                                                          script.content_type,
+                                                          script.stream,
+                                                          script.size)
+
         # TODO: Add edited date?
-        # FIXME: This differs from the usual pattern!
-        #        Asset should be created separately!
-        get_db().edit_submission(submission.id, {
+        get_db().edit_submission(submission_id, {
             "title": title,
             "body": body,
-            "script_id": submission.script_id if not script else None,
-            "script_name": script_name,
-            "script_bytes": script.stream.read() if script else None
-        })
+            "script_id": script_id
+        }, required_author(session["user"], "edit", "submission"))
 
-        # Delete original asset, if required
+        # Delete original asset in the background, if required
         if script:
-            get_db().remove_asset(submission.script_id)
+            get_job_queue().enqueue("remove_asset", asset_id=owner.asset_id)
 
-        return redirect(f"/chall/{submission.challenge_id}/#sub-{submission.id}")
+        return redirect(f"/chall/{owner.challenge_id}/#sub-{submission_id}")
 
     except SubmissionNotFoundException:
         return "Submission does not exit.", 400
@@ -466,16 +507,16 @@ def api_delete_submission():
     submission_id = request.form["id"]
 
     try:
-        submission = get_db().get_submission(
-            session["user"]["id"], submission_id)
+        owner = get_db().get_owner("submission", submission_id)
 
         # Check permission
-        if not has_permission(session["user"], "delete", "submission", submission.author_id):
+        if not has_permission(session["user"], "delete", "submission", owner.author_id):
             return "Permission denied.", 401
 
         # Delete submission
-        get_db().remove_submission(submission.id)
-        return redirect(f"/chall/{submission.challenge_id}")
+        get_db().remove_submission(submission_id,
+                                   required_author(session["user"], "delete", "submission"))
+        return redirect(f"/chall/{owner.challenge_id}")
 
     except SubmissionNotFoundException:
         return "Submission does not exit.", 400
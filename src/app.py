@@ -1,10 +1,14 @@
 from pathlib import Path
 from datetime import datetime
+import gc
+from time import perf_counter, time
 from secrets import token_urlsafe
 from traceback import print_exception
+import click
 from flask import (
     Flask,
     Response,
+    jsonify,
     redirect,
     render_template,
     request,
@@ -12,7 +16,8 @@ from flask import (
     session,
     g
 )
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
 from api import (
     api_change_password,
     api_delete_challenge,
@@ -31,30 +36,158 @@ from api import (
     api_post_comment
 )
 from database.abstract import (
+    AbstractDatabase,
+    Asset,
     AssetNotFoundException,
     ChallengeNotFoundException,
     UserNotFoundException,
     page_size
 )
-from util.get_db import get_db
-from util.filetype import filename_to_file_type
+from database.asset_gc import get_asset_collector
+from database.migrations import check_migrations
+from database.params import baseline_schema_filepath, database_params, ranking_refresh_interval
+from database.ranking import get_score_refresher
+from database.vote_buffer import VoteBuffer
+from database.writer import open_database
+from util.get_db import get_categories, get_db
+from util.compression import CompressionMiddleware
+from util.conditional import build_stamp, not_modified, page_etag, with_etag
+from util.filetype import filename_to_file_type, sniff_image_type
+from util.hasher import HasherBusyException, PasswordHasher
+from util.jobs import JobQueue
+from util.metrics import metrics
 from util.random_text import get_random_top_text
+from util.rate_limit import create_rate_limiter
+from util.session import ServerSideSessionInterface, create_session_store
+from util.static_assets import StaticAssets
+from util.streaming import flush, stream_page
+from util.templates import CountingBytecodeCache, warm_up_templates
+from util.uploads import (
+    UploadRejectedException,
+    image_variants,
+    make_variant,
+    use_original,
+    variants_enabled
+)
 
 # Initialize Flask
 app = Flask(__name__)
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 app.config["SESSION_COOKIE_SAMESITE"] = "Strict"
+app.config["SESSION_BACKEND"] = "sqlite"  # "sqlite" (shared by workers) or "memory"
+app.config["SESSION_DATABASE"] = "./sessions.db"
+app.config["PASSWORD_HASH_METHOD"] = "scrypt:32768:8:1"
+app.config["PASSWORD_HASH_WORKERS"] = 2
+app.config["PASSWORD_HASH_QUEUE"] = 16
+app.config["PASSWORD_HASH_TIMEOUT"] = 5.0
+app.config["LOGIN_RATE_LIMIT_BACKEND"] = "sqlite"  # "sqlite" (shared by workers) or "local"
+app.config["LOGIN_RATE_LIMIT_DATABASE"] = "./sessions.db"
+app.config["LOGIN_RATE_LIMIT_PER_USER"] = (10, 1 / 30)  # (burst, attempts per second)
+app.config["LOGIN_RATE_LIMIT_PER_ADDRESS"] = (30, 1 / 5)
+# Reverse proxies in front of the app. Behind one, every request comes from the proxy's
+# address, so set this to trust that many X-Forwarded-For/-Proto hops for the client address.
+# Keep 0 when clients connect directly, or anyone could pick their address with the header.
+app.config["TRUSTED_PROXIES"] = 0
+app.config["VOTE_WRITE_BEHIND"] = False  # Coalesce votes and write them in batches
+app.config["VOTE_FLUSH_INTERVAL"] = 0.5
+app.config["MAX_CONTENT_LENGTH"] = 8 * 1024 * 1024  # Whole request, larger ones get 413
+app.config["UPLOAD_MAX_IMAGE_BYTES"] = 5 * 1024 * 1024
+app.config["UPLOAD_MAX_SCRIPT_BYTES"] = 512 * 1024
+app.config["UPLOAD_AVATAR_SIZE"] = (256, 256)  # Images are downscaled to fit, with Pillow
+app.config["UPLOAD_BANNER_SIZE"] = (1500, 500)
+app.config["JOB_QUEUE_DATABASE"] = "./jobs.db"
+app.config["JOB_WORKERS"] = 2
+app.config["JOB_MAX_ATTEMPTS"] = 5
+app.config["COMPRESSION_MIN_SIZE"] = 1024  # Smaller responses are sent as they are
+app.config["COMPRESSION_LEVEL"] = 6  # gzip scale 1-9, also used for brotli and zstd
+app.config["COMPRESSION_ROUTE_LEVELS"] = {"/api/": 1}  # Path prefix: level
+app.config["TEMPLATE_BYTECODE_CACHE"] = "./.template-cache"  # None to compile on every start
+app.config["SECRET_KEY_FILE"] = "./.secret"  # Generated on first start
 
 # Add custom functions to templates
 app.jinja_env.globals["get_random_top_text"] = get_random_top_text
-app.jinja_env.globals["get_categories"] = lambda: get_db().get_categories()
+app.jinja_env.globals["get_categories"] = get_categories
 app.jinja_env.globals["get_page_size"] = lambda: page_size
+app.jinja_env.globals["flush"] = flush
+
+# Keep compiled templates on disk between starts (see util/templates.py)
+if app.config["TEMPLATE_BYTECODE_CACHE"]:
+    app.jinja_env.bytecode_cache = CountingBytecodeCache(app.config["TEMPLATE_BYTECODE_CACHE"])
+
+# Fingerprinted and precompressed public files (see util/static_assets.py)
+static_assets = app.extensions["static_assets"] = StaticAssets(Path(app.root_path) / "public")
+app.extensions["page_build"] = build_stamp(Path(app.root_path))  # Part of page ETags
+app.jinja_env.globals["static_url"] = static_assets.url
+
+# Compress pages on the way out, assets under /a/ are stored compressed already
+app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                                     app.config["COMPRESSION_MIN_SIZE"],
+                                     app.config["COMPRESSION_LEVEL"],
+                                     app.config["COMPRESSION_ROUTE_LEVELS"])
+
+# Client address and scheme from the trusted proxies, e.g. for the login rate limit
+if app.config["TRUSTED_PROXIES"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app,
+                            x_for=app.config["TRUSTED_PROXIES"],
+                            x_proto=app.config["TRUSTED_PROXIES"])
+
+# Keep session data on the server, the cookie only holds the session id
+app.session_interface = ServerSideSessionInterface(create_session_store(
+    app.config["SESSION_BACKEND"],
+    int(app.permanent_session_lifetime.total_seconds()),
+    app.config["SESSION_DATABASE"]))
+
+# Hash passwords outside of the request workers
+app.extensions["password_hasher"] = PasswordHasher(app.config["PASSWORD_HASH_METHOD"],
+                                                   app.config["PASSWORD_HASH_WORKERS"],
+                                                   app.config["PASSWORD_HASH_QUEUE"],
+                                                   app.config["PASSWORD_HASH_TIMEOUT"])
+
+# Throttle login attempts per username and per client address
+app.extensions["rate_limiters"] = {
+    name: create_rate_limiter(app.config["LOGIN_RATE_LIMIT_BACKEND"],
+                              name,
+                              *app.config[config_key],
+                              app.config["LOGIN_RATE_LIMIT_DATABASE"])
+    for name, config_key in (("login_user", "LOGIN_RATE_LIMIT_PER_USER"),
+                             ("login_address", "LOGIN_RATE_LIMIT_PER_ADDRESS"))
+}
+
+# Optionally buffer votes and write them in batches
+if app.config["VOTE_WRITE_BEHIND"]:
+    app.extensions["vote_buffer"] = VoteBuffer(app.config["VOTE_FLUSH_INTERVAL"])
+
+# Deferred side effects of requests, run by background job workers
+job_queue = app.extensions["job_queue"] = JobQueue(app.config["JOB_QUEUE_DATABASE"],
+                                                   app.config["JOB_WORKERS"],
+                                                   app.config["JOB_MAX_ATTEMPTS"])
+
+
+@job_queue.handler("remove_asset")
+def remove_asset_job(asset_id):  # Assets no longer referenced by anything
+    db = AbstractDatabase(open_database())
+    try:
+        db.remove_asset(asset_id)
+    finally:
+        db.connection.close()
 
-# Generate secret
-secret_key = Path("./.secret")
-if not secret_key.exists():
-    secret_key.write_text(token_urlsafe(32), "utf-8")
-app.secret_key = secret_key.read_text("utf-8")
+
+@job_queue.handler("make_asset_variants")
+def make_asset_variants_job(asset_id):  # Ready before the first feed shows the new image
+    if not variants_enabled:
+        return
+    db = AbstractDatabase(open_database())
+    try:
+        original = db.get_asset(asset_id)
+        for variant in image_variants:
+            if db.get_asset_variant(asset_id, variant) is not None:
+                continue
+            value, content_type = make_variant(original.value, variant) or (b"", use_original)
+            db.create_asset_variant(asset_id, variant, content_type, value)
+    except AssetNotFoundException:
+        pass  # Replaced again already
+    finally:
+        db.connection.close()
 
 
 @app.template_filter("epoch_to_date")  # MARK: Filters
@@ -64,17 +197,31 @@ def epoch_to_date_filter(epoch):
 
 @app.teardown_appcontext  # MARK: DB teardown
 def close_connection(_):  # Auto-closes the database connection
-    db = getattr(g, "_database", None)
+    # Also runs before a streamed page is rendered, which then opens a new one (util/streaming.py)
+    db = g.pop("_database", None)
     if db is not None:
-        db.close()
+        db.connection.close()
 
 
 @app.get("/public/<string:path>")  # Public dir route
 def public(path):
-    return send_from_directory("public", path)
+    response = static_assets.response(path, request)
+    if response is None:  # Added after startup
+        return send_from_directory("public", path)
+    return response
 
 
 @app.before_request  # MARK: Before request
+def load_secret_key():
+    # Not at import: create_app() reads it in the master, other entry points on the first request
+    if app.secret_key is None:
+        secret_key = Path(app.config["SECRET_KEY_FILE"])
+        if not secret_key.exists():
+            secret_key.write_text(token_urlsafe(32), "utf-8")
+        app.secret_key = secret_key.read_text("utf-8")
+
+
+@app.before_request
 def check_required_password_change():
     # If password change is required, only required routes are allowed
     if (
@@ -88,6 +235,22 @@ def check_required_password_change():
         return redirect("/reset-password")
 
 
+@app.before_request
+def start_background_workers():
+    # Keeps the ranked feeds up to date (see database/ranking.py)
+    get_score_refresher()
+
+    # Picks up jobs left queued by earlier runs
+    job_queue.start()
+
+    # Removes assets nothing references anymore (see database/asset_gc.py)
+    get_asset_collector().start()
+
+    # Writes buffered votes, when enabled
+    if "vote_buffer" in app.extensions:
+        app.extensions["vote_buffer"].start()
+
+
 @app.before_request
 def check_csrf():  # Handle CSRF token for API endpoints
     if request.path.startswith("/api/"):
@@ -108,27 +271,51 @@ def check_csrf():  # Handle CSRF token for API endpoints
         session["request_token"] = token_urlsafe(16)
 
 
+@app.after_request  # MARK: After request
+def remember_last_write(response):
+    # Reads of this session go to the primary database for a while (read-your-writes)
+    # Only a logged in user's accepted requests write, a 401 or failed login writes nothing
+    if (request.path.startswith("/api/") and request.method == "POST"
+            and "user" in session and response.status_code < 400):
+        session["last_write"] = int(time())
+    return response
+
+
 @app.get("/")  # MARK: Pages
 @app.get("/c/<int:category_id>")
 def home(category_id=None):
     page = int(request.args.get("page")
                if "page" in request.args.keys() else "0")
-    categories = get_db().get_categories()
+    categories = get_categories()
 
     # Make sure category is valid
     if isinstance(category_id, int) and category_id not in range(1, len(categories) + 1):
         return redirect("/")
 
+    # Feed order: latest, hot, top this week or top of all time
+    sort = request.args.get("sort", "latest")
+    if sort not in ("latest", "hot", "week", "top"):
+        return "Unknown sort.", 400
+
+    # Any change can move the feed, ranked feeds also move with the score refreshes
+    ranking_round = int(time() // ranking_refresh_interval) if sort in ("hot", "week") else 0
+    etag = page_etag(get_db().get_latest_version(), ranking_round)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
     challenges = get_db().get_challenges(
         session["user"]["id"] if "user" in session else -1,
         category_id,
-        page)
-    return render_template("./pages/home.html",
-                           at_home=request.path == "/",
-                           challenges=challenges,
-                           category_name=categories[category_id -
-                                                    1].name if category_id else None,
-                           page=page)
+        page,
+        sort)
+    return with_etag(stream_page("./pages/home.html",
+                                 at_home=request.path == "/",
+                                 challenges=challenges,
+                                 sort=sort,
+                                 category_name=categories[category_id -
+                                                          1].name if category_id else None,
+                                 page=page), etag)
 
 
 @app.get("/search")
@@ -148,12 +335,12 @@ def search():
                                                 session["user"]["id"] if "user" in session else -1,
                                                 None,
                                                 page)
-    return render_template("./pages/search-results.html",
-                           challenges=challenges,
-                           users=users,
-                           search_string=search_string,
-                           page=page,
-                           tab=search_tab)
+    return stream_page("./pages/search-results.html",
+                       challenges=challenges,
+                       users=users,
+                       search_string=search_string,
+                       page=page,
+                       tab=search_tab)
 
 
 @app.get("/login")
@@ -205,6 +392,15 @@ def challenge(challenge_id, sub_path, reply_id, sub_action):
     user_id = session["user"]["id"] if "user" in session else -1
     page = int(request.args.get("page")
                if "page" in request.args.keys() else "0")
+
+    # The challenge page itself can be answered from the browser's copy, forms are not
+    etag = None
+    if not sub_path:
+        etag = page_etag(get_db().get_challenge_version(challenge_id))
+        unchanged = not_modified(etag)
+        if unchanged:
+            return unchanged
+
     try:
         challenge_data = get_db().get_challenge(user_id, challenge_id)
     except ChallengeNotFoundException:
@@ -224,7 +420,7 @@ def challenge(challenge_id, sub_path, reply_id, sub_action):
 
     # Performing actions requires user to be admin or own the content
     # NOTE: Checked in API too
-    if not session["user"]["is_admin"]:
+    if "user" in session and not session["user"]["is_admin"]:
         if sub_path in ("edit", "delete") and not sub_action and challenge_data.author_id != user_id:
             return redirect(f"/chall/{challenge_id}")
         if sub_action and reply_to_edit.author_id != user_id:
@@ -255,6 +451,13 @@ def challenge(challenge_id, sub_path, reply_id, sub_action):
             return "Not found.", 404
         template = forms[form_key]
 
+    # Forms are short, only the challenge page itself is streamed
+    if etag:
+        return with_etag(stream_page(template,
+                                     challenge=challenge_data,
+                                     replies=comments_and_submissions,
+                                     reply_to_edit=reply_to_edit,
+                                     page=page), etag)
     return render_template(template,
                            challenge=challenge_data,
                            replies=comments_and_submissions,
@@ -276,6 +479,11 @@ def profile(username):
     except UserNotFoundException:
         return redirect("/")
 
+    etag = page_etag(get_db().get_user_version(user.id))
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
     page = int(request.args.get("page")
                if "page" in request.args.keys() else "0")
     content = get_db().get_user_content(session["user"]["id"] if "user" in session else -1,
@@ -283,13 +491,13 @@ def profile(username):
     received_votes = get_db().get_received_votes(user.id)
     given_votes = get_db().get_given_votes(user.id)
 
-    return render_template("./pages/profile.html",
-                           profile=user.profile.to_dict(),
-                           username=user.username,
-                           content=content,
-                           received_votes=received_votes,
-                           given_votes=given_votes,
-                           page=page)
+    return with_etag(stream_page("./pages/profile.html",
+                                 profile=user.profile.to_dict(),
+                                 username=user.username,
+                                 content=content,
+                                 received_votes=received_votes,
+                                 given_votes=given_votes,
+                                 page=page), etag)
 
 
 @app.get("/me/edit", defaults={"username": ""})
@@ -334,17 +542,79 @@ def target_user_settings(username):
     return render_template("./pages/user-settings.html", user=user)
 
 
+@app.get("/admin/metrics")
+def admin_metrics():
+    # Must be admin
+    if "user" not in session or not session["user"]["is_admin"]:
+        return "Permission denied.", 401
+
+    return jsonify(metrics.snapshot())
+
+
+@app.get("/admin/jobs")
+def admin_jobs():
+    # Must be admin
+    if "user" not in session or not session["user"]["is_admin"]:
+        return "Permission denied.", 401
+
+    return jsonify(job_queue.status())
+
+
+def send_asset(value: bytes, content_type: str) -> Response:
+    response = Response(value)
+    response.headers["Content-Type"] = content_type
+    response.headers["X-Content-Type-Options"] = "nosniff"
+
+    # Asset ids are never reused for other content (AUTOINCREMENT), so caches can keep them
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+def send_original(asset_to_send: Asset) -> Response:
+    # Sniffed at upload, older assets are sniffed here
+    content_type = (asset_to_send.content_type or
+                    sniff_image_type(asset_to_send.value[:16]) or
+                    filename_to_file_type(asset_to_send.filename))
+    return send_asset(asset_to_send.value, content_type)
+
+
 @app.get("/a/<int:asset_id>")
 def asset(asset_id):
     try:
-        asset_to_send = get_db().get_asset(asset_id)
+        return send_original(get_db().get_asset(asset_id))
     except AssetNotFoundException:
         return redirect("/")
 
-    response = Response(asset_to_send.value)
-    response.headers["Content-Type"] = filename_to_file_type(
-        asset_to_send.filename)
-    return response
+
+@app.get("/a/<int:asset_id>/<string:variant>")
+def asset_variant(asset_id, variant):
+    if variant == "original":
+        return asset(asset_id)
+    if variant not in image_variants:
+        return "Unknown variant.", 404
+    if not variants_enabled:  # Without Pillow the original is all there is, nothing is stored
+        return asset(asset_id)
+
+    stored = get_db().get_asset_variant(asset_id, variant)
+    if stored is not None:
+        metrics.increment("assets.variant_hits")
+        if stored.content_type == use_original:  # Tried before, the original has to do
+            return asset(asset_id)
+        return send_asset(stored.value, stored.content_type)
+
+    # Made on first request, for images uploaded before variants existed
+    try:
+        original = get_db().get_asset(asset_id)
+    except AssetNotFoundException:
+        return redirect("/")
+    metrics.increment("assets.variant_misses")
+    made = make_variant(original.value, variant)
+    if made is None:  # Not an image: remembered, so it is not tried again
+        get_db().create_asset_variant(asset_id, variant, use_original, b"")
+        return send_original(original)
+    value, content_type = made
+    get_db().create_asset_variant(asset_id, variant, content_type, value)
+    return send_asset(value, content_type)
 
 
 # MARK: API
@@ -380,13 +650,91 @@ app.add_url_rule("/api/admin/request-password-change",
                  view_func=api_require_password_change, methods=["POST"])
 
 
+@app.cli.command("check-counters")  # MARK: Commands
+@click.option("--fix", is_flag=True, help="Recompute the counters that have drifted.")
+def check_counters(fix):
+    """Check the reply counters of challenges against the actual replies."""
+    drifted = get_db().check_reply_counters(fix)
+    for challenge_id, comment_count, comments, submission_count, submissions in drifted:
+        click.echo(f"Challenge {challenge_id}: comments {comment_count} (actual {comments}), "
+                   f"submissions {submission_count} (actual {submissions})")
+    if not drifted:
+        click.echo("All reply counters are consistent.")
+    elif fix:
+        click.echo(f"Fixed {len(drifted)} challenges.")
+
+
+@app.cli.command("check-migrations")
+def check_migrations_command():
+    """Check that the migrations bring an old database to the same schema as schema.sql."""
+    differences = check_migrations(Path(database_params[1]), Path(baseline_schema_filepath))
+    for difference in differences:
+        click.echo(difference)
+    if differences:
+        raise click.ClickException("Migrations and schema.sql have drifted apart.")
+    click.echo("Migrations match schema.sql.")
+
+
+@app.cli.command("collect-assets")
+@click.option("--enable-vacuum", is_flag=True,
+              help="Switch an older database to incremental vacuum first (runs VACUUM).")
+def collect_assets(enable_vacuum):
+    """Remove unreferenced assets and give the space back to the filesystem."""
+    collector = get_asset_collector()
+    if enable_vacuum:
+        collector.enable_vacuum()
+    removed, reclaimed = collector.collect()
+    vacuumed = collector.vacuum()
+    click.echo(f"Removed {removed} assets ({reclaimed} bytes), "
+               f"gave {vacuumed} bytes back to the filesystem.")
+
+
 @app.errorhandler(NotFound)  # MARK: Default error handlers
 def handle_exception_not_found(_):
     return "Not found.", 404
 
 
+@app.errorhandler(RequestEntityTooLarge)
+def handle_exception_too_large(_):
+    return "Upload too large.", 413
+
+
+@app.errorhandler(UploadRejectedException)
+def handle_exception_upload_rejected(e):
+    return str(e), 400
+
+
+@app.errorhandler(HasherBusyException)
+def handle_exception_hasher_busy(_):
+    return "Server busy, try again later.", 503
+
+
 @app.errorhandler(Exception)
 def handle_exception_general(e):
     print("Internal Server Error")
     print_exception(e)
     return "Internal server error.", 500
+
+
+# Compile every template now, instead of during the first requests
+app.extensions["template_warmup"] = warm_up_templates(app)
+
+
+def create_app() -> Flask:
+    # Entry point for pre-fork servers, run in the repository root like the rest of the app:
+    # gunicorn --pythonpath src --preload -w 4 "app:create_app()"
+    # Runs once in the master, the workers are forked with everything below already loaded.
+    # Connections, threads and pools are only created in the workers (see util/prefork.py).
+    start = perf_counter()
+    load_secret_key()
+    db = AbstractDatabase(open_database())  # Creates or migrates the database
+    try:
+        app.extensions["categories"] = db.get_categories()
+    finally:
+        db.connection.close()
+
+    # Keep the loaded objects out of garbage collection, so the workers share their pages
+    gc.collect()
+    gc.freeze()
+    print(f"Preloaded in {(perf_counter() - start) * 1000:.1f} ms.")
+    return app
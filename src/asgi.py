@@ -0,0 +1,201 @@
+# ASGI entry point for the app, e.g. `uvicorn --app-dir src asgi:asgi_app` in the repository root
+# The Flask app itself stays a WSGI app, so the sync behavior is identical.
+# The event loop holds idle connections and sends, the app takes a worker thread while it runs.
+# Assets (/a/<id>) skip the app: they are read with the awaitable database and sent from the loop.
+
+import asyncio
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from threading import Condition
+from flask import redirect
+from app import app, send_original
+from database.abstract import AssetNotFoundException
+from util.get_db import get_async_db
+
+asset_path = re.compile(r"/a/(\d+)")
+
+
+def encode_headers(headers) -> list:
+    return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+
+class ResponseBuffer:
+    # Messages from the worker thread to the event loop, which sends them to the client
+    # The worker only waits for a slow client when more than high_water bytes are waiting
+    def __init__(self, loop, high_water: int):
+        self.loop = loop
+        self.high_water = high_water
+        self.messages = asyncio.Queue()
+        self.buffered = 0
+        self.closed = False
+        self.condition = Condition()
+
+    def put(self, message: dict):  # In the worker thread
+        with self.condition:
+            while self.buffered > self.high_water and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise ConnectionAbortedError("Client is gone")
+            self.buffered += len(message.get("body", b""))
+        self.loop.call_soon_threadsafe(self.messages.put_nowait, message)
+
+    def finish(self):  # In the worker thread, after the last message
+        self.loop.call_soon_threadsafe(self.messages.put_nowait, None)
+
+    def sent(self, message: dict):  # In the event loop
+        with self.condition:
+            self.buffered -= len(message.get("body", b""))
+            self.condition.notify()
+
+    def close(self):  # In the event loop, the worker stops at its next message
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class WsgiToAsgi:
+    def __init__(self,
+                 wsgi_app,
+                 workers: int = 16,
+                 max_memory_body: int = 1024 * 1024,
+                 high_water: int = 64 * 1024):
+        self.wsgi_app = wsgi_app
+        self.max_memory_body = max_memory_body
+        self.high_water = high_water
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="asgi-worker")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        match = asset_path.fullmatch(scope["path"])
+        if match and scope["method"] == "GET":
+            await self._asset(int(match[1]), send)
+            return
+
+        body = await self._read_body(receive)
+        loop = asyncio.get_running_loop()
+        buffer = ResponseBuffer(loop, self.high_water)
+        worker = loop.run_in_executor(self.executor, self._run, self._environ(scope, body), buffer)
+        try:
+            while True:
+                message = await buffer.messages.get()
+                if message is None:
+                    break
+                await send(message)
+                buffer.sent(message)
+            await worker  # Raises what the app raised
+        finally:
+            buffer.close()
+            await asyncio.gather(worker, return_exceptions=True)
+            body.close()
+
+    async def _read_body(self, receive):
+        # Read the request body without a worker thread, large bodies go to disk
+        body = SpooledTemporaryFile(max_size=self.max_memory_body)  # pylint: disable=consider-using-with
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.write(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        body.seek(0)
+        return body
+
+    def _run(self, environ: dict, buffer: ResponseBuffer):  # In a worker thread
+        try:
+            self._render(environ, buffer)
+        finally:
+            buffer.finish()
+
+    def _render(self, environ: dict, buffer: ResponseBuffer):
+        # The whole response is rendered in one worker thread, streamed pages keep using
+        # the request's SQLite connection and Flask context while rendering
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = encode_headers(headers)
+
+        def start():
+            buffer.put({"type": "http.response.start",
+                        "status": response["status"],
+                        "headers": response["headers"]})
+
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            started = False
+            for chunk in iterable:
+                if not started:
+                    start()
+                    started = True
+                if chunk:
+                    buffer.put({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not started:
+                start()
+            buffer.put({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    async def _asset(self, asset_id: int, send):
+        # Same response as the /a/<asset_id> route, only the read takes a (reader) thread
+        # Sessions are not touched, a visitor without one does not get a cookie here
+        try:
+            response = send_original(await get_async_db().get_asset(asset_id))
+        except AssetNotFoundException:
+            response = redirect("/")
+        await send({"type": "http.response.start",
+                    "status": response.status_code,
+                    "headers": encode_headers(response.headers.to_wsgi_list())})
+        await send({"type": "http.response.body", "body": response.get_data()})
+
+    def _environ(self, scope, body) -> dict:
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else "HTTP_" + name
+            if key in environ:
+                value = environ[key] + ("; " if key == "HTTP_COOKIE" else ",") + value
+            environ[key] = value
+        return environ
+
+
+asgi_app = WsgiToAsgi(app)
@@ -0,0 +1,90 @@
+import tracemalloc
+from sqlite3 import connect
+from timeit import timeit
+from database.abstract import page_size
+from database.types import ChallengeHusk
+
+# Micro-benchmark for building feed rows: __dict__ based husks vs. __slots__ husks
+# Usage: python bench_husks.py (from the src/ directory)
+
+
+class DictChallengeHusk:  # The husk as it was before __slots__
+    def __init__(self,
+                 challenge_id,
+                 created,
+                 title,
+                 body,
+                 accepts_submissions,
+                 category_id,
+                 category_name,
+                 author_name,
+                 author_id,
+                 author_image_id,
+                 votes,
+                 has_my_vote,
+                 comment_count,
+                 submission_count,
+                 last_activity):
+        self.id = challenge_id
+        self.created = created
+        self.title = title
+        self.body = body
+        self.accepts_submissions = accepts_submissions == 1
+        self.category_id = category_id
+        self.category_name = category_name
+        self.author_name = author_name
+        self.author_id = author_id
+        self.author_image_id = author_image_id
+        self.votes = votes
+        self.has_my_vote = has_my_vote == 1
+        self.comment_count = comment_count
+        self.submission_count = submission_count
+        self.last_activity = last_activity
+
+
+rows_per_run = 1000
+row = (1, 1733725672, "Hello World?", "Make JavaScript output 'Hello, World!'",
+       1, 2, "Least Lines of Javascript", "admin", 0, None, 12, 0,
+       3, 1, 1733729272)
+rows = [row] * rows_per_run
+
+# In-memory table to measure the full fetch + build path
+db = connect(":memory:")
+db.execute("CREATE TABLE Rows (a, b, c, d, e, f, g, h, i, j, k, l, m, n, o)")
+db.executemany("INSERT INTO Rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def allocated(build):  # Bytes still held by the built husks
+    tracemalloc.start()
+    built = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+    return size
+
+
+def fetch_tuples_then_build():
+    return [DictChallengeHusk(*result) for result in db.execute("SELECT * FROM Rows").fetchall()]
+
+
+def fetch_tuples_then_build_slots():
+    return [ChallengeHusk(*result) for result in db.execute("SELECT * FROM Rows").fetchall()]
+
+
+print(f"Per page ({page_size} rows):")
+print(f"  __dict__ husks: {allocated(lambda: [DictChallengeHusk(*r) for r in rows[:page_size]])} B")
+print(f"  __slots__ husks: {allocated(lambda: [ChallengeHusk(*r) for r in rows[:page_size]])} B")
+
+print(f"Construction ({rows_per_run} rows, best of 5):")
+for name, build in (("__dict__ husks", lambda: [DictChallengeHusk(*r) for r in rows]),
+                    ("__slots__ husks", lambda: [ChallengeHusk(*r) for r in rows])):
+    best = min(timeit(build, number=100) for _ in range(5)) / 100
+    print(f"  {name}: {best * 1e6:.0f} us")
+
+print(f"Fetch + construction ({rows_per_run} rows, best of 5):")
+for name, build in (("tuples then __dict__ husks", fetch_tuples_then_build),
+                    ("tuples then __slots__ husks", fetch_tuples_then_build_slots)):
+    best = min(timeit(build, number=100) for _ in range(5)) / 100
+    print(f"  {name}: {best * 1e6:.0f} us")
+
+db.close()
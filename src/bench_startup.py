@@ -0,0 +1,78 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from statistics import median
+
+# Startup benchmark: how long a worker takes from start to its first answered request
+# - cold: nothing on disk yet (new database, no compiled templates)
+# - warm: database and template bytecode cache from an earlier start
+# - forked: a worker forked from a master that ran create_app() (pre-fork preload)
+# Usage: python bench_startup.py (from the src/ directory)
+
+runs = 5
+src = Path(__file__).resolve().parent
+
+# Runs in a new interpreter, prints the seconds to import and to answer the first request
+worker = f"""
+import sys
+from time import perf_counter
+start = perf_counter()
+sys.path.insert(0, {str(src)!r})
+from app import app
+imported = perf_counter()
+app.test_client().get("/", buffered=True)
+print(imported - start, perf_counter() - start)
+"""
+
+# Preloads in the master, then times the first request of a forked worker
+forked = f"""
+import os, sys
+sys.path.insert(0, {str(src)!r})
+from time import perf_counter
+from app import create_app
+app = create_app()
+read, write = os.pipe()
+if os.fork() == 0:
+    start = perf_counter()
+    app.test_client().get("/", buffered=True)
+    os.write(write, str(perf_counter() - start).encode())
+    os._exit(0)
+os.wait()
+print(0.0, float(os.read(read, 64)))
+"""
+
+
+def measure(script: str, directory: Path):
+    result = subprocess.run([sys.executable, "-c", script], cwd=directory, check=True,
+                            capture_output=True, text=True)
+    imported, first_request = result.stdout.strip().splitlines()[-1].split()
+    return float(imported), float(first_request)
+
+
+def fresh_directory() -> Path:
+    directory = Path(tempfile.mkdtemp())
+    shutil.copytree(src.parent / "db", directory / "db")
+    return directory
+
+
+def report(name: str, results):
+    imports = [imported for imported, _ in results]
+    totals = [total for _, total in results]
+    print(f"{name:>8}: import {median(imports) * 1000:8.1f} ms, "
+          f"first response after {median(totals) * 1000:8.1f} ms (median of {len(results)})")
+
+
+if __name__ == "__main__":
+    directories = [fresh_directory() for _ in range(runs)]
+    try:
+        # The app expects to be started in the repository root (./db/main.db and so on)
+        report("cold", [measure(worker, directory) for directory in directories])
+        report("warm", [measure(worker, directory) for directory in directories])
+        if hasattr(os, "fork"):
+            report("forked", [measure(forked, directory) for directory in directories])
+    finally:
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -1,10 +1,15 @@
 # Database abstractions on top of SQL to make development easier
 # Implements complex functions to perform tasks (not just "commands") against the database
 
+from threading import Lock
 from time import time
-from typing import List, Literal, Optional, Union
+from typing import BinaryIO, List, Literal, Optional, Tuple, Union
 from database.sql import sql_table
+from database.coherence import CoherentCache, get_change_tracker
 from database.connection import DatabaseConnection
+from database.params import database_params, use_shared_cache
+from database.previews import make_body_preview
+from database.shared_cache import SharedCache
 from database.types import (
     Asset,
     AssetNotFoundException,
@@ -12,6 +17,7 @@ from database.types import (
     ChallengeHusk,
     ChallengeEditable,
     ChallengeNotFoundException,
+    DatabaseException,
     Profile,
     ProfileEditable,
     ProfileNotFoundException,
@@ -24,17 +30,33 @@ from database.types import (
     CommentEditable,
     CommentNotFoundException,
     CommentHusk,
+    ContentOwner,
     SubmissionHusk,
     StatsDict,
-    StatsException
+    Page,
+    StatsException,
+    VoteState,
+    user_from_dict
 )
+from util.prefork import after_fork
 
 page_size = 10
+user_cache_size = 128  # Users with their profile images
+search_count_cap = 1000  # Search results are counted up to this, then shown as "1000+"
 
 
 class AbstractDatabase:
     def __init__(self, connection=DatabaseConnection):
         self.connection = connection
+        self.owners = {}  # get_owner() results, an instance lives for one request
+
+    def _count(self, query: str, parameters: tuple) -> int:
+        return self.connection.query(query=sql_table[query], parameters=parameters, limit=1)[0][0]
+
+    def _search_count(self, query: str, parameters: tuple) -> Tuple[int, bool]:
+        # Stops counting at the cap: (count, capped)
+        count = self._count(query, (*parameters, search_count_cap + 1))
+        return min(count, search_count_cap), count > search_count_cap
 
     # MARK: User Abstractions
     def user_exists(self, username: str) -> bool:
@@ -61,6 +83,24 @@ class AbstractDatabase:
         return self.get_user(username)
 
     def get_user(self, username: str) -> User:
+        # Without the password hash and asset contents, the same whether cached or not
+        # Only reads of the primary database are cached, a snapshot may be behind it
+        if self.connection.database_filepath != database_params[0]:
+            return user_from_dict(self._load_user(username).to_dict())
+        return user_from_dict(get_user_cache().get_or_load(
+            username,
+            lambda: self._load_user(username).to_dict(),
+            lambda user: [("user", user["id"])]))
+
+    def get_password_hash(self, username: str) -> str:
+        # Read only when a password is checked, never cached
+        result = self.connection.query(query=sql_table["get_password_hash"],
+                                       parameters=(username,), limit=1)
+        if len(result) == 0:
+            raise UserNotFoundException(username)
+        return result[0][0]
+
+    def _load_user(self, username: str) -> User:
         # TODO: Use table joins to get all the user info at once?
         # Get user
         result = self.connection.query(query=sql_table["get_user"],
@@ -73,9 +113,9 @@ class AbstractDatabase:
 
         return User(user_data[0],
                     user_data[1],
-                    user_data[2],
+                    None,
+                    user_data[2] == 1,
                     user_data[3] == 1,
-                    user_data[4] == 1,
                     user_profile)
 
     def edit_user(self, username: str, new_fields: UserEditable):
@@ -141,18 +181,38 @@ class AbstractDatabase:
     # MARK: Asset abstractions
     def create_asset(self, filename: str, value: bytes) -> Asset:
         _, cursor = self.connection.execute(query=sql_table["create_asset"],
-                                            parameters=(filename, value))
+                                            parameters=(filename, value, int(time())))
         asset_id = cursor.lastrowid
         cursor.close()
 
         return Asset(asset_id, filename, value)
 
+    def create_asset_from_stream(self,
+                                 filename: str,
+                                 content_type: str,
+                                 stream: BinaryIO,
+                                 size: int) -> int:
+        # Copied into the database in chunks, the upload is never fully in memory
+        _, cursor = self.connection.execute_blob(query=sql_table["create_asset_streamed"],
+                                                 parameters=(filename,
+                                                             size,
+                                                             int(time()),
+                                                             content_type),
+                                                 table="Assets",
+                                                 column="value",
+                                                 stream=stream)
+        asset_id = cursor.lastrowid
+        cursor.close()
+        if asset_id is None:
+            raise DatabaseException("Asset could not be stored!")
+        return asset_id
+
     def get_asset(self, asset_id: int) -> Asset:
         result = self.connection.query(
             query=sql_table["get_asset"], parameters=(asset_id,), limit=1)
         if not result:
             raise AssetNotFoundException(asset_id)
-        return Asset(asset_id, result[0][0], result[0][1])
+        return Asset(asset_id, *result[0])
 
     def get_asset_with_submission_id(self, submission_id: int) -> Asset:
         # Handy shortcut used in processing edits to submissions
@@ -163,34 +223,67 @@ class AbstractDatabase:
         return Asset(result[0][0], result[0][1], value=result[0][2])
 
     def remove_asset(self, asset_id: int):
-        self.connection.execute(
-            query=sql_table["remove_asset"], parameters=(asset_id,))
+        # Raises on failure, so the remove_asset job is retried
+        _, cursor = self.connection.execute(
+            query=sql_table["remove_asset"], parameters=(asset_id,), raise_errors=True)
+        cursor.close()
+
+    def get_asset_variant(self, asset_id: int, variant: str) -> Optional[Asset]:
+        # None until the variant has been made
+        result = self.connection.query(
+            query=sql_table["get_asset_variant"], parameters=(asset_id, variant), limit=1)
+        if not result:
+            return None
+        content_type, value = result[0]
+        return Asset(asset_id, variant, value, content_type)
+
+    def create_asset_variant(self, asset_id: int, variant: str, content_type: str, value: bytes):
+        # Removed together with the original asset (ON DELETE CASCADE)
+        _, cursor = self.connection.execute(query=sql_table["create_asset_variant"],
+                                            parameters=(asset_id, variant, content_type, value))
+        cursor.close()
 
     # MARK: Categ. abstractions
     def get_categories(self) -> List[Category]:
         results = self.connection.query(query=sql_table["get_categories"])
-        categories = []
-        for result in results:
-            categories.append(Category(result[0], result[1]))
-
-        return categories
+        return [Category(*result) for result in results]
 
     # MARK: Chall. abstractions
     def get_challenges(self,
                        current_user_id: int,
                        category_id: Optional[int],
-                       page: int) -> List[ChallengeHusk]:
-        results = self.connection.query(query=sql_table["get_full_challenges"],
+                       page: int,
+                       sort: Literal["latest", "hot", "week", "top"] = "latest") -> Page:
+        # Top this week is not counted, it would need a scan of the week
+        total = (self._count("count_challenges", (category_id, category_id))
+                 if sort != "week" else None)
+        if sort == "latest":
+            results = self.connection.query(query=sql_table["get_full_challenges"],
+                                            parameters=(
+                current_user_id,
+                category_id,
+                category_id,
+                page_size + 1,
+                page * page_size))
+            return Page([ChallengeHusk(*result) for result in results[:page_size]],
+                        len(results) > page_size,
+                        total)
+
+        # Ranked by the precomputed scores (see database/ranking.py)
+        if sort not in ("hot", "week", "top"):
+            raise ValueError("Unknown sort!")
+        results = self.connection.query(query=sql_table["get_challenges_hot" if sort == "hot"
+                                                        else "get_challenges_top"],
                                         parameters=(
             current_user_id,
+            int(time()) - 7 * 24 * 60 * 60 if sort == "week" else 0,
             category_id,
             category_id,
-            page_size,
+            page_size + 1,
             page * page_size))
-        challenges = []
-        for result in results:
-            challenges.append(ChallengeHusk(*result))
-        return challenges
+        return Page([ChallengeHusk(*result) for result in results[:page_size]],
+                    len(results) > page_size,
+                    total)
 
     def challenge_exists(self, challenge_id: int) -> bool:
         return self.connection.query(query=sql_table["challenge_exists"],
@@ -210,43 +303,53 @@ class AbstractDatabase:
     def get_challenge_replies(self,
                               current_user_id: int,
                               challenge_id: int,
-                              page: int) -> List[Union[CommentHusk, SubmissionHusk]]:
+                              page: int) -> Page:
         results = self.connection.query(query=sql_table["get_comments_and_submissions"],
                                         parameters=(
             current_user_id,
             challenge_id,
             current_user_id,
             challenge_id,
-            page_size,
+            page_size + 1,
             page * page_size))
 
         all_replies = []
-        for entry_type, *result in results:
+        for entry_type, *result in results[:page_size]:
             if entry_type == "comment":
                 all_replies.append(CommentHusk(*result[0:-3]))
             else:
                 all_replies.append(SubmissionHusk(*result))
 
-        return all_replies
-
-    def edit_challenge(self, challenge_id: int, new_fields: ChallengeEditable):
-        # Check if challenge exists
-        if not self.challenge_exists(challenge_id):
-            raise ChallengeNotFoundException(challenge_id)
-
+        # Kept up to date on the challenge row (see db/schema.sql)
+        return Page(all_replies,
+                    len(results) > page_size,
+                    self._count("count_challenge_replies", (challenge_id,)))
+
+    def edit_challenge(self,
+                       challenge_id: int,
+                       new_fields: ChallengeEditable,
+                       author_id: Optional[int] = None) -> bool:
+        # With author_id, only a challenge of that author is edited
+        # Returns False when nothing was edited, get_owner() then tells why
         _, cursor = self.connection.execute(query=sql_table["edit_challenge"],
                                             parameters=(
             new_fields["title"],
             new_fields["body"],
+            make_body_preview(new_fields["body"]),
             new_fields["category_id"],
             1 if new_fields["accepts_submissions"] else 0,
-            challenge_id))
+            challenge_id,
+            author_id,
+            author_id))
         cursor.close()
+        return cursor.rowcount == 1
 
-    def remove_challenge(self, challenge_id: int):
+    def remove_challenge(self, challenge_id: int, author_id: Optional[int] = None) -> bool:
         _, cursor = self.connection.execute(query=sql_table["remove_challenge"],
-                                            parameters=(challenge_id,))
+                                            parameters=(challenge_id, author_id, author_id))
         cursor.close()
+        self.owners.pop(("challenge", challenge_id), None)
+        return cursor.rowcount == 1
 
     def create_challenge(self,
                          title: str,
@@ -259,6 +362,7 @@ class AbstractDatabase:
             int(time()),
             title,
             body,
+            make_body_preview(body),
             category_id,
             author_id,
             1 if accepts_submissions else 0))
@@ -266,12 +370,21 @@ class AbstractDatabase:
         cursor.close()
         return post_id
 
+    def check_reply_counters(self, fix: bool = False) -> List[tuple]:
+        # Counters are kept by triggers, this finds (and fixes) any drift:
+        # (challenge_id, comment_count, comments, submission_count, submissions)
+        drifted = self.connection.query(query=sql_table["get_drifted_reply_counters"])
+        if fix and drifted:
+            self.connection.execute_batch([(sql_table["fix_reply_counters"], (result[0],))
+                                           for result in drifted])
+        return drifted
+
     # MARK: Search
     def search_challenges(self,
                           search_string: str,
                           current_user_id: int,
                           category_id: Optional[int],
-                          page: int):
+                          page: int) -> Page:
         results = self.connection.query(query=sql_table["search_challenges"],
                                         parameters=(
             current_user_id,
@@ -279,22 +392,27 @@ class AbstractDatabase:
             category_id,
             search_string,
             search_string,
-            page_size,
+            page_size + 1,
             page * page_size))
+        total, capped = self._search_count("count_search_challenges",
+                                           (category_id, category_id, search_string, search_string))
 
-        return [ChallengeHusk(*result) for result in results]
+        return Page([ChallengeHusk(*result) for result in results[:page_size]],
+                    len(results) > page_size,
+                    total,
+                    capped)
 
-    def search_users(self, search_string: str, page: int):
+    def search_users(self, search_string: str, page: int) -> Page:
         # This method does not returns complete user & profile information
         # to optimize querying. To get full user info, use get_user
         results = self.connection.query(query=sql_table["search_users"],
                                         parameters=(
             search_string,
-            page_size,
+            page_size + 1,
             page * page_size))
 
         users = []
-        for result in results:
+        for result in results[:page_size]:
             profile_image_asset = Asset(*result[5:8])
             user_profile = Profile(result[3],
                                    result[0],
@@ -311,7 +429,8 @@ class AbstractDatabase:
             )
             users.append(user)
 
-        return users
+        total, capped = self._search_count("count_search_users", (search_string,))
+        return Page(users, len(results) > page_size, total, capped)
 
     # MARK: Voting abstractions
     def vote_for(self,
@@ -350,6 +469,29 @@ class AbstractDatabase:
             query=statement, parameters=(target_id, user_id))
         cursor.close()
 
+    def get_vote_state(self,
+                       target_type: Literal["submission", "comment", "challenge"],
+                       target_id: int,
+                       user_id: int) -> VoteState:
+        if target_type not in ("submission", "challenge", "comment"):
+            raise ValueError("Unknown target type!")
+
+        [result] = self.connection.query(query=sql_table[f"get_vote_state_for_{target_type}"],
+                                         parameters=(target_id, target_id, user_id))
+        return VoteState(*result)
+
+    def set_vote(self,
+                 target_type: Literal["submission", "comment", "challenge"],
+                 target_id: int,
+                 user_id: int,
+                 voted: bool) -> VoteState:
+        # Idempotent, setting the same state twice changes nothing
+        if voted:
+            self.vote_for(target_type, target_id, user_id)
+        else:
+            self.remove_vote_from(target_type, target_id, user_id)
+        return self.get_vote_state(target_type, target_id, user_id)
+
     # MARK: Comment abstractions
     def create_comment(self, challenge_id: int, body: str, author_id: int) -> int:
         _, cursor = self.connection.execute(query=sql_table["create_comment"],
@@ -362,10 +504,12 @@ class AbstractDatabase:
         cursor.close()
         return comment_id
 
-    def remove_comment(self, comment_id: int):
+    def remove_comment(self, comment_id: int, author_id: Optional[int] = None) -> bool:
         _, cursor = self.connection.execute(query=sql_table["remove_comment"],
-                                            parameters=(comment_id,))
+                                            parameters=(comment_id, author_id, author_id))
         cursor.close()
+        self.owners.pop(("comment", comment_id), None)
+        return cursor.rowcount == 1
 
     def get_comment(self, current_user_id: int, comment_id: int) -> CommentHusk:
         [result] = self.connection.query(query=sql_table["get_comment"],
@@ -378,14 +522,17 @@ class AbstractDatabase:
         return self.connection.query(query=sql_table["comment_exists"],
                                      parameters=(comment_id,), limit=1)[0][0] == 1
 
-    def edit_comment(self, comment_id: int, new_fields: CommentEditable):
-        # Check if challenge exists
-        if not self.comment_exists(comment_id):
-            raise CommentNotFoundException(comment_id)
-
+    def edit_comment(self,
+                     comment_id: int,
+                     new_fields: CommentEditable,
+                     author_id: Optional[int] = None) -> bool:
         _, cursor = self.connection.execute(query=sql_table["edit_comment"],
-                                            parameters=(new_fields["body"], comment_id))
+                                            parameters=(new_fields["body"],
+                                                        comment_id,
+                                                        author_id,
+                                                        author_id))
         cursor.close()
+        return cursor.rowcount == 1
 
     # MARK: Submissions abstractions
     def create_submission(self,
@@ -406,10 +553,12 @@ class AbstractDatabase:
         cursor.close()
         return submission_id
 
-    def remove_submission(self, submission_id: int):
+    def remove_submission(self, submission_id: int, author_id: Optional[int] = None) -> bool:
         _, cursor = self.connection.execute(query=sql_table["remove_submission"],
-                                            parameters=(submission_id,))
+                                            parameters=(submission_id, author_id, author_id))
         cursor.close()
+        self.owners.pop(("submission", submission_id), None)
+        return cursor.rowcount == 1
 
     def get_submission(self, current_user_id: int, submission_id: int) -> SubmissionHusk:
         [result] = self.connection.query(query=sql_table["get_submission"],
@@ -422,26 +571,22 @@ class AbstractDatabase:
         return self.connection.query(query=sql_table["submission_exists"],
                                      parameters=(comment_id,), limit=1)[0][0] == 1
 
-    def edit_submission(self, submission_id: int, new_fields: SubmissionEditable):
-        # Check if challenge exists
-        if not self.submission_exists(submission_id):
-            raise SubmissionNotFoundException(submission_id)
-
-        # If script_id is not provided, delete original and create new asset
-        script_asset_id = new_fields["script_id"]
-        if not new_fields["script_id"]:
-            current_asset = self.get_asset_with_submission_id(submission_id)
-            self.remove_asset(current_asset.id)
-            new_script_asset = self.create_asset(
-                new_fields["script_name"], new_fields["script_bytes"])
-            script_asset_id = new_script_asset.id
-
+    def edit_submission(self,
+                        submission_id: int,
+                        new_fields: SubmissionEditable,
+                        author_id: Optional[int] = None) -> bool:
+        # The new script is stored by the caller first (create_asset_from_stream)
+        # The original is left for the caller or the asset collector to remove,
+        # it can only go once the submission no longer references it
         _, cursor = self.connection.execute(query=sql_table["edit_submission"],
                                             parameters=(new_fields["title"],
                                                         new_fields["body"],
-                                                        script_asset_id,
-                                                        submission_id))
+                                                        new_fields["script_id"],
+                                                        submission_id,
+                                                        author_id,
+                                                        author_id))
         cursor.close()
+        return cursor.rowcount == 1
 
     # MARK: Get all user content
 
@@ -464,7 +609,7 @@ class AbstractDatabase:
     def get_user_content(self,
                          as_user_id: int,
                          for_user_id: int,
-                         page: int) -> List[Union[ChallengeHusk, CommentHusk, SubmissionHusk]]:
+                         page: int) -> Page:
         results = self.connection.query(query=sql_table["get_user_content"],
                                         parameters=(
             as_user_id,
@@ -473,19 +618,51 @@ class AbstractDatabase:
             for_user_id,
             as_user_id,
             for_user_id,
-            page_size,
+            page_size + 1,
             page * page_size))
         content = []
-        for entry_type, *result in results:
+        for entry_type, *result in results[:page_size]:
             if entry_type == "challenge":
-                content.append(ChallengeHusk(*result[1:13]))
+                content.append(ChallengeHusk(*result[1:13], *result[15:18]))
             elif entry_type == "comment":
                 content.append(CommentHusk(
                     *self._transform_to_reply(result)[:9]))
             else:
                 content.append(SubmissionHusk(
                     *self._transform_to_reply(result)))
-        return content
+        return Page(content, len(results) > page_size)
+
+    # MARK: Ownership
+    def get_owner(self,
+                  target_type: Literal["challenge", "comment", "submission"],
+                  target_id: int) -> ContentOwner:
+        # Primary key lookup for permission checks, the full husks are not needed for them
+        key = (target_type, target_id)
+        if key not in self.owners:
+            results = self.connection.query(query=sql_table[f"get_{target_type}_owner"],
+                                            parameters=(target_id,), limit=1)
+            if not results:
+                raise {
+                    "challenge": ChallengeNotFoundException,
+                    "comment": CommentNotFoundException,
+                    "submission": SubmissionNotFoundException
+                }[target_type](target_id)
+            self.owners[key] = ContentOwner(*results[0])
+        return self.owners[key]
+
+    # MARK: Versions
+    # Change together with what the pages show (ChangeLog), see util/conditional.py
+
+    def get_latest_version(self) -> int:
+        return self._count("get_latest_version", ())
+
+    def get_challenge_version(self, challenge_id: int) -> int:
+        return self._count("get_challenge_version", (challenge_id,))
+
+    def get_user_version(self, user_id: int) -> Tuple[int, ...]:
+        [result] = self.connection.query(query=sql_table["get_user_version"],
+                                         parameters=(user_id,), limit=1)
+        return tuple(result)
 
     # MARK: Vote statistics
 
@@ -510,3 +687,22 @@ class AbstractDatabase:
             "comment": result[1],
             "submission": result[2]
         }
+
+
+user_cache = None
+user_cache_lock = Lock()
+
+
+@after_fork
+def forget_user_cache_lock():
+    global user_cache_lock  # pylint: disable=global-statement
+    user_cache_lock = Lock()
+
+
+def get_user_cache() -> Union[CoherentCache, SharedCache]:
+    global user_cache  # pylint: disable=global-statement
+    with user_cache_lock:
+        if user_cache is None:
+            cache_type = SharedCache if use_shared_cache else CoherentCache
+            user_cache = cache_type(get_change_tracker(), "users", user_cache_size)
+        return user_cache
@@ -0,0 +1,140 @@
+# Mark-and-sweep collection of unreferenced assets
+# Assets are referenced by profiles (image, banner) and submissions (script). Anything
+# else is garbage: replaced profile images, scripts of removed submissions and challenges.
+# The collector walks the Assets table in small id ranges with pauses in between,
+# and afterwards optionally gives the freed pages back with PRAGMA incremental_vacuum.
+# Only one process per database collects at a time (see util/lease.py).
+
+from sqlite3 import connect
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Tuple
+from database.params import (
+    asset_gc_grace,
+    asset_gc_interval,
+    asset_gc_pause,
+    asset_gc_scan_size,
+    asset_gc_vacuum_pages,
+    database_params
+)
+from database.sql import sql_table
+from database.writer import open_database
+from util.lease import FileLease, lease_path
+from util.metrics import metrics
+from util.prefork import after_fork
+
+
+class AssetCollector:
+    def __init__(self,
+                 database: str,
+                 interval: float,
+                 scan_size: int,
+                 pause: float,
+                 grace: int,
+                 vacuum_pages: int):
+        self.database = database
+        self.interval = interval
+        self.scan_size = scan_size
+        self.pause = pause
+        self.grace = grace
+        self.vacuum_pages = vacuum_pages
+        self.lease = FileLease(lease_path(database, "asset-gc"))
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="asset-gc", daemon=True)
+                self.thread.start()
+
+    def collect(self) -> Tuple[int, int]:  # One full pass, returns (assets, bytes) removed
+        removed, reclaimed = 0, 0
+        connection = open_database()
+        try:
+            [[last_id]] = connection.query(sql_table["get_max_asset_id"])
+            cursor = 0
+            while cursor < last_id:
+                orphans = connection.query(sql_table["get_orphaned_assets"],
+                                           (cursor, cursor + self.scan_size, time() - self.grace))
+                if orphans:
+                    connection.execute_batch([
+                        (sql_table["remove_orphaned_asset"], (asset_id,) * 4)
+                        for asset_id, _ in orphans])
+                    removed += len(orphans)
+                    reclaimed += sum(size for _, size in orphans)
+                cursor += self.scan_size
+                sleep(self.pause)
+        finally:
+            connection.close()
+
+        metrics.increment("asset_gc.passes")
+        metrics.increment("asset_gc.removed", removed)
+        metrics.increment("asset_gc.reclaimed_bytes", reclaimed)
+        return removed, reclaimed
+
+    def vacuum(self) -> int:  # Returns bytes given back to the filesystem
+        if not self.vacuum_pages:
+            return 0
+        connection = connect(self.database, timeout=30, isolation_level=None)
+        try:
+            # Only databases created with auto_vacuum = INCREMENTAL (see db/schema.sql)
+            [[mode]] = connection.execute("PRAGMA auto_vacuum").fetchall()
+            if mode != 2:
+                return 0
+            [[page_size]] = connection.execute("PRAGMA page_size").fetchall()
+            [[before]] = connection.execute("PRAGMA freelist_count").fetchall()
+
+            # execute() would only step the pragma once (freeing a single page),
+            # executescript() runs it to completion
+            connection.executescript(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)});")
+            [[after]] = connection.execute("PRAGMA freelist_count").fetchall()
+        finally:
+            connection.close()
+
+        vacuumed = (before - after) * page_size
+        metrics.increment("asset_gc.vacuumed_bytes", vacuumed)
+        return vacuumed
+
+    def enable_vacuum(self):
+        # Databases created before auto_vacuum was set need a full VACUUM once
+        # NOTE: Rewrites the whole database, run it while the app is not serving
+        connection = connect(self.database, timeout=30, isolation_level=None)
+        try:
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+
+    def _run(self):
+        while True:
+            try:
+                if self.lease.acquire():
+                    self.collect()
+                    self.vacuum()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                print("Asset collection failed:", err)
+            sleep(self.interval)
+
+
+collector = None
+collector_lock = Lock()
+
+
+@after_fork
+def forget_asset_collector():
+    global collector, collector_lock  # pylint: disable=global-statement
+    collector, collector_lock = None, Lock()
+
+
+def get_asset_collector() -> AssetCollector:  # The asset collector of this process
+    global collector  # pylint: disable=global-statement
+    with collector_lock:
+        if collector is None:
+            collector = AssetCollector(database_params[0],
+                                       asset_gc_interval,
+                                       asset_gc_scan_size,
+                                       asset_gc_pause,
+                                       asset_gc_grace,
+                                       asset_gc_vacuum_pages)
+        return collector
@@ -0,0 +1,70 @@
+# Awaitable database abstractions for ASGI serving (see asgi.py)
+# Reads run on a pool of reader threads, writes on a single writer thread
+# (which hands them to the process writer, when the write queue is enabled).
+# Every thread owns its own connection, as SQLite connections are bound to a thread.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import local
+from database.abstract import AbstractDatabase
+from database.writer import open_database
+
+# AbstractDatabase methods that write to the database
+write_methods = {
+    "create_user",
+    "edit_user",
+    "set_user_new_password_required",
+    "edit_profile",
+    "create_asset",
+    "create_asset_from_stream",
+    "create_asset_variant",
+    "remove_asset",
+    "edit_challenge",
+    "remove_challenge",
+    "create_challenge",
+    "check_reply_counters",
+    "vote_for",
+    "remove_vote_from",
+    "set_vote",
+    "create_comment",
+    "remove_comment",
+    "edit_comment",
+    "create_submission",
+    "remove_submission",
+    "edit_submission"
+}
+
+
+class AsyncDatabase:
+    def __init__(self, readers: int = 4):
+        self.local = local()
+        self.readers = ThreadPoolExecutor(max_workers=readers,
+                                          thread_name_prefix="db-reader",
+                                          initializer=self._open)
+        self.writer = ThreadPoolExecutor(max_workers=1,
+                                         thread_name_prefix="db-writer",
+                                         initializer=self._open)
+
+    def _open(self):  # Runs once in every reader and writer thread
+        self.local.connection = open_database()
+
+    def _call(self, name: str, *args, **kwargs):
+        # A new AbstractDatabase for every call, its caches (owners) live for one request
+        return getattr(AbstractDatabase(self.local.connection), name)(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        # Expose every AbstractDatabase method as an awaitable
+        if not callable(getattr(AbstractDatabase, name, None)) or name.startswith("_"):
+            raise AttributeError(name)
+
+        executor = self.writer if name in write_methods else self.readers
+
+        async def method(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, partial(self._call, name, *args, **kwargs))
+        return method
+
+    def close(self):
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
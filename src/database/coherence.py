@@ -0,0 +1,170 @@
+# Cache coherence between worker processes, without a shared cache service
+# Triggers record the last change of every entity in ChangeLog (entity, entity_id, version).
+# PRAGMA data_version tells cheaply whether anyone has committed since the last check,
+# only then are the new ChangeLog rows read and the cached entries depending on them dropped.
+
+from collections import OrderedDict
+from pathlib import Path
+from sqlite3 import connect
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from database.params import database_params
+from util.metrics import metrics
+from util.prefork import after_fork
+
+# ("challenge", 12) is one challenge, ("challenge", None) any change to any challenge
+Dependency = Tuple[str, Optional[int]]
+Change = Tuple[str, int, int]  # (entity, entity_id, version)
+
+
+def no_dependencies(_) -> List[Dependency]:
+    return []
+
+
+class CoherentCache:
+    def __init__(self, tracker: "ChangeTracker", name: str, max_entries: int = 1024):
+        self.tracker = tracker
+        self.name = name
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Hashable, Tuple[Any, List[Dependency]]]" = OrderedDict()
+        self.dependents: Dict[Dependency, Set[Hashable]] = {}
+        self.lock = Lock()
+        tracker.register(self)
+
+    def get_or_load(self,
+                    key: Hashable,
+                    load: Callable[[], Any],
+                    depends_on: Callable[[Any], Iterable[Dependency]] = no_dependencies) -> Any:
+        read_version = self.tracker.check()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                metrics.increment(f"cache.{self.name}.hits")
+                return self.entries[key][0]
+        metrics.increment(f"cache.{self.name}.misses")
+
+        value = load()
+
+        # Something committed while loading, the value may already be out of date
+        if self.tracker.check() != read_version:
+            return value
+        self._store(key, value, list(depends_on(value)))
+        return value
+
+    def _store(self, key: Hashable, value: Any, dependencies: List[Dependency]):
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (value, dependencies)
+            for dependency in dependencies:
+                self.dependents.setdefault(dependency, set()).add(key)
+            if len(self.entries) > self.max_entries:  # Least recently used goes first
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: Hashable):  # Called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for dependency in entry[1]:
+            keys = self.dependents.get(dependency)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[dependency]
+
+    def invalidate(self, changes: Iterable[Change]) -> int:
+        removed = 0
+        with self.lock:
+            for entity, entity_id, _ in changes:
+                for dependency in ((entity, entity_id), (entity, None)):
+                    for key in list(self.dependents.get(dependency, ())):
+                        self._remove(key)
+                        removed += 1
+        return removed
+
+    def catch_up(self, _version: int, _changes_since: Callable[[int], List[Change]]):
+        # Nothing kept from before the tracker connected can be checked anymore
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.dependents.clear()
+
+
+class ChangeTracker:
+    def __init__(self, database: str):
+        self.database = database
+        self.connection = None
+        self.data_version = None
+        self.version = 0  # Latest ChangeLog version seen
+        self.caches: list = []  # CoherentCache or SharedCache
+        self.lock = Lock()
+        after_fork(self._forget_connection)
+
+    def register(self, cache):
+        with self.lock:
+            self.caches.append(cache)
+            if self.connection is not None:
+                cache.catch_up(self.version, self._changes_since)
+
+    def _forget_connection(self):
+        self.connection = None
+        self.data_version = None
+        self.lock = Lock()
+
+    def _connect(self):
+        # Its own read only connection, so every commit shows up in data_version
+        self.connection = connect(Path(self.database).resolve().as_uri() + "?mode=ro", uri=True,
+                                  check_same_thread=False, isolation_level=None)
+        [self.data_version] = self.connection.execute("PRAGMA data_version").fetchone()
+        [self.version] = self.connection.execute(
+            "SELECT COALESCE(MAX(version), 0) FROM ChangeLog").fetchone()
+        for cache in self.caches:
+            cache.catch_up(self.version, self._changes_since)
+
+    def _changes_since(self, version: int) -> List[Change]:  # Called with the lock held
+        return self.connection.execute(
+            "SELECT entity, entity_id, version FROM ChangeLog WHERE version > ?",
+            (version,)).fetchall()
+
+    def check(self) -> int:  # Drops the cached entries that changed, returns the version
+        with self.lock:
+            if self.connection is None:
+                self._connect()
+                return self.version
+
+            [data_version] = self.connection.execute("PRAGMA data_version").fetchone()
+            if data_version == self.data_version:
+                return self.version
+            self.data_version = data_version
+
+            changes = self._changes_since(self.version)
+            if not changes:
+                return self.version
+
+            # Invalidated before the new version is published, so no request that sees
+            # the new version can still get an entry from before it
+            removed = sum(cache.invalidate(changes) for cache in self.caches)
+            self.version = max(version for _, _, version in changes)
+
+        metrics.increment("coherence.changes", len(changes))
+        metrics.increment("coherence.invalidations", removed)
+        return self.version
+
+
+change_tracker = None
+change_tracker_lock = Lock()
+
+
+@after_fork
+def forget_change_tracker_lock():
+    global change_tracker_lock  # pylint: disable=global-statement
+    change_tracker_lock = Lock()
+
+
+def get_change_tracker() -> ChangeTracker:  # The change tracker of this process
+    global change_tracker  # pylint: disable=global-statement
+    with change_tracker_lock:
+        if change_tracker is None:
+            change_tracker = ChangeTracker(database_params[0])
+        return change_tracker
@@ -1,24 +1,69 @@
 # SQLite3 database connection library for the first layer of abstraction and the basics
 
+import os
 from sqlite3 import Error, connect, Connection, Cursor
 from pathlib import Path
-from typing import Any, List, Optional, Tuple, Union
+from threading import Lock
+from typing import Any, BinaryIO, List, Optional, Set, Tuple, Union
 
+from database.migrations import migrate, migrations
 from database.types import DatabaseException
+from util.prefork import after_fork
+
+# Threads of this process create and migrate the database one at a time
+creation_lock = Lock()
+
+
+@after_fork
+def forget_creation_lock():
+    global creation_lock  # pylint: disable=global-statement
+    creation_lock = Lock()
+
+
+# Databases created or migrated by this process (inherited by forked workers)
+prepared_databases: Set[str] = set()
+
+# Bytes copied at a time when streaming into a BLOB
+blob_chunk_size = 64 * 1024
+
+
+def write_blob(connection: Connection, table: str, column: str, row_id: int, stream: BinaryIO):
+    # Fills a zeroblob() of the right size chunk by chunk, without the whole value in memory
+    if not hasattr(connection, "blobopen"):  # Python < 3.11
+        connection.execute(f"UPDATE {table} SET {column} = ? WHERE rowid = ?",
+                           (stream.read(), row_id))
+        return
+    with connection.blobopen(table, column, row_id) as blob:
+        for chunk in iter(lambda: stream.read(blob_chunk_size), b""):
+            blob.write(chunk)
+
+
+class WriteResult:  # Stands in for the cursor when writes go through a writer
+    __slots__ = ("lastrowid", "rowcount")
+
+    def __init__(self, lastrowid: Optional[int], rowcount: int):
+        self.lastrowid = lastrowid
+        self.rowcount = rowcount
+
+    def close(self):
+        pass
 
 
 class DatabaseConnection:
-    def __init__(self, database="./main.db", schema="./schema.sql", init="./init.sql"):
+    def __init__(self,
+                 database="./main.db",
+                 schema="./schema.sql",
+                 init="./init.sql",
+                 writer=None):
         self.database_filepath = database
         self.schema_filepath = schema
         self.init_filepath = init
         self.connection = None
 
-    # Open the database connection
-    def open(self):
-        if self.connection:
-            raise DatabaseException("Database already opened!")
+        # With a writer (database/writer.py), this connection only reads
+        self.writer = writer
 
+    def _prepare(self, database_file: Path):
         # Read schema
         schema_file = Path(self.schema_filepath)
         if not schema_file.exists():
@@ -30,17 +75,44 @@ class DatabaseConnection:
             raise FileNotFoundError("Init file not found.")
 
         # Open database and write schema, if it does not exist
-        database_file = Path(self.database_filepath)
-        if not database_file.exists():
-            schema = schema_file.read_text("utf-8")
-            self.connection = connect(database_file)
-            self.connection.executescript(schema)
+        with creation_lock:
+            if not database_file.exists():
+                # Built aside and moved in place, so nobody opens a half written database
+                temporary = database_file.with_name(f"{database_file.name}.{os.getpid()}.tmp")
+                temporary.unlink(missing_ok=True)  # Left over from a crash
+                schema = schema_file.read_text("utf-8")
+                connection = connect(temporary)
+                connection.executescript(schema)
 
-            # Do the db init too
-            init = init_file.read_text("utf-8")
-            self.connection.executescript(init)
+                # Do the db init too
+                init = init_file.read_text("utf-8")
+                connection.executescript(init)
 
-            self.connection.commit()
+                # Fresh databases already have the latest schema
+                connection.execute(f"PRAGMA user_version = {len(migrations)}")
+                connection.commit()
+                connection.close()
+                os.replace(temporary, database_file)
+            else:
+                # Bring older databases up to date (see database/migrations.py)
+                migrate(database_file)
+
+    # Open the database connection
+    def open(self):
+        if self.connection:
+            raise DatabaseException("Database already opened!")
+
+        # Create or migrate the database once per process, later opens skip the file checks
+        database_file = Path(self.database_filepath)
+        key = os.path.abspath(self.database_filepath)
+        if key not in prepared_databases:
+            self._prepare(database_file)
+            prepared_databases.add(key)
+
+        # Reads never take the write lock, writes are queued to the writer
+        if self.writer:
+            self.connection = connect(database_file.resolve().as_uri() + "?mode=ro", uri=True)
+            self.connection.execute("PRAGMA query_only = ON")
         else:
             self.connection = connect(database_file)
 
@@ -55,7 +127,14 @@ class DatabaseConnection:
         self.connection.close()
 
     # Execute a command against the database
-    def execute(self, query: str, parameters: Union[Tuple[Any], dict]) -> Tuple[Connection, Cursor]:
+    # With raise_errors the error is raised after rollback, e.g. for jobs that retry
+    def execute(self,
+                query: str,
+                parameters: Union[Tuple[Any], dict],
+                raise_errors: bool = False) -> Tuple[Connection, Union[Cursor, WriteResult]]:
+        if self.writer:
+            return self.connection, self._execute_queued(query, parameters, raise_errors)
+
         try:
             if not self.connection:
                 raise DatabaseException("Database not open!")
@@ -66,8 +145,83 @@ class DatabaseConnection:
             print("Database execution error:", err, "For:",
                   query, "With params:", parameters)
             self.connection.rollback()
+            if raise_errors:
+                cursor.close()
+                raise
         return self.connection, cursor
 
+    def _execute_queued(self,
+                        query: str,
+                        parameters: Union[Tuple[Any], dict],
+                        raise_errors: bool) -> WriteResult:
+        if not self.connection:
+            raise DatabaseException("Database not open!")
+        try:
+            return self.writer.execute(query, parameters)
+        except (Error, TimeoutError) as err:
+            # After a timeout the write is still queued, it may be committed later
+            print("Database execution error:", repr(err), "For:",
+                  query, "With params:", parameters)
+            if raise_errors:
+                raise
+            return WriteResult(None, 0)
+
+    # Execute an insert with a zeroblob(size) parameter and stream its value into place
+    def execute_blob(self,
+                     query: str,
+                     parameters: Union[Tuple[Any], dict],
+                     table: str,
+                     column: str,
+                     stream: BinaryIO) -> Tuple[Connection, Union[Cursor, WriteResult]]:
+        if not self.connection:
+            raise DatabaseException("Database not open!")
+
+        def fill(connection, cursor):
+            write_blob(connection, table, column, cursor.lastrowid, stream)
+
+        if self.writer:
+            try:
+                return self.connection, self.writer.execute_with(query, parameters, fill)
+            except (Error, OSError) as err:  # TimeoutError is an OSError
+                print("Database blob write error:", repr(err), "For:", query)
+                return self.connection, WriteResult(None, 0)
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query, parameters)
+            fill(self.connection, cursor)
+            self.connection.commit()
+        except (Error, OSError) as err:
+            print("Database blob write error:", err, "For:", query)
+            self.connection.rollback()
+            return self.connection, WriteResult(None, 0)
+        return self.connection, cursor
+
+    # Execute many commands against the database in a single transaction
+    def execute_batch(self, commands: List[Tuple[str, Union[Tuple[Any], dict]]]):
+        if not self.connection:
+            raise DatabaseException("Database not open!")
+        try:
+            if self.writer:
+                self.writer.execute_many(commands)
+            else:
+                cursor = self.connection.cursor()
+                for query, parameters in commands:
+                    cursor.execute(query, parameters)
+                self.connection.commit()
+                cursor.close()
+        except TimeoutError as err:
+            # Still queued to the writer and may be committed later, so it is not run again
+            print("Database batch error:", repr(err), "Not retried.")
+        except Error as err:
+            # Fall back to one by one, so a single bad command does not drop the rest
+            print("Database batch error:", err, "Retrying commands one by one.")
+            if self.connection.in_transaction:
+                self.connection.rollback()
+            for query, parameters in commands:
+                _, cursor = self.execute(query, parameters)
+                cursor.close()
+
     # Query the database
     def query(self,
               query=str,
@@ -0,0 +1,539 @@
+# Schema changes for databases created with an older schema.sql
+# Fresh databases get the full schema.sql and start at the latest version.
+# Migration n (1-based) brings the database to PRAGMA user_version = n.
+# A step is an SQL statement, or a function given the connection for work SQL can not do.
+# NOTE: Keep schema.sql up to date with every migration added here!
+# `flask check-migrations` compares the two, starting from db/baseline.sql.
+
+from pathlib import Path
+from sqlite3 import Connection, connect
+from typing import Callable, Dict, List, Set, Tuple, Union
+from database.previews import fill_body_previews
+
+migrations: List[List[Union[str, Callable[[Connection], None]]]] = [
+    # 1: Precomputed ranking scores for the challenge feed
+    [
+        """
+        CREATE TABLE ChallengeScores (
+            challenge_id INTEGER PRIMARY KEY REFERENCES Challenges(id) ON DELETE CASCADE,
+            category_id INTEGER NOT NULL,
+            created INTEGER NOT NULL,
+            votes INTEGER NOT NULL DEFAULT 0,
+            replies INTEGER NOT NULL DEFAULT 0,
+            hot REAL NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX challenge_scores_hot ON ChallengeScores(hot DESC)",
+        "CREATE INDEX challenge_scores_category_hot ON ChallengeScores(category_id, hot DESC)",
+        "CREATE INDEX challenge_scores_votes ON ChallengeScores(votes DESC, created DESC)",
+        """
+        CREATE INDEX challenge_scores_category_votes
+        ON ChallengeScores(category_id, votes DESC, created DESC)
+        """,
+        "CREATE INDEX challenge_scores_created ON ChallengeScores(created)",
+        "CREATE TABLE ChallengeScoresDirty (challenge_id INTEGER PRIMARY KEY)",
+        "CREATE INDEX comments_challenge_id ON Comments(challenge_id)",
+        "CREATE INDEX submissions_challenge_id ON Submissions(challenge_id)",
+        """
+        CREATE TRIGGER challenge_scores_challenge_insert AFTER INSERT ON Challenges
+        BEGIN
+            INSERT INTO ChallengeScores (challenge_id, category_id, created, hot)
+            VALUES (NEW.id, NEW.category_id, NEW.created, NEW.created / 45000.0);
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_scores_challenge_category AFTER UPDATE OF category_id ON Challenges
+        BEGIN
+            UPDATE ChallengeScores SET category_id = NEW.category_id
+            WHERE challenge_id = NEW.id;
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_scores_vote_insert AFTER INSERT ON Votes
+        WHEN NEW.challenge_id IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (NEW.challenge_id);
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_scores_vote_delete AFTER DELETE ON Votes
+        WHEN OLD.challenge_id IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (OLD.challenge_id);
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_scores_comment_insert AFTER INSERT ON Comments
+        BEGIN
+            INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (NEW.challenge_id);
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_scores_comment_delete AFTER DELETE ON Comments
+        BEGIN
+            INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (OLD.challenge_id);
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_scores_submission_insert AFTER INSERT ON Submissions
+        BEGIN
+            INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (NEW.challenge_id);
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_scores_submission_delete AFTER DELETE ON Submissions
+        BEGIN
+            INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (OLD.challenge_id);
+        END
+        """,
+        """
+        INSERT INTO ChallengeScores (challenge_id, category_id, created, hot)
+        SELECT id, category_id, created, created / 45000.0 FROM Challenges
+        """,
+        "INSERT INTO ChallengeScoresDirty SELECT id FROM Challenges"
+    ],
+    # 2: Reply counters and last activity maintained on the challenge rows
+    [
+        "ALTER TABLE Challenges ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE Challenges ADD COLUMN submission_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE Challenges ADD COLUMN last_activity INTEGER NOT NULL DEFAULT 0",
+        """
+        CREATE TRIGGER challenge_activity_challenge_insert AFTER INSERT ON Challenges
+        BEGIN
+            UPDATE Challenges SET last_activity = NEW.created WHERE id = NEW.id;
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_activity_comment_insert AFTER INSERT ON Comments
+        BEGIN
+            UPDATE Challenges SET
+                comment_count = comment_count + 1,
+                last_activity = MAX(last_activity, NEW.created)
+            WHERE id = NEW.challenge_id;
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_activity_comment_delete AFTER DELETE ON Comments
+        BEGIN
+            UPDATE Challenges SET
+                comment_count = comment_count - 1,
+                last_activity = MAX(
+                    Challenges.created,
+                    COALESCE((SELECT MAX(Comments.created) FROM Comments
+                              WHERE Comments.challenge_id = OLD.challenge_id), 0),
+                    COALESCE((SELECT MAX(Submissions.created) FROM Submissions
+                              WHERE Submissions.challenge_id = OLD.challenge_id), 0))
+            WHERE id = OLD.challenge_id;
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_activity_submission_insert AFTER INSERT ON Submissions
+        BEGIN
+            UPDATE Challenges SET
+                submission_count = submission_count + 1,
+                last_activity = MAX(last_activity, NEW.created)
+            WHERE id = NEW.challenge_id;
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_activity_submission_delete AFTER DELETE ON Submissions
+        BEGIN
+            UPDATE Challenges SET
+                submission_count = submission_count - 1,
+                last_activity = MAX(
+                    Challenges.created,
+                    COALESCE((SELECT MAX(Comments.created) FROM Comments
+                              WHERE Comments.challenge_id = OLD.challenge_id), 0),
+                    COALESCE((SELECT MAX(Submissions.created) FROM Submissions
+                              WHERE Submissions.challenge_id = OLD.challenge_id), 0))
+            WHERE id = OLD.challenge_id;
+        END
+        """,
+        """
+        UPDATE Challenges SET
+            comment_count = (SELECT COUNT(*) FROM Comments
+                             WHERE Comments.challenge_id = Challenges.id),
+            submission_count = (SELECT COUNT(*) FROM Submissions
+                                WHERE Submissions.challenge_id = Challenges.id),
+            last_activity = MAX(
+                Challenges.created,
+                COALESCE((SELECT MAX(Comments.created) FROM Comments
+                          WHERE Comments.challenge_id = Challenges.id), 0),
+                COALESCE((SELECT MAX(Submissions.created) FROM Submissions
+                          WHERE Submissions.challenge_id = Challenges.id), 0))
+        """
+    ],
+    # 3: Challenge counts per category for page counts
+    [
+        """
+        CREATE TABLE ChallengeCounts (
+            category_id INTEGER PRIMARY KEY,
+            challenges INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TRIGGER challenge_counts_insert AFTER INSERT ON Challenges
+        BEGIN
+            INSERT INTO ChallengeCounts (category_id, challenges) VALUES (NEW.category_id, 1)
+            ON CONFLICT (category_id) DO UPDATE SET challenges = challenges + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_counts_delete AFTER DELETE ON Challenges
+        BEGIN
+            UPDATE ChallengeCounts SET challenges = challenges - 1
+            WHERE category_id = OLD.category_id;
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_counts_category AFTER UPDATE OF category_id ON Challenges
+        WHEN NEW.category_id != OLD.category_id
+        BEGIN
+            UPDATE ChallengeCounts SET challenges = challenges - 1
+            WHERE category_id = OLD.category_id;
+            INSERT INTO ChallengeCounts (category_id, challenges) VALUES (NEW.category_id, 1)
+            ON CONFLICT (category_id) DO UPDATE SET challenges = challenges + 1;
+        END
+        """,
+        """
+        INSERT INTO ChallengeCounts (category_id, challenges)
+        SELECT category_id, COUNT(*) FROM Challenges GROUP BY category_id
+        """
+    ],
+    # 4: Asset garbage collection (see database/asset_gc.py)
+    # Submissions are rebuilt, so deleting an asset no longer deletes its submission.
+    # Legacy rename keeps triggers of other tables pointing at "Submissions".
+    [
+        "ALTER TABLE Assets ADD COLUMN created INTEGER NOT NULL DEFAULT 0",
+        """
+        CREATE INDEX profiles_image_asset_id ON Profiles(image_asset_id)
+        WHERE image_asset_id IS NOT NULL
+        """,
+        """
+        CREATE INDEX profiles_banner_asset_id ON Profiles(banner_asset_id)
+        WHERE banner_asset_id IS NOT NULL
+        """,
+        "PRAGMA legacy_alter_table = ON",
+        """
+        CREATE TABLE Submissions_new (
+            id INTEGER PRIMARY KEY,
+            created INTEGER NOT NULL,
+            challenge_id INTEGER NOT NULL REFERENCES Challenges(id) ON DELETE CASCADE,
+            title TEXT NOT NULL,
+            body TEXT NOT NULL,
+            solution_asset_id INTEGER NOT NULL REFERENCES Assets(id),
+            author_id INTEGER NOT NULL
+        )
+        """,
+        """
+        INSERT INTO Submissions_new
+        SELECT id, created, challenge_id, title, body, solution_asset_id, author_id
+        FROM Submissions
+        """,
+        "DROP TABLE Submissions",
+        "ALTER TABLE Submissions_new RENAME TO Submissions",
+        "PRAGMA legacy_alter_table = OFF",
+        "CREATE INDEX submission_id_to_author_id ON Submissions(author_id)",
+        "CREATE INDEX submissions_challenge_id ON Submissions(challenge_id)",
+        "CREATE INDEX submissions_solution_asset_id ON Submissions(solution_asset_id)",
+        """
+        CREATE TRIGGER challenge_scores_submission_insert AFTER INSERT ON Submissions
+        BEGIN
+            INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (NEW.challenge_id);
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_scores_submission_delete AFTER DELETE ON Submissions
+        BEGIN
+            INSERT OR IGNORE INTO ChallengeScoresDirty VALUES (OLD.challenge_id);
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_activity_submission_insert AFTER INSERT ON Submissions
+        BEGIN
+            UPDATE Challenges SET
+                submission_count = submission_count + 1,
+                last_activity = MAX(last_activity, NEW.created)
+            WHERE id = NEW.challenge_id;
+        END
+        """,
+        """
+        CREATE TRIGGER challenge_activity_submission_delete AFTER DELETE ON Submissions
+        BEGIN
+            UPDATE Challenges SET
+                submission_count = submission_count - 1,
+                last_activity = MAX(
+                    Challenges.created,
+                    COALESCE((SELECT MAX(Comments.created) FROM Comments
+                              WHERE Comments.challenge_id = OLD.challenge_id), 0),
+                    COALESCE((SELECT MAX(Submissions.created) FROM Submissions
+                              WHERE Submissions.challenge_id = OLD.challenge_id), 0))
+            WHERE id = OLD.challenge_id;
+        END
+        """
+    ],
+    # 5: Content type sniffed at upload (see util/uploads.py)
+    # Rebuilt rather than altered, so that ids are never reused (AUTOINCREMENT), as /a/<id>
+    # responses are cached for good. Foreign keys are off on this connection, the references
+    # to Assets stay as they are.
+    [
+        """
+        CREATE TABLE AssetsNew (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            value BLOB NOT NULL,
+            created INTEGER NOT NULL DEFAULT 0,
+            content_type TEXT
+        )
+        """,
+        """
+        INSERT INTO AssetsNew (id, filename, value, created)
+        SELECT id, filename, value, created FROM Assets
+        """,
+        "DROP TABLE Assets",
+        "ALTER TABLE AssetsNew RENAME TO Assets"
+    ],
+    # 6: Downscaled image variants (see util/uploads.py)
+    [
+        """
+        CREATE TABLE AssetVariants (
+            asset_id INTEGER NOT NULL REFERENCES Assets(id) ON DELETE CASCADE,
+            variant TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            value BLOB NOT NULL,
+            PRIMARY KEY (asset_id, variant)
+        )
+        """
+    ],
+    # 7: Change log for cache invalidation across workers (see database/coherence.py)
+    [
+        """
+        CREATE TABLE ChangeLog (
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (entity, entity_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE INDEX change_log_version ON ChangeLog(version)
+        """,
+        """
+        CREATE TRIGGER change_log_user_update AFTER UPDATE ON Users
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('user', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_user_delete AFTER DELETE ON Users
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('user', OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_profile_update AFTER UPDATE ON Profiles
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('user', NEW.user_id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_challenge_insert AFTER INSERT ON Challenges
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('challenge', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_challenge_update AFTER UPDATE ON Challenges
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('challenge', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_challenge_delete AFTER DELETE ON Challenges
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('challenge', OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_comment_insert AFTER INSERT ON Comments
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('comment', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_comment_update AFTER UPDATE ON Comments
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('comment', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_comment_delete AFTER DELETE ON Comments
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('comment', OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_submission_insert AFTER INSERT ON Submissions
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('submission', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_submission_update AFTER UPDATE ON Submissions
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('submission', NEW.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_submission_delete AFTER DELETE ON Submissions
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES ('submission', OLD.id, (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_vote_insert AFTER INSERT ON Votes
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES (CASE WHEN NEW.challenge_id IS NOT NULL THEN 'challenge'
+                         WHEN NEW.comment_id IS NOT NULL THEN 'comment'
+                         ELSE 'submission' END,
+                    COALESCE(NEW.challenge_id, NEW.comment_id, NEW.submission_id),
+                    (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """,
+        """
+        CREATE TRIGGER change_log_vote_delete AFTER DELETE ON Votes
+        BEGIN
+            INSERT INTO ChangeLog (entity, entity_id, version)
+            VALUES (CASE WHEN OLD.challenge_id IS NOT NULL THEN 'challenge'
+                         WHEN OLD.comment_id IS NOT NULL THEN 'comment'
+                         ELSE 'submission' END,
+                    COALESCE(OLD.challenge_id, OLD.comment_id, OLD.submission_id),
+                    (SELECT COALESCE(MAX(version), 0) + 1 FROM ChangeLog))
+            ON CONFLICT (entity, entity_id) DO UPDATE SET version = excluded.version;
+        END
+        """
+    ],
+    # 8: Shortened challenge bodies for feed rows (see database/previews.py)
+    [
+        "ALTER TABLE Challenges ADD COLUMN body_preview TEXT",
+        fill_body_previews
+    ]
+]
+
+# Databases already migrated by this process
+migrated_databases: Set[str] = set()
+
+
+def _run_migration(connection: Connection, number: int):
+    for statement in migrations[number]:
+        if callable(statement):
+            statement(connection)
+        else:
+            connection.execute(statement)
+
+
+def migrate(database_file: Path):
+    key = str(database_file.resolve())
+    if key in migrated_databases:
+        return
+
+    connection = connect(database_file, isolation_level=None)
+    try:
+        [version] = connection.execute("PRAGMA user_version").fetchone()
+        if version < len(migrations):
+            # Lock first and check again, another worker may have just migrated
+            connection.execute("BEGIN IMMEDIATE")
+            [version] = connection.execute("PRAGMA user_version").fetchone()
+            for number in range(version, len(migrations)):
+                _run_migration(connection, number)
+                print(f"Database migrated to version {number + 1}.")
+            connection.execute(f"PRAGMA user_version = {len(migrations)}")
+            connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+    migrated_databases.add(key)
+
+
+def _describe_schema(connection: Connection) -> Dict[Tuple[str, str], tuple]:
+    # What a database is made of, written the same way however it got there
+    description = {}
+    for kind, name, table, sql in connection.execute("""
+        SELECT type, name, tbl_name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'
+    """):
+        if kind == "table":
+            columns = connection.execute("""
+                SELECT name, type, "notnull", dflt_value, pk, hidden FROM pragma_table_xinfo(?)
+            """, (name,)).fetchall()
+            description[kind, name] = ([column[0] for column in columns],
+                                       "AUTOINCREMENT" in sql.upper())
+            for column in columns:
+                description["column", f"{name}.{column[0]}"] = column[1:]
+            description["foreign keys of", name] = sorted(connection.execute("""
+                SELECT "table", "from", "to", on_update, on_delete
+                FROM pragma_foreign_key_list(?)
+            """, (name,)).fetchall())
+        elif kind == "index":
+            description[kind, name] = (
+                table,
+                connection.execute("SELECT name FROM pragma_index_xinfo(?) WHERE key",
+                                   (name,)).fetchall(),
+                " ".join((sql or "").split()))
+        else:  # Triggers and views
+            description[kind, name] = (table, " ".join(sql.split()))
+    return description
+
+
+def check_migrations(schema_file: Path, baseline_file: Path) -> List[str]:
+    # Differences between a baseline database brought up to date by the migrations
+    # and a fresh database from schema.sql, an empty list when they match
+    migrated = connect(":memory:", isolation_level=None)
+    fresh = connect(":memory:")
+    try:
+        migrated.executescript(baseline_file.read_text("utf-8"))
+        for number in range(len(migrations)):
+            _run_migration(migrated, number)
+        fresh.executescript(schema_file.read_text("utf-8"))
+        migrated_schema = _describe_schema(migrated)
+        fresh_schema = _describe_schema(fresh)
+    finally:
+        migrated.close()
+        fresh.close()
+
+    differences = []
+    for kind, name in sorted(migrated_schema.keys() | fresh_schema.keys()):
+        if (kind, name) not in fresh_schema:
+            differences.append(f"{kind} {name} is only made by the migrations")
+        elif (kind, name) not in migrated_schema:
+            differences.append(f"{kind} {name} is only in schema.sql")
+        elif migrated_schema[kind, name] != fresh_schema[kind, name]:
+            differences.append(f"{kind} {name} differs: "
+                               f"{migrated_schema[kind, name]} (migrated) "
+                               f"!= {fresh_schema[kind, name]} (schema.sql)")
+    return differences
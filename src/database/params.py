@@ -1,2 +1,31 @@
 # Configuration for database library
 database_params = ("./main.db", "./db/schema.sql", "./db/init.sql")
+baseline_schema_filepath = "./db/baseline.sql"  # Schema before the first migration
+
+# Queue all writes of a process to a single writer connection (see database/writer.py)
+use_write_queue = True
+write_batch_size = 64
+
+# Where GET requests read from: "primary" (main.db) or "snapshot" (a periodic copy of it)
+# After a user's own writes, their reads use the primary for read_your_writes_window seconds
+read_consistency = "primary"
+snapshot_filepath = "./main.snapshot.db"
+snapshot_interval = 5
+read_your_writes_window = 30
+
+# Precomputed challenge ranking (see database/ranking.py)
+ranking_refresh_interval = 10
+ranking_batch_size = 500
+
+# Unreferenced asset collection (see database/asset_gc.py)
+asset_gc_interval = 15 * 60  # Seconds between full passes
+asset_gc_scan_size = 1000  # Asset ids checked per step
+asset_gc_pause = 0.1  # Seconds between steps, keeps the writer free for requests
+asset_gc_grace = 60 * 60  # New assets are left alone, they may be about to be referenced
+asset_gc_vacuum_pages = 1000  # Pages given back to the filesystem per pass, 0 to disable
+
+# Cache shared by the worker processes of a node (see database/shared_cache.py)
+use_shared_cache = True
+shared_cache_filepath = "./main.cache.db"
+shared_cache_mmap_size = 64 * 1024 * 1024
+shared_cache_max_entry_size = 256 * 1024  # Larger values are not shared, only returned
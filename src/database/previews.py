@@ -0,0 +1,30 @@
+# Shortened challenge bodies for feed rows, stored in Challenges.body_preview
+# Also used by migration 8, so this module imports nothing from the database package.
+
+from typing import Optional
+
+preview_length = 300  # Feed rows show this much of a challenge body
+preview_lines = 8
+
+
+def make_body_preview(body: str) -> Optional[str]:
+    # None when the whole body fits, feed rows then show the body itself
+    # Trailing whitespace is not shown anyway, so it does not make a body too long
+    preview = "\n".join(body.split("\n")[:preview_lines])[:preview_length].rstrip()
+    return None if preview == body.rstrip() else preview + "…"
+
+
+def fill_body_previews(connection, batch_size: int = 500):
+    # Previews of existing challenges, in id order a batch at a time
+    # Starts below the smallest id, db/init.sql has a challenge with id 0
+    [[last_id]] = connection.execute("SELECT MIN(id) - 1 FROM Challenges").fetchall()
+    while last_id is not None:
+        rows = connection.execute(
+            "SELECT id, body FROM Challenges WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size)).fetchall()
+        if not rows:
+            return
+        connection.executemany(
+            "UPDATE Challenges SET body_preview = ? WHERE id = ?",
+            [(make_body_preview(body), challenge_id) for challenge_id, body in rows])
+        last_id = rows[-1][0]
@@ -0,0 +1,103 @@
+# Precomputed ranking scores for the challenge feed
+# Triggers mark challenges with new votes, comments or submissions as dirty
+# (see db/schema.sql), and a background thread recomputes only those scores.
+# The time decay is part of the score itself: newer challenges start higher,
+# so old scores never have to be recomputed just because time has passed.
+# Only one process per database refreshes at a time (see util/lease.py).
+
+from math import log10
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from database.params import database_params, ranking_batch_size, ranking_refresh_interval
+from database.sql import sql_table
+from database.writer import open_database
+from util.lease import FileLease, lease_path
+from util.metrics import metrics
+from util.prefork import after_fork
+
+# Seconds of age worth one order of magnitude of activity (12.5 hours)
+hot_decay = 45000
+
+
+def hot_score(votes: int, replies: int, created: int) -> float:
+    # A reply counts as half a vote
+    return log10(max(votes + replies / 2, 1)) + created / hot_decay
+
+
+class ScoreRefresher:
+    def __init__(self, database: str, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lease = FileLease(lease_path(database, "challenge-scores"))
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="challenge-scores", daemon=True)
+                self.thread.start()
+
+    def refresh(self) -> int:  # Returns the amount of dirty challenges handled
+        connection = open_database()
+        try:
+            dirty = connection.query(sql_table["get_dirty_challenge_scores"],
+                                     (self.batch_size,))
+            if not dirty:
+                return 0
+
+            # Cleared first, so activity from now on marks the challenge dirty again
+            start = perf_counter()
+            connection.execute_batch([(sql_table["clear_dirty_challenge_score"], (challenge_id,))
+                                      for [challenge_id] in dirty])
+
+            commands = []
+            for [challenge_id] in dirty:
+                # Removed challenges lose their score row through the foreign key
+                for _, category_id, created, votes, replies in connection.query(
+                        sql_table["get_challenge_activity"], (challenge_id,)):
+                    commands.append((sql_table["set_challenge_score"], (
+                        challenge_id,
+                        category_id,
+                        created,
+                        votes,
+                        replies,
+                        hot_score(votes, replies, created))))
+            connection.execute_batch(commands)
+        finally:
+            connection.close()
+
+        metrics.increment("challenge_scores.refreshed", len(commands))
+        metrics.observe("challenge_scores.refresh_seconds", perf_counter() - start)
+        return len(dirty)
+
+    def _run(self):
+        while True:
+            try:
+                # Keep going while there is a backlog
+                while self.lease.acquire() and self.refresh() >= self.batch_size:
+                    pass
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                print("Challenge score refresh failed:", err)
+            sleep(self.interval)
+
+
+score_refresher = None
+score_refresher_lock = Lock()
+
+
+@after_fork
+def forget_score_refresher():
+    global score_refresher, score_refresher_lock  # pylint: disable=global-statement
+    score_refresher, score_refresher_lock = None, Lock()
+
+
+def get_score_refresher() -> ScoreRefresher:  # The score refresher of this process
+    global score_refresher  # pylint: disable=global-statement
+    with score_refresher_lock:
+        if score_refresher is None:
+            score_refresher = ScoreRefresher(database_params[0],
+                                             ranking_refresh_interval,
+                                             ranking_batch_size)
+            score_refresher.start()
+        return score_refresher
@@ -0,0 +1,294 @@
+# Cache shared by all worker processes of a node
+# Entries live in a separate SQLite database that every worker maps into memory (mmap_size),
+# so a value loaded by one worker is a hit in all the others and kept only once.
+# Same interface as CoherentCache (database/coherence.py), and invalidated the same way:
+# each worker's ChangeTracker deletes the entries depending on what changed.
+# Values are stored as JSON, the file is not trusted to hold anything that runs code on load.
+
+from json import dumps, loads
+from sqlite3 import Error, connect
+from threading import Lock
+from time import time
+from traceback import print_exception
+from typing import Any, Callable, Hashable, Iterable, List, Optional
+from database.coherence import Change, ChangeTracker, Dependency, no_dependencies
+from database.params import (
+    shared_cache_filepath,
+    shared_cache_max_entry_size,
+    shared_cache_mmap_size
+)
+from util.metrics import metrics
+from util.prefork import after_fork
+
+any_id = -1  # Stored in place of None, ("challenge", None) depends on every challenge
+touch_interval = 10  # Seconds between last_used updates of an entry, hits are reads only
+missing = object()
+
+schema = """
+CREATE TABLE IF NOT EXISTS CacheEntries (
+    cache TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    expires REAL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (cache, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_entries_last_used ON CacheEntries(cache, last_used);
+
+CREATE TABLE IF NOT EXISTS CacheDependencies (
+    cache TEXT NOT NULL,
+    key TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    entity_id INTEGER NOT NULL,
+    PRIMARY KEY (cache, key, entity, entity_id),
+    FOREIGN KEY (cache, key) REFERENCES CacheEntries(cache, key) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_dependencies_entity
+    ON CacheDependencies(entity, entity_id);
+
+-- Latest invalidated version of every entity, so a value loaded before a change
+-- is not stored after another worker has already invalidated it
+CREATE TABLE IF NOT EXISTS CacheInvalidations (
+    entity TEXT NOT NULL,
+    entity_id INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (entity, entity_id)
+) WITHOUT ROWID;
+
+-- ChangeLog version each cache has been invalidated up to
+CREATE TABLE IF NOT EXISTS CacheVersions (
+    cache TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class SharedCache:
+    def __init__(self,
+                 tracker: ChangeTracker,
+                 name: str,
+                 max_entries: int = 1024,
+                 ttl: Optional[float] = None,
+                 max_entry_size: int = shared_cache_max_entry_size,
+                 filepath: str = shared_cache_filepath):
+        self.tracker = tracker
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_entry_size = max_entry_size
+        self.filepath = filepath
+        self.connection = None
+        self.lock = Lock()
+        after_fork(self._forget_connection)
+        tracker.register(self)
+
+    def _forget_connection(self):
+        self.connection = None
+        self.lock = Lock()
+
+    def _connect(self):  # Called with the lock held
+        if self.connection is None:
+            # It is only a cache: nothing is synced to disk, a lost write is a miss later
+            connection = connect(self.filepath, timeout=5, check_same_thread=False,
+                                 isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute(f"PRAGMA mmap_size = {int(shared_cache_mmap_size)}")
+            connection.execute("PRAGMA foreign_keys = ON")
+            connection.executescript(schema)
+            self.connection = connection
+        return self.connection
+
+    def _transaction(self, body: Callable[[Any], Any]) -> Any:  # Called with the lock held
+        # BEGIN IMMEDIATE takes the write lock up front, so the body reads and writes atomically
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = body(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    def _read(self, connection, key: str, now: float) -> Any:
+        row = connection.execute(
+            "SELECT value, expires, last_used FROM CacheEntries WHERE cache = ? AND key = ?",
+            (self.name, key)).fetchone()
+        if row is None:
+            return missing
+        value, expires, last_used = row
+        if expires is not None and expires <= now:
+            return missing
+        if now - last_used > touch_interval:  # Approximate LRU, most hits write nothing
+            connection.execute(
+                "UPDATE CacheEntries SET last_used = ? WHERE cache = ? AND key = ?",
+                (now, self.name, key))
+        try:
+            return loads(value)
+        except ValueError:  # Written in another format, e.g. by an older version
+            return missing
+
+    def _write(self, connection, key: str, data: bytes, now: float,
+               dependencies: List[Dependency]):
+        expires = now + self.ttl if self.ttl is not None else None
+        connection.execute("DELETE FROM CacheEntries WHERE cache = ? AND key = ?",
+                           (self.name, key))
+        connection.execute("INSERT INTO CacheEntries VALUES (?, ?, ?, ?, ?)",
+                           (self.name, key, data, expires, now))
+        connection.executemany(
+            "INSERT OR IGNORE INTO CacheDependencies VALUES (?, ?, ?, ?)",
+            [(self.name, key, entity, any_id if entity_id is None else entity_id)
+             for entity, entity_id in dependencies])
+
+        # Expired entries go first, then the least recently used ones over the limit
+        connection.execute(
+            "DELETE FROM CacheEntries WHERE cache = ? AND expires <= ?", (self.name, now))
+        connection.execute("""
+            DELETE FROM CacheEntries WHERE cache = ?1 AND key IN (
+                SELECT key FROM CacheEntries WHERE cache = ?1 ORDER BY last_used
+                LIMIT MAX(0, (SELECT COUNT(*) FROM CacheEntries WHERE cache = ?1) - ?2))
+        """, (self.name, self.max_entries))
+
+    def _invalidated_after(self, connection, dependencies: List[Dependency],
+                           version: int) -> bool:
+        for entity, entity_id in dependencies:
+            if entity_id is None:
+                row = connection.execute(
+                    "SELECT MAX(version) FROM CacheInvalidations WHERE entity = ?",
+                    (entity,)).fetchone()
+            else:
+                row = connection.execute(
+                    "SELECT version FROM CacheInvalidations WHERE entity = ? AND entity_id = ?",
+                    (entity, entity_id)).fetchone()
+            if row is not None and row[0] is not None and row[0] > version:
+                return True
+        return False
+
+    def _failed(self, e: Error):
+        # A broken or busy cache must not break the request, it only costs a load
+        metrics.increment(f"cache.{self.name}.errors")
+        print(f"Shared cache {self.name} failed")
+        print_exception(e)
+
+    def get_or_load(self,
+                    key: Hashable,
+                    load: Callable[[], Any],
+                    depends_on: Callable[[Any], Iterable[Dependency]] = no_dependencies) -> Any:
+        read_version = self.tracker.check()
+        stored_key = repr(key)
+        now = time()
+        try:
+            with self.lock:
+                value = self._read(self._connect(), stored_key, now)
+        except Error as e:
+            self._failed(e)
+            value = missing
+        if value is not missing:
+            metrics.increment(f"cache.{self.name}.hits")
+            return value
+        metrics.increment(f"cache.{self.name}.misses")
+
+        value = load()
+
+        # Something committed while loading, the value may already be out of date
+        if self.tracker.check() != read_version:
+            return value
+        data = dumps(value).encode()
+        if len(data) > self.max_entry_size:
+            metrics.increment(f"cache.{self.name}.too_large")
+            return value
+
+        dependencies = list(depends_on(value))
+
+        def store(connection):
+            if not self._invalidated_after(connection, dependencies, read_version):
+                self._write(connection, stored_key, data, now, dependencies)
+
+        try:
+            with self.lock:
+                self._transaction(store)
+        except Error as e:
+            self._failed(e)
+        return value
+
+    def update(self, key: Hashable, change: Callable[[Any], Any], default: Any = None) -> Any:
+        # Atomic read-modify-write across all workers, returns the new value
+        stored_key = repr(key)
+        now = time()
+
+        def read_and_write(connection):
+            value = self._read(connection, stored_key, now)
+            value = change(default if value is missing else value)
+            self._write(connection, stored_key, dumps(value).encode(), now, [])
+            return value
+
+        try:
+            with self.lock:
+                return self._transaction(read_and_write)
+        except Error as e:
+            self._failed(e)
+            return change(default)  # As if nothing had been stored yet
+
+    def invalidate(self, changes: Iterable[Change]) -> int:
+        changes = list(changes)
+        if not changes:
+            return 0
+
+        def delete(connection):
+            removed = 0
+            for entity, entity_id, version in changes:
+                connection.execute("""
+                    INSERT INTO CacheInvalidations VALUES (?, ?, ?)
+                    ON CONFLICT (entity, entity_id)
+                    DO UPDATE SET version = MAX(version, excluded.version)
+                """, (entity, entity_id, version))
+                removed += connection.execute("""
+                    DELETE FROM CacheEntries WHERE cache = ? AND key IN (
+                        SELECT key FROM CacheDependencies
+                        WHERE cache = ? AND entity = ? AND entity_id IN (?, ?))
+                """, (self.name, self.name, entity, entity_id, any_id)).rowcount
+            self._set_version(connection, max(version for _, _, version in changes))
+            return removed
+
+        try:
+            with self.lock:
+                return self._transaction(delete)
+        except Error as e:
+            self._failed(e)
+            return 0
+
+    def _set_version(self, connection, version: int):
+        connection.execute("""
+            INSERT INTO CacheVersions VALUES (?, ?)
+            ON CONFLICT (cache) DO UPDATE SET version = MAX(version, excluded.version)
+        """, (self.name, version))
+
+    def catch_up(self, version: int, changes_since: Callable[[int], List[Change]]):
+        # Entries outlive the workers, so drop what changed while no worker was watching
+        try:
+            with self.lock:
+                row = self._connect().execute(
+                    "SELECT version FROM CacheVersions WHERE cache = ?", (self.name,)).fetchone()
+        except Error as e:
+            self._failed(e)
+            return
+
+        # A cache from before a new database can not be checked against it
+        if row is None or row[0] > version:
+            self.clear(version)
+        elif row[0] < version:
+            self.invalidate(changes_since(row[0]))
+
+    def clear(self, version: int = 0):
+        def delete(connection):
+            connection.execute("DELETE FROM CacheEntries WHERE cache = ?", (self.name,))
+            connection.execute("DELETE FROM CacheVersions WHERE cache = ?", (self.name,))
+            connection.execute("DELETE FROM CacheInvalidations WHERE version > ?", (version,))
+            self._set_version(connection, version)
+
+        try:
+            with self.lock:
+                self._transaction(delete)
+        except Error as e:
+            self._failed(e)
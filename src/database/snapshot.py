@@ -0,0 +1,91 @@
+# Snapshot copy of the database for read-heavy pages
+# The copy is refreshed periodically with the sqlite3 backup API, so feed reads
+# never share locks or pages with the writers of the primary database.
+
+import os
+from pathlib import Path
+from sqlite3 import connect
+from threading import Lock, Thread
+from time import perf_counter, sleep, time
+from database.params import database_params, snapshot_filepath, snapshot_interval
+from util.metrics import metrics
+from util.prefork import after_fork
+
+
+class SnapshotRefresher:
+    def __init__(self, database: str, snapshot: str, interval: float):
+        self.database = database
+        self.snapshot = Path(snapshot)
+        self.interval = interval
+        self.thread = None
+        self.lock = Lock()
+
+        # Kept open, so data_version tells whether anything was committed meanwhile
+        self.source = None
+        self.copied_version = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="db-snapshot", daemon=True)
+                self.thread.start()
+
+    def is_ready(self) -> bool:
+        return self.snapshot.exists()
+
+    def refresh(self):
+        if self.source is None:
+            self.source = connect(self.database, check_same_thread=False)
+
+        # Nothing committed since the last copy
+        [version] = self.source.execute("PRAGMA data_version").fetchone()
+        if self.is_ready() and version == self.copied_version:
+            return
+
+        # Workers share the snapshot file, skip if another one refreshed it just now
+        if self.is_ready() and time() - self.snapshot.stat().st_mtime < self.interval:
+            return
+
+        start = perf_counter()
+        temporary = self.snapshot.with_name(f"{self.snapshot.name}.{os.getpid()}.tmp")
+        target = connect(temporary)
+        try:
+            self.source.backup(target, pages=1024)
+
+            # Read-only WAL databases need their -shm file, so use a rollback journal
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+        self.copied_version = version
+
+        # Open connections keep reading the old copy, new ones get this one
+        os.replace(temporary, self.snapshot)
+        metrics.increment("database_snapshot.refreshes")
+        metrics.observe("database_snapshot.refresh_seconds", perf_counter() - start)
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                print("Database snapshot refresh failed:", err)
+            sleep(self.interval)
+
+
+refresher = None
+refresher_lock = Lock()
+
+
+@after_fork
+def forget_snapshot_refresher():
+    global refresher, refresher_lock  # pylint: disable=global-statement
+    refresher, refresher_lock = None, Lock()
+
+
+def get_snapshot_refresher() -> SnapshotRefresher:  # The snapshot refresher of this process
+    global refresher  # pylint: disable=global-statement
+    with refresher_lock:
+        if refresher is None:
+            refresher = SnapshotRefresher(database_params[0], snapshot_filepath, snapshot_interval)
+            refresher.start()
+        return refresher
@@ -1,4 +1,35 @@
 # All SQL commands used by the database library
+
+# Challenge feed ranked by the precomputed ChallengeScores (see database/ranking.py)
+ranked_challenges = """
+        SELECT
+            C.id,
+            C.created,
+            C.title,
+            COALESCE(C.body_preview, C.body) AS body,
+            C.accepts_submissions,
+            ChallengeCategories.id AS category_id,
+            ChallengeCategories.name AS category_name,
+            Users.username,
+            Users.id,
+            Profiles.image_asset_id AS profile_image,
+            (SELECT COUNT(*) FROM Votes WHERE challenge_id = C.id) AS vote_count,
+            EXISTS (
+                SELECT 1 FROM Votes WHERE challenge_id = C.id AND voter_id = ?
+            ) AS has_voted,
+            C.comment_count,
+            C.submission_count,
+            C.last_activity
+        FROM ChallengeScores S
+        JOIN Challenges C ON C.id = S.challenge_id
+        JOIN ChallengeCategories ON C.category_id = ChallengeCategories.id
+        JOIN Users ON C.author_id = Users.id
+        JOIN Profiles ON Profiles.user_id = Users.id
+        WHERE S.created >= ? AND (? IS NULL OR S.category_id = ?)
+        ORDER BY {order}
+        LIMIT ? OFFSET ?
+"""
+
 sql_table = {
     # MARK: User
 
@@ -18,12 +49,14 @@ sql_table = {
         SELECT
             id,
             username,
-            password_hash,
             require_new_password,
-            is_admin 
+            is_admin
         FROM Users WHERE username = ?
     """,
 
+    # Only for checking a password, get_user leaves the hash out
+    "get_password_hash": "SELECT password_hash FROM Users WHERE username = ?",
+
     "edit_user": """
         UPDATE Users
         SET username = ?, password_hash = ?, require_new_password = ?
@@ -68,9 +101,14 @@ sql_table = {
 
     # MARK: Asset
 
-    "create_asset": "INSERT INTO Assets (filename, value) VALUES (?, ?)",
+    "create_asset": "INSERT INTO Assets (filename, value, created) VALUES (?, ?, ?)",
 
-    "get_asset": "SELECT filename, value FROM Assets WHERE id = ?",
+    "create_asset_streamed": """
+        INSERT INTO Assets (filename, value, created, content_type)
+        VALUES (?, zeroblob(?), ?, ?)
+    """,
+
+    "get_asset": "SELECT filename, value, content_type FROM Assets WHERE id = ?",
 
     "get_asset_with_submission_id": """
         SELECT
@@ -85,6 +123,37 @@ sql_table = {
 
     "remove_asset": "DELETE FROM Assets WHERE id = ?",
 
+    "get_asset_variant": """
+        SELECT content_type, value FROM AssetVariants WHERE asset_id = ? AND variant = ?
+    """,
+
+    # Two requests may make the same variant at once, the first one is kept
+    "create_asset_variant": """
+        INSERT OR IGNORE INTO AssetVariants (asset_id, variant, content_type, value)
+        VALUES (?, ?, ?, ?)
+    """,
+
+    # Assets in an id range that nothing references
+    "get_orphaned_assets": """
+        SELECT A.id, length(A.value)
+        FROM Assets A
+        WHERE A.id > ? AND A.id <= ? AND A.created < ?
+            AND NOT EXISTS (SELECT 1 FROM Profiles WHERE image_asset_id = A.id)
+            AND NOT EXISTS (SELECT 1 FROM Profiles WHERE banner_asset_id = A.id)
+            AND NOT EXISTS (SELECT 1 FROM Submissions WHERE solution_asset_id = A.id)
+    """,
+
+    "get_max_asset_id": "SELECT COALESCE(MAX(id), 0) FROM Assets",
+
+    # Checks again, in case the asset got referenced after it was found
+    "remove_orphaned_asset": """
+        DELETE FROM Assets
+        WHERE id = ?
+            AND NOT EXISTS (SELECT 1 FROM Profiles WHERE image_asset_id = ?)
+            AND NOT EXISTS (SELECT 1 FROM Profiles WHERE banner_asset_id = ?)
+            AND NOT EXISTS (SELECT 1 FROM Submissions WHERE solution_asset_id = ?)
+    """,
+
     # MARK: Category
 
     "get_categories": "SELECT id, name FROM ChallengeCategories",
@@ -96,7 +165,7 @@ sql_table = {
             C.id, 
             C.created, 
             C.title, 
-            C.body,
+            COALESCE(C.body_preview, C.body) AS body,
             C.accepts_submissions,
             ChallengeCategories.id AS category_id, 
             ChallengeCategories.name AS category_name, 
@@ -104,7 +173,10 @@ sql_table = {
             Users.id,
             Profiles.image_asset_id AS profile_image,
             COALESCE(VoteCounts.vote_count, 0) AS vote_count,
-            CASE WHEN UserVotes.voter_id IS NOT NULL THEN 1 ELSE 0 END AS has_voted
+            CASE WHEN UserVotes.voter_id IS NOT NULL THEN 1 ELSE 0 END AS has_voted,
+            C.comment_count,
+            C.submission_count,
+            C.last_activity
         FROM Challenges C
         JOIN ChallengeCategories ON C.category_id = ChallengeCategories.id
         JOIN Users ON C.author_id = Users.id
@@ -125,6 +197,19 @@ sql_table = {
         LIMIT ? OFFSET ?
     """,
 
+    "get_challenges_hot": ranked_challenges.format(order="S.hot DESC"),
+
+    "get_challenges_top": ranked_challenges.format(order="S.votes DESC, S.created DESC"),
+
+    "count_challenges": """
+        SELECT COALESCE(SUM(challenges), 0) FROM ChallengeCounts
+        WHERE ? IS NULL OR category_id = ?
+    """,
+
+    "count_challenge_replies": """
+        SELECT comment_count + submission_count FROM Challenges WHERE id = ?
+    """,
+
     "get_full_challenge": """
         SELECT 
             C.id, 
@@ -138,7 +223,10 @@ sql_table = {
             Users.id,
             Profiles.image_asset_id AS profile_image,
             COALESCE(VoteCounts.vote_count, 0) AS vote_count,
-            CASE WHEN UserVotes.voter_id IS NOT NULL THEN 1 ELSE 0 END AS has_voted
+            CASE WHEN UserVotes.voter_id IS NOT NULL THEN 1 ELSE 0 END AS has_voted,
+            C.comment_count,
+            C.submission_count,
+            C.last_activity
         FROM Challenges C
         JOIN ChallengeCategories ON C.category_id = ChallengeCategories.id
         JOIN Users ON C.author_id = Users.id
@@ -163,24 +251,31 @@ sql_table = {
             created,
             title,
             body,
+            body_preview,
             category_id,
             author_id,
             accepts_submissions
-        ) VALUES (?, ?, ?, ?, ?, ?)
+        ) VALUES (?, ?, ?, ?, ?, ?, ?)
     """,
 
     "challenge_exists": "SELECT EXISTS (SELECT id FROM Challenges WHERE id = ?)",
 
+    "get_challenge_owner": "SELECT author_id, id, NULL FROM Challenges WHERE id = ?",
+
     "edit_challenge": """
         UPDATE Challenges SET
             title = ?,
             body = ?,
+            body_preview = ?,
             category_id = ?,
             accepts_submissions = ?
-        WHERE id = ?
+        WHERE id = ? AND (? IS NULL OR author_id = ?)
     """,
 
-    "remove_challenge": "DELETE FROM Challenges WHERE id = ?",
+    # An author id limits the change to the rows of that author, NULL allows any
+    "remove_challenge": """
+        DELETE FROM Challenges WHERE id = ? AND (? IS NULL OR author_id = ?)
+    """,
 
     # MARK: Search
 
@@ -189,7 +284,7 @@ sql_table = {
             C.id, 
             C.created, 
             C.title, 
-            C.body,
+            COALESCE(C.body_preview, C.body) AS body,
             C.accepts_submissions,
             ChallengeCategories.id AS category_id, 
             ChallengeCategories.name AS category_name, 
@@ -197,7 +292,10 @@ sql_table = {
             Users.id, 
             Profiles.image_asset_id AS profile_image,
             COALESCE(VoteCounts.vote_count, 0) AS vote_count,
-            CASE WHEN UserVotes.voter_id IS NOT NULL THEN 1 ELSE 0 END AS has_voted
+            CASE WHEN UserVotes.voter_id IS NOT NULL THEN 1 ELSE 0 END AS has_voted,
+            C.comment_count,
+            C.submission_count,
+            C.last_activity
         FROM Challenges C
         JOIN ChallengeCategories ON C.category_id = ChallengeCategories.id
         JOIN Users ON C.author_id = Users.id
@@ -223,6 +321,19 @@ sql_table = {
         LIMIT ? OFFSET ?
     """,
 
+    "count_search_challenges": """
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM Challenges C
+            WHERE
+                (? IS NULL OR C.category_id = ?)
+                AND (
+                    LOWER(C.title) LIKE LOWER('%' || ? || '%') OR
+                    LOWER(C.body) LIKE LOWER('%' || ? || '%')
+                )
+            LIMIT ?
+        )
+    """,
+
     "search_users": """
         SELECT
             U.id AS user_id,
@@ -243,13 +354,31 @@ sql_table = {
         LIMIT ? OFFSET ?
     """,
 
+    "count_search_users": """
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM Users WHERE LOWER(username) LIKE LOWER('%' || ? || '%')
+            LIMIT ?
+        )
+    """,
+
     # MARK: Vote
 
-    "create_vote_for_challenge": "INSERT INTO Votes (challenge_id, voter_id) VALUES (?, ?)",
+    # NOTE: Voting twice is not an error, the second vote is simply ignored
 
-    "create_vote_for_comment": "INSERT INTO Votes (comment_id, voter_id) VALUES (?, ?)",
+    "create_vote_for_challenge": """
+        INSERT INTO Votes (challenge_id, voter_id) VALUES (?, ?)
+        ON CONFLICT DO NOTHING
+    """,
 
-    "create_vote_for_submission": "INSERT INTO Votes (submission_id, voter_id) VALUES (?, ?)",
+    "create_vote_for_comment": """
+        INSERT INTO Votes (comment_id, voter_id) VALUES (?, ?)
+        ON CONFLICT DO NOTHING
+    """,
+
+    "create_vote_for_submission": """
+        INSERT INTO Votes (submission_id, voter_id) VALUES (?, ?)
+        ON CONFLICT DO NOTHING
+    """,
 
     "remove_vote_from_challenge": "DELETE FROM Votes WHERE challenge_id = ? AND voter_id = ?",
 
@@ -257,6 +386,90 @@ sql_table = {
 
     "remove_vote_from_submission": "DELETE FROM Votes WHERE submission_id = ? AND voter_id = ?",
 
+    "get_vote_state_for_challenge": """
+        SELECT
+            (SELECT COUNT(*) FROM Votes WHERE challenge_id = ?),
+            EXISTS (SELECT 1 FROM Votes WHERE challenge_id = ? AND voter_id = ?)
+    """,
+
+    "get_vote_state_for_comment": """
+        SELECT
+            (SELECT COUNT(*) FROM Votes WHERE comment_id = ?),
+            EXISTS (SELECT 1 FROM Votes WHERE comment_id = ? AND voter_id = ?)
+    """,
+
+    "get_vote_state_for_submission": """
+        SELECT
+            (SELECT COUNT(*) FROM Votes WHERE submission_id = ?),
+            EXISTS (SELECT 1 FROM Votes WHERE submission_id = ? AND voter_id = ?)
+    """,
+
+    # MARK: Ranking
+
+    "get_dirty_challenge_scores": "SELECT challenge_id FROM ChallengeScoresDirty LIMIT ?",
+
+    "clear_dirty_challenge_score": "DELETE FROM ChallengeScoresDirty WHERE challenge_id = ?",
+
+    "get_challenge_activity": """
+        SELECT
+            C.id,
+            C.category_id,
+            C.created,
+            (SELECT COUNT(*) FROM Votes WHERE challenge_id = C.id),
+            C.comment_count + C.submission_count
+        FROM Challenges C
+        WHERE C.id = ?
+    """,
+
+    "set_challenge_score": """
+        INSERT INTO ChallengeScores (challenge_id, category_id, created, votes, replies, hot)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (challenge_id) DO UPDATE SET
+            category_id = excluded.category_id,
+            votes = excluded.votes,
+            replies = excluded.replies,
+            hot = excluded.hot
+    """,
+
+    # MARK: Reply counters
+
+    "get_drifted_reply_counters": """
+        SELECT id, comment_count, comments, submission_count, submissions
+        FROM (
+            SELECT
+                C.id,
+                C.comment_count,
+                (SELECT COUNT(*) FROM Comments WHERE challenge_id = C.id) AS comments,
+                C.submission_count,
+                (SELECT COUNT(*) FROM Submissions WHERE challenge_id = C.id) AS submissions,
+                C.last_activity,
+                MAX(
+                    C.created,
+                    COALESCE((SELECT MAX(created) FROM Comments WHERE challenge_id = C.id), 0),
+                    COALESCE((SELECT MAX(created) FROM Submissions WHERE challenge_id = C.id), 0)
+                ) AS activity
+            FROM Challenges C
+        )
+        WHERE comment_count != comments
+            OR submission_count != submissions
+            OR last_activity != activity
+    """,
+
+    "fix_reply_counters": """
+        UPDATE Challenges SET
+            comment_count = (SELECT COUNT(*) FROM Comments
+                             WHERE Comments.challenge_id = Challenges.id),
+            submission_count = (SELECT COUNT(*) FROM Submissions
+                                WHERE Submissions.challenge_id = Challenges.id),
+            last_activity = MAX(
+                Challenges.created,
+                COALESCE((SELECT MAX(Comments.created) FROM Comments
+                          WHERE Comments.challenge_id = Challenges.id), 0),
+                COALESCE((SELECT MAX(Submissions.created) FROM Submissions
+                          WHERE Submissions.challenge_id = Challenges.id), 0))
+        WHERE id = ?
+    """,
+
     # MARK: Vote stats
 
     "get_received_votes": """
@@ -369,11 +582,17 @@ sql_table = {
         LIMIT ? OFFSET ?
     """,
 
-    "remove_comment": "DELETE FROM Comments WHERE id = ?",
+    "remove_comment": """
+        DELETE FROM Comments WHERE id = ? AND (? IS NULL OR author_id = ?)
+    """,
 
     "comment_exists": "SELECT EXISTS (SELECT id FROM Comments WHERE id = ?)",
 
-    "edit_comment": "UPDATE Comments SET body = ? WHERE id = ?",
+    "get_comment_owner": "SELECT author_id, challenge_id, NULL FROM Comments WHERE id = ?",
+
+    "edit_comment": """
+        UPDATE Comments SET body = ? WHERE id = ? AND (? IS NULL OR author_id = ?)
+    """,
 
     # MARK: Submission
 
@@ -388,7 +607,9 @@ sql_table = {
         ) VALUES (?, ?, ?, ?, ?, ?)
     """,
 
-    "remove_submission": "DELETE FROM Submissions WHERE id = ?",
+    "remove_submission": """
+        DELETE FROM Submissions WHERE id = ? AND (? IS NULL OR author_id = ?)
+    """,
 
     "get_submission": """
         SELECT
@@ -417,10 +638,14 @@ sql_table = {
 
     "submission_exists": "SELECT EXISTS (SELECT id FROM Submissions WHERE id = ?)",
 
+    "get_submission_owner": """
+        SELECT author_id, challenge_id, solution_asset_id FROM Submissions WHERE id = ?
+    """,
+
     "edit_submission": """
         UPDATE Submissions
         SET title = ?, body = ?, solution_asset_id = ?
-        WHERE id = ?
+        WHERE id = ? AND (? IS NULL OR author_id = ?)
     """,
 
     # MARK: Get all user content
@@ -432,7 +657,7 @@ sql_table = {
             Challenges.id AS id,
             Challenges.created,
             Challenges.title,
-            Challenges.body,
+            COALESCE(Challenges.body_preview, Challenges.body) AS body,
             Challenges.accepts_submissions,
             Challenges.category_id,
             ChallengeCategories.name AS category_name,
@@ -445,7 +670,10 @@ sql_table = {
                 WHERE challenge_id = Challenges.id AND voter_id = ?
             ) AS has_voted,
             NULL AS solution_asset_id,
-            NULL AS solution_filename
+            NULL AS solution_filename,
+            Challenges.comment_count,
+            Challenges.submission_count,
+            Challenges.last_activity
         FROM Challenges
         JOIN ChallengeCategories ON Challenges.category_id = ChallengeCategories.id
         JOIN Users ON Challenges.author_id = Users.id
@@ -473,7 +701,10 @@ sql_table = {
                 WHERE comment_id = Comments.id AND voter_id = ?
             ) AS has_votes,
             NULL AS solution_asset_id,
-            NULL AS solution_filename
+            NULL AS solution_filename,
+            NULL AS comment_count,
+            NULL AS submission_count,
+            NULL AS last_activity
         FROM Comments
         JOIN Users ON Comments.author_id = Users.id
         LEFT JOIN Profiles ON Users.id = Profiles.user_id
@@ -500,7 +731,10 @@ sql_table = {
                 WHERE submission_id = Submissions.id AND voter_id = ?
             ) AS has_voted,
             Submissions.solution_asset_id,
-            (SELECT filename FROM Assets WHERE id = Submissions.solution_asset_id) AS solution_filename
+            (SELECT filename FROM Assets WHERE id = Submissions.solution_asset_id) AS solution_filename,
+            NULL AS comment_count,
+            NULL AS submission_count,
+            NULL AS last_activity
         FROM Submissions
         JOIN Users ON Submissions.author_id = Users.id
         LEFT JOIN Profiles ON Users.id = Profiles.user_id
@@ -508,5 +742,44 @@ sql_table = {
 
         ORDER BY created DESC
         LIMIT ? OFFSET ?
+    """,
+
+    # Version stamps of what a page shows, for its ETag (see util/conditional.py)
+    "get_latest_version": """
+        SELECT COALESCE(MAX(version), 0) FROM ChangeLog
+    """,
+
+    # Replies added or removed also update the challenge (its reply counts)
+    "get_challenge_version": """
+        SELECT COALESCE(MAX(version), 0) FROM ChangeLog
+        WHERE (entity = 'challenge' AND entity_id = ?1)
+            OR (entity = 'comment' AND entity_id IN (
+                SELECT id FROM Comments WHERE challenge_id = ?1))
+            OR (entity = 'submission' AND entity_id IN (
+                SELECT id FROM Submissions WHERE challenge_id = ?1))
+            OR (entity = 'user' AND entity_id IN (
+                SELECT author_id FROM Challenges WHERE id = ?1
+                UNION SELECT author_id FROM Comments WHERE challenge_id = ?1
+                UNION SELECT author_id FROM Submissions WHERE challenge_id = ?1))
+    """,
+
+    # Removed content and votes leave nothing to join to, the counts tell them apart
+    "get_user_version": """
+        SELECT
+            (SELECT COALESCE(MAX(version), 0) FROM ChangeLog
+            WHERE (entity = 'user' AND entity_id = ?1)
+                OR (entity = 'challenge' AND entity_id IN (
+                    SELECT id FROM Challenges WHERE author_id = ?1
+                    UNION SELECT challenge_id FROM Votes WHERE voter_id = ?1))
+                OR (entity = 'comment' AND entity_id IN (
+                    SELECT id FROM Comments WHERE author_id = ?1
+                    UNION SELECT comment_id FROM Votes WHERE voter_id = ?1))
+                OR (entity = 'submission' AND entity_id IN (
+                    SELECT id FROM Submissions WHERE author_id = ?1
+                    UNION SELECT submission_id FROM Votes WHERE voter_id = ?1))),
+            (SELECT COUNT(*) FROM Challenges WHERE author_id = ?1),
+            (SELECT COUNT(*) FROM Comments WHERE author_id = ?1),
+            (SELECT COUNT(*) FROM Submissions WHERE author_id = ?1),
+            (SELECT COUNT(*) FROM Votes WHERE voter_id = ?1)
     """
 }
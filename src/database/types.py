@@ -9,14 +9,18 @@ class DatabaseException(Exception):
 
 
 class Asset:
+    __slots__ = ("id", "filename", "value", "content_type")
+
     id: str
     filename: str
     value: bytes
+    content_type: Optional[str]
 
-    def __init__(self, asset_id, filename, value):
+    def __init__(self, asset_id, filename, value, content_type=None):
         self.id = asset_id
         self.filename = filename
         self.value = value
+        self.content_type = content_type
 
     def to_dict(self):
         return {
@@ -31,6 +35,8 @@ class AssetNotFoundException(Exception):
 
 
 class Profile:
+    __slots__ = ("id", "user_id", "description", "image_asset", "banner_asset")
+
     id: str
     user_id: str
     description: str
@@ -63,16 +69,24 @@ class ProfileEditable(TypedDict):
 class UserDict(TypedDict):
     id: str
     username: str
-    password_hash: str
     require_new_password: bool
     profile: Profile
     is_admin: bool
 
 
 class User:
+    __slots__ = (
+        "id",
+        "username",
+        "password_hash",
+        "require_new_password",
+        "profile",
+        "is_admin"
+    )
+
     id: str
     username: str
-    password_hash: str
+    password_hash: Optional[str]  # None, see get_password_hash in database/abstract.py
     require_new_password: bool
     profile: Profile
     is_admin: bool
@@ -92,16 +106,31 @@ class User:
         self.profile = profile
 
     def to_dict(self):
+        # NOTE: Stored in the session and the user cache, so the password hash is left out
         return {
             "id": self.id,
             "username": self.username,
-            "password_hash": self.password_hash,
             "require_new_password": self.require_new_password,
             "is_admin": self.is_admin,
             "profile": self.profile.to_dict()
         }
 
 
+def user_from_dict(data: dict) -> User:
+    # The other way around, without the password hash and the asset contents
+    profile = data["profile"]
+    image_asset, banner_asset = (
+        Asset(asset["id"], asset["filename"], None) if asset else None
+        for asset in (profile["image_asset"], profile["banner_asset"]))
+    return User(data["id"],
+                data["username"],
+                None,
+                data["require_new_password"],
+                data["is_admin"],
+                Profile(profile["id"], profile["user_id"], profile["description"],
+                        image_asset, banner_asset))
+
+
 class UserEditable(TypedDict):
     username: str
     password_hash: str
@@ -124,6 +153,8 @@ class ProfileNotFoundException(Exception):
 
 
 class Category:
+    __slots__ = ("id", "name")
+
     id: int
     name: str
 
@@ -131,15 +162,48 @@ class Category:
         self.id = category_id
         self.name = name
 
+
+class ContentOwner:  # Who owns a challenge, comment or submission (see get_owner)
+    __slots__ = ("author_id", "challenge_id", "asset_id")
+
+    author_id: int
+    challenge_id: int
+    asset_id: Optional[int]  # Script of a submission
+
+    def __init__(self, author_id, challenge_id, asset_id):
+        self.author_id = author_id
+        self.challenge_id = challenge_id
+        self.asset_id = asset_id
+
 # FIXME: The types for challenges, comments and submissions are incomplete,
 #        when it comes to giving the developer as much information to work with,
 #        in favor of performance. We could build full User, Profile, Asset etc.
 #        classes with little effort, but I think the choice I made here is the right one.
 #        However, it may not be final.
 #        Classes effected by this are named "Husks"
+# NOTE: Husks (and the other row types here) are built for every row on every page,
+#       so they use __slots__ to skip the per-instance __dict__.
 
 
 class ChallengeHusk:
+    __slots__ = (
+        "id",
+        "created",
+        "title",
+        "body",
+        "accepts_submissions",
+        "category_id",
+        "category_name",
+        "author_name",
+        "author_id",
+        "author_image_id",
+        "votes",
+        "has_my_vote",
+        "comment_count",
+        "submission_count",
+        "last_activity"
+    )
+
     id: int
     type = "challenge"
     created: int
@@ -153,6 +217,9 @@ class ChallengeHusk:
     author_image_id: int
     votes: int
     has_my_vote: bool
+    comment_count: int
+    submission_count: int
+    last_activity: int
 
     def __init__(self,
                  challenge_id,
@@ -166,7 +233,10 @@ class ChallengeHusk:
                  author_id,
                  author_image_id,
                  votes,
-                 has_my_vote):
+                 has_my_vote,
+                 comment_count,
+                 submission_count,
+                 last_activity):
         self.id = challenge_id
         self.created = created
         self.title = title
@@ -179,6 +249,9 @@ class ChallengeHusk:
         self.author_image_id = author_image_id
         self.votes = votes
         self.has_my_vote = has_my_vote == 1
+        self.comment_count = comment_count
+        self.submission_count = submission_count
+        self.last_activity = last_activity
 
     def to_dict(self):
         return {
@@ -190,7 +263,10 @@ class ChallengeHusk:
             "author_name": self.author_name,
             "author_image_id": self.author_image_id,
             "votes": self.votes,
-            "has_my_vote": self.has_my_vote
+            "has_my_vote": self.has_my_vote,
+            "comment_count": self.comment_count,
+            "submission_count": self.submission_count,
+            "last_activity": self.last_activity
         }
 
 
@@ -216,6 +292,18 @@ class CommentEditable(TypedDict):
 
 
 class CommentHusk:
+    __slots__ = (
+        "id",
+        "created",
+        "body",
+        "author_id",
+        "author_image_id",
+        "author_name",
+        "challenge_id",
+        "votes",
+        "has_my_vote"
+    )
+
     id: int
     type = "comment"
     created: int
@@ -249,6 +337,21 @@ class CommentHusk:
 
 
 class SubmissionHusk:
+    __slots__ = (
+        "id",
+        "created",
+        "title",
+        "body",
+        "author_id",
+        "author_image_id",
+        "author_name",
+        "challenge_id",
+        "votes",
+        "has_my_vote",
+        "script_id",
+        "script_name"
+    )
+
     id: int
     type = "submission"
     created: int
@@ -298,9 +401,38 @@ class SubmissionNotFoundException(Exception):
 class SubmissionEditable(TypedDict):
     title: str
     body: str
-    script_id: Optional[int]
-    script_name: str
-    script_bytes: str
+    script_id: int
+
+
+class VoteState:
+    __slots__ = ("votes", "has_my_vote")
+
+    votes: int
+    has_my_vote: bool
+
+    def __init__(self, votes, has_my_vote):
+        self.votes = votes
+        self.has_my_vote = has_my_vote == 1
+
+    def to_dict(self):
+        return {
+            "votes": self.votes,
+            "has_my_vote": self.has_my_vote
+        }
+
+
+class Page(list):  # One page of results from a paginated query
+    __slots__ = ("has_more", "total", "total_capped")
+
+    def __init__(self,
+                 items: list,
+                 has_more: bool,
+                 total: Optional[int] = None,
+                 total_capped: bool = False):
+        super().__init__(items)
+        self.has_more = has_more        # Fetched one row past the page to know
+        self.total = total              # None when not known
+        self.total_capped = total_capped  # At least this many, counting stopped there
 
 
 class StatsDict(TypedDict):
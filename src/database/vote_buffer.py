@@ -0,0 +1,95 @@
+# Write-behind buffer for votes: rapid vote toggles are coalesced and written in batches
+
+import atexit
+from threading import Event, Lock, Thread
+from typing import Dict, Literal, Optional, Tuple
+from database.sql import sql_table
+from database.types import VoteState
+from database.writer import open_database
+from util.metrics import metrics
+from util.prefork import after_fork
+
+VoteKey = Tuple[str, int, int]  # (target_type, target_id, user_id)
+
+
+class VoteBuffer:
+    def __init__(self, flush_interval: float = 0.5, max_pending: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending: Dict[VoteKey, bool] = {}
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.wake = Event()
+        self.thread = None
+        after_fork(self._forget_thread)
+
+    def _forget_thread(self):  # Started again on first use in the forked child
+        self.thread = None
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.wake = Event()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="vote-buffer", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def set(self,
+            target_type: Literal["submission", "comment", "challenge"],
+            target_id: int,
+            user_id: int,
+            voted: bool):
+        if target_type not in ("submission", "challenge", "comment"):
+            raise ValueError("Unknown target type!")
+
+        # Only the latest state of each vote gets written
+        key = (target_type, target_id, user_id)
+        with self.lock:
+            if key in self.pending:
+                metrics.increment("vote_buffer.coalesced")
+            self.pending[key] = voted
+            if len(self.pending) >= self.max_pending:
+                self.wake.set()
+
+    def apply_pending(self,
+                      target_type: str,
+                      target_id: int,
+                      user_id: int,
+                      state: VoteState) -> VoteState:
+        # Adjust the state read from the database with the vote not yet written
+        with self.lock:
+            voted: Optional[bool] = self.pending.get((target_type, target_id, user_id))
+        if voted is None or voted == state.has_my_vote:
+            return state
+        return VoteState(state.votes + (1 if voted else -1), voted)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+
+            commands = [
+                (sql_table[("create_vote_for_" if voted else "remove_vote_from_") + target_type],
+                 (target_id, user_id))
+                for (target_type, target_id, user_id), voted in pending.items()
+            ]
+            connection = open_database()
+            try:
+                connection.execute_batch(commands)
+            finally:
+                connection.close()
+            metrics.increment("vote_buffer.flushes")
+            metrics.increment("vote_buffer.votes_written", len(commands))
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                print("Vote buffer flush failed:", err)
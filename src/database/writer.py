@@ -0,0 +1,174 @@
+# Single writer for all database mutations of this process
+# SQLite allows one writer at a time, so instead of every request connection fighting
+# for the write lock, writes are queued to one connection owned by a dedicated thread.
+# Queued jobs are committed together (group commit), each in its own savepoint.
+
+from concurrent.futures import Future
+from queue import Empty, Queue
+from sqlite3 import Error
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, List, Optional, Tuple, Union
+from database.connection import DatabaseConnection, WriteResult
+from database.params import (
+    database_params,
+    snapshot_filepath,
+    use_write_queue,
+    write_batch_size
+)
+from database.snapshot import get_snapshot_refresher
+from util.metrics import metrics
+from util.prefork import after_fork
+
+Command = Tuple[str, Union[Tuple[Any], dict]]
+
+
+class WriteJob:
+    __slots__ = ("commands", "callback", "future")
+
+    def __init__(self, commands: List[Command], callback: Optional[Callable] = None):
+        self.commands = commands
+        self.callback = callback  # Runs after the commands: callback(connection, cursor)
+        self.future = Future()
+
+
+JobResult = Tuple[WriteJob, Optional[WriteResult], Optional[Exception]]
+
+
+class DatabaseWriter:
+    def __init__(self, params=database_params, max_batch: int = 64, timeout: float = 30):
+        self.params = params
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.queue: "Queue[WriteJob]" = Queue()
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="db-writer", daemon=True)
+                self.thread.start()
+
+    def submit(self, commands: List[Command], callback: Optional[Callable] = None) -> Future:
+        self.start()
+        job = WriteJob(commands, callback)
+        self.queue.put(job)
+        metrics.set_gauge("database_writer.queue_depth", self.queue.qsize())
+        return job.future
+
+    # The methods below block until the write is committed and raise the sqlite3 error if it
+    # failed, or TimeoutError after timeout seconds: the write then stays queued and may still
+    # be committed later.
+    def execute(self, query: str, parameters: Union[Tuple[Any], dict]) -> WriteResult:
+        return self.submit([(query, parameters)]).result(self.timeout)
+
+    def execute_many(self, commands: List[Command]) -> WriteResult:
+        # All commands succeed or fail together
+        return self.submit(commands).result(self.timeout)
+
+    def execute_with(self,
+                     query: str,
+                     parameters: Union[Tuple[Any], dict],
+                     callback: Callable) -> WriteResult:
+        # The callback gets the writer connection and cursor, in the same savepoint
+        return self.submit([(query, parameters)], callback).result(self.timeout)
+
+    def _run(self):
+        connection = DatabaseConnection(*self.params).open().connection
+        connection.isolation_level = None  # Transactions are handled by hand
+        connection.execute("PRAGMA journal_mode = WAL")
+
+        while True:
+            jobs = self._take_jobs()
+            try:
+                self._commit_group(connection, jobs)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                # Never leave callers waiting, the writer keeps on running
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(err)
+
+    def _take_jobs(self) -> List[WriteJob]:
+        # Waits for a job, then takes every job queued meanwhile into the same commit
+        jobs = [self.queue.get()]
+        while len(jobs) < self.max_batch:
+            try:
+                jobs.append(self.queue.get_nowait())
+            except Empty:
+                break
+        metrics.set_gauge("database_writer.queue_depth", self.queue.qsize())
+        return jobs
+
+    def _commit_group(self, connection, jobs: List[WriteJob]):
+        start = perf_counter()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            results = [self._run_job(connection, job) for job in jobs]
+            connection.execute("COMMIT")
+        except Error as err:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            for job in jobs:
+                job.future.set_exception(err)
+            return
+
+        # Results are only handed out once they are committed
+        for job, result, err in results:
+            if err:
+                job.future.set_exception(err)
+            else:
+                job.future.set_result(result)
+
+        metrics.increment("database_writer.commits")
+        metrics.increment("database_writer.jobs", len(jobs))
+        metrics.observe("database_writer.commit_seconds", perf_counter() - start)
+
+    def _run_job(self, connection, job: WriteJob) -> JobResult:
+        # A failing job only rolls back its own savepoint
+        connection.execute("SAVEPOINT job")
+        try:
+            cursor = connection.cursor()
+            for query, parameters in job.commands:
+                cursor.execute(query, parameters)
+            if job.callback:
+                job.callback(connection, cursor)
+            connection.execute("RELEASE job")
+            result = WriteResult(cursor.lastrowid, cursor.rowcount)
+            cursor.close()
+            return job, result, None
+        except (Error, OSError) as err:
+            connection.execute("ROLLBACK TO job")
+            connection.execute("RELEASE job")
+            return job, None, err
+
+
+writer = None
+writer_lock = Lock()
+
+
+@after_fork
+def forget_writer():  # The writer thread of the parent does not exist in a forked child
+    global writer, writer_lock  # pylint: disable=global-statement
+    writer, writer_lock = None, Lock()
+
+
+def get_writer() -> DatabaseWriter:  # The writer of this process
+    global writer  # pylint: disable=global-statement
+    with writer_lock:
+        if writer is None:
+            writer = DatabaseWriter(database_params, write_batch_size)
+        return writer
+
+
+def open_database(from_snapshot: bool = False) -> DatabaseConnection:
+    # Opens a connection with the configured params, writes go through the process writer
+    params = database_params
+
+    # Reads from the snapshot copy, once it exists (see database/snapshot.py)
+    if from_snapshot and use_write_queue and get_snapshot_refresher().is_ready():
+        params = (snapshot_filepath, *database_params[1:])
+        metrics.increment("database.snapshot_connections")
+
+    return DatabaseConnection(*params,
+                              writer=get_writer() if use_write_queue else None).open()
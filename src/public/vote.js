@@ -0,0 +1,26 @@
+// Vote without reloading the page. Without JavaScript, the vote form works as a normal form.
+document.addEventListener("submit", async (event) => {
+    const form = event.target;
+    if (!form.classList.contains("vote") || form.method.toUpperCase() !== "POST") {
+        return;
+    }
+    event.preventDefault();
+
+    const response = await fetch(form.action, {
+        method: "POST",
+        body: new FormData(form),
+        headers: { Accept: "application/json" }
+    });
+    if (!response.ok) {
+        form.submit();
+        return;
+    }
+
+    const state = await response.json();
+    form.querySelector("input[name=vote_action]").value = state.has_my_vote ? "0" : "1";
+    form.querySelector(".vote-label").textContent = state.has_my_vote ? "Downvote" : "Upvote";
+    form.querySelector(".vote-count").textContent = state.votes;
+    form.querySelector("svg").setAttribute("style", state.has_my_vote
+        ? "stroke: var(--very-yellow); transform: rotate(180deg);"
+        : "stroke: black");
+});
@@ -0,0 +1,172 @@
+# WSGI middleware compressing dynamic responses (HTML pages mostly)
+# Responses of known length are compressed whole, streamed responses chunk by chunk,
+# flushing after every chunk so the browser still gets each part as soon as it is ready.
+
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from util.metrics import metrics
+
+try:
+    import brotli
+except ImportError:  # Optional, like zstandard below
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content types worth compressing, images and uploads are compressed already
+compressible_types = ("text/", "application/json", "application/javascript", "image/svg+xml")
+
+
+class Encoder:  # Same interface for every encoding, level is on the gzip scale (1-9)
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=level)
+        elif encoding == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.process(data)
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:  # Everything so far, without ending the stream
+        if self.encoding == "br":
+            return self.compressor.flush()
+        if self.encoding == "zstd":
+            return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+class CompressionMiddleware:
+    def __init__(self,
+                 wsgi_app: Callable,
+                 min_size: int = 1024,
+                 level: int = 6,
+                 route_levels: Optional[Dict[str, int]] = None,
+                 skip_prefixes: Tuple[str, ...] = ("/a/",)):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size  # Smaller bodies are not worth the CPU or the headers
+        self.level = level
+        self.route_levels = route_levels or {}  # Path prefix: level, the longest prefix wins
+        self.skip_prefixes = skip_prefixes
+
+        # Best first, when the client accepts several
+        self.encodings = [encoding for encoding, available in (("br", brotli is not None),
+                                                               ("zstd", zstandard is not None),
+                                                               ("gzip", True))
+                          if available]
+
+    def _negotiate(self, environ: dict) -> Optional[str]:
+        accepted = set()
+        for part in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+            name, _, params = part.strip().partition(";")
+            if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            accepted.add(name.strip().lower())
+        for encoding in self.encodings:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def _level(self, path: str) -> int:
+        matches = [prefix for prefix in self.route_levels if path.startswith(prefix)]
+        return self.route_levels[max(matches, key=len)] if matches else self.level
+
+    def _should_compress(self, status: str, headers: List[Tuple[str, str]]) -> bool:
+        if not status.startswith("200"):
+            return False
+        values = {name.lower(): value for name, value in headers}
+        if "content-encoding" in values or "no-transform" in values.get("cache-control", ""):
+            return False
+        if not values.get("content-type", "").startswith(compressible_types):
+            return False
+        length = values.get("content-length")
+        return length is None or int(length) >= self.min_size
+
+    def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        path = environ.get("PATH_INFO", "")
+        encoding = self._negotiate(environ)
+        if (
+            encoding is None or
+            environ.get("REQUEST_METHOD") == "HEAD" or
+            path.startswith(self.skip_prefixes)
+        ):
+            return self.wsgi_app(environ, start_response)
+
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            if exc_info or "returned" in captured:  # Errors and late calls go straight through
+                return start_response(status, headers, exc_info)
+            captured["status"], captured["headers"] = status, headers
+            return lambda data: None  # Unused write() of old WSGI apps
+
+        iterable = self.wsgi_app(environ, capture_start_response)
+        captured["returned"] = True
+        if "status" not in captured:
+            return iterable
+
+        status, headers = captured["status"], captured["headers"]
+        if not self._should_compress(status, headers):
+            start_response(status, headers)
+            return iterable
+
+        encoder = Encoder(encoding, self._level(path))
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in ("content-length", "vary")]
+        vary = [value for name, value in captured["headers"] if name.lower() == "vary"]
+        headers.append(("Vary", ", ".join(vary + ["Accept-Encoding"])))
+        headers.append(("Content-Encoding", encoding))
+        headers = [(name, "W/" + value if name.lower() == "etag" and
+                    not value.startswith("W/") else value)
+                   for name, value in headers]  # Same content, different bytes
+
+        streamed = not any(name.lower() == "content-length" for name, _ in captured["headers"])
+        if streamed:
+            start_response(status, headers)
+            return self._compress_stream(iterable, encoder)
+
+        # Known length: compressed now, so the length can still be sent
+        try:
+            body = b"".join(iterable)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        compressed = encoder.compress(body) + encoder.finish()
+        self._record(encoding, len(body), len(compressed))
+        start_response(status, headers + [("Content-Length", str(len(compressed)))])
+        return [compressed]
+
+    def _compress_stream(self, iterable: Iterable[bytes], encoder: Encoder) -> Iterable[bytes]:
+        size = compressed_size = 0
+        try:
+            for chunk in iterable:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                compressed = encoder.compress(chunk) + encoder.flush()
+                compressed_size += len(compressed)
+                yield compressed
+            compressed = encoder.finish()
+            compressed_size += len(compressed)
+            yield compressed
+            self._record(encoder.encoding, size, compressed_size)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    def _record(self, encoding: str, size: int, compressed_size: int):
+        metrics.increment(f"compression.{encoding}.responses")
+        metrics.increment("compression.bytes_in", size)
+        metrics.increment("compression.bytes_saved", size - compressed_size)
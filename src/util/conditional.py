@@ -0,0 +1,42 @@
+# Conditional GET for HTML pages
+# A page's ETag is made from the version stamps of what it shows (ChangeLog in db/schema.sql),
+# the viewer and the query, so a reload that would render the same page is answered
+# with 304 Not Modified before any heavy query or template is run.
+
+from hashlib import sha1
+from pathlib import Path
+from typing import Optional
+from flask import Response, current_app, request, session
+
+
+def build_stamp(root: Path) -> str:
+    # Templates and public files of this deploy, same in every worker
+    stamp = sha1()
+    for directory in ("templates", "public"):
+        for path in sorted((root / directory).rglob("*")):
+            if path.is_file():
+                stat = path.stat()
+                stamp.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+    return stamp.hexdigest()[:16]
+
+
+def page_etag(*versions) -> str:
+    # The header, vote buttons and forms differ per viewer, so pages are never shared
+    viewer = (session.get("request_token"), session.get("user"))
+    query = sorted(request.args.items(multi=True))
+    parts = (current_app.extensions["page_build"], request.path, query, viewer, versions)
+    return sha1(repr(parts).encode()).hexdigest()
+
+
+def not_modified(etag: str) -> Optional[Response]:
+    # Compressed responses carry a weak ETag, so the weak comparison is used
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_etag(Response(status=304), etag)
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
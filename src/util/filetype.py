@@ -16,3 +16,23 @@ def filename_to_file_type(filename: str):
     ending = filename.split(".")[-1]
 
     return file_types[ending] if ending in file_types else "text/plain"
+
+
+def sniff_image_type(head: bytes):
+    # Image type from the first bytes of the file, None if not a known image
+    # NOTE: SVG is left out on purpose, it can carry scripts
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"BM"):
+        return "image/bmp"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "image/tiff"
+    if head[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return None
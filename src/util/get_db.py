@@ -1,11 +1,51 @@
-from flask import g
+from threading import Lock
+from time import time
+from typing import List
+from flask import current_app, g, request, session
 from database.abstract import AbstractDatabase
-from database.connection import DatabaseConnection
-from database.params import database_params
+from database.asynchronous import AsyncDatabase
+from database.types import Category
+from database.params import read_consistency, read_your_writes_window
+from database.writer import open_database
+from util.prefork import after_fork
+
+
+def reads_from_snapshot() -> bool:
+    # Only pages that just read, and not for users who have just written something
+    return (
+        read_consistency == "snapshot" and
+        request.method == "GET" and
+        time() - session.get("last_write", 0) > read_your_writes_window
+    )
 
 
 def get_db() -> AbstractDatabase:  # Get an abstract database instance in Flask context
     db = getattr(g, "_database", None)
     if db is None:
-        db = AbstractDatabase(DatabaseConnection(*database_params).open())
+        db = g._database = AbstractDatabase(open_database(reads_from_snapshot()))
     return db
+
+
+def get_categories() -> List[Category]:  # Categories never change, loaded once (or preloaded)
+    categories = current_app.extensions.get("categories")
+    if categories is None:
+        categories = current_app.extensions["categories"] = get_db().get_categories()
+    return categories
+
+
+async_db = None
+async_db_lock = Lock()
+
+
+@after_fork
+def forget_async_db():  # Its thread pools are not carried over a fork
+    global async_db, async_db_lock  # pylint: disable=global-statement
+    async_db, async_db_lock = None, Lock()
+
+
+def get_async_db() -> AsyncDatabase:  # The awaitable database of this process (see asgi.py)
+    global async_db  # pylint: disable=global-statement
+    with async_db_lock:
+        if async_db is None:
+            async_db = AsyncDatabase()
+        return async_db
@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import Literal, Optional
 from database.types import UserDict
 
 
@@ -37,3 +37,11 @@ def has_permission(  # Logic for checking permissions for users
         return True
 
     return False
+
+
+def required_author(  # Author an edit or delete is limited to, None when any is allowed
+        user: UserDict,
+        action: Literal["delete", "edit"],
+        target_type: Literal["challenge", "comment", "submission"]
+) -> Optional[int]:
+    return None if has_permission(user, action, target_type, None) else user["id"]
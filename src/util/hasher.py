@@ -0,0 +1,114 @@
+# Password hashing in a bounded process pool, so scrypt does not block the request workers
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+from util.metrics import metrics
+from util.prefork import after_fork
+
+
+class HasherBusyException(Exception):
+    def __init__(self):
+        super().__init__("Password hasher is busy.")
+
+
+class PasswordHasher:
+    def __init__(self,
+                 method: str = "scrypt:32768:8:1",
+                 workers: int = 2,
+                 max_queue: int = 16,
+                 timeout: float = 5.0):
+        self.method = method
+        self.hash_method = None  # The method as it appears in stored hashes
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = None
+        self.lock = Lock()
+
+        # Running + queued jobs are bounded, extra callers wait up to the timeout
+        self.slots = BoundedSemaphore(workers + max_queue)
+        self.depth = 0
+        after_fork(self._forget_executor)
+
+    def _forget_executor(self):  # The pool of the parent can not be used from a fork
+        self.executor = None
+        self.lock = Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Created on first use, so the pool is never inherited by forked workers
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=get_context("spawn"))
+            return self.executor
+
+    def _set_depth(self, change: int):
+        with self.lock:
+            self.depth += change
+            metrics.set_gauge("password_hasher.queue_depth", self.depth)
+
+    def _release(self, _future=None):  # Frees the slot of a finished job
+        self._set_depth(-1)
+        self.slots.release()
+
+    def _run(self, name: str, function, *args):
+        if not self.slots.acquire(timeout=self.timeout):
+            metrics.increment("password_hasher.rejected")
+            raise HasherBusyException()
+
+        self._set_depth(1)
+        start = perf_counter()
+        try:
+            return self._call(function, *args)
+        finally:
+            metrics.observe(f"password_hasher.{name}_seconds", perf_counter() - start)
+
+    def _call(self, function, *args):
+        # No workers configured, hash in the request worker
+        if self.workers == 0:
+            try:
+                return function(*args)
+            finally:
+                self._release()
+
+        try:
+            future = self._get_executor().submit(function, *args)
+        except Exception:
+            self._release()
+            raise
+
+        # The slot is kept until the job is done, also after the caller stopped waiting
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError as err:
+            future.cancel()  # Only a job that has not started yet is cancelled
+            metrics.increment("password_hasher.timeouts")
+            raise HasherBusyException() from err
+
+    def hash(self, password: str) -> str:
+        return self._run("hash", generate_password_hash, password, self.method)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run("verify", check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        # Hashes are stored as "<method>$<salt>$<hash>", with the method in full:
+        # werkzeug expands e.g. "scrypt" to "scrypt:32768:8:1", so the configured
+        # method is expanded the same way once, from a hash of an empty password
+        if self.hash_method is None:
+            self.hash_method = self.hash("").split("$", 1)[0]
+        return not password_hash.startswith(self.hash_method + "$")
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+
+def get_hasher() -> PasswordHasher:  # Password hasher of the app in Flask context
+    return current_app.extensions["password_hasher"]
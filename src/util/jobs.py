@@ -0,0 +1,186 @@
+# Background jobs: deferred side effects that should not hold up the request
+# Jobs are kept in SQLite, so they survive restarts and are shared by all worker processes.
+# A failing job is retried with exponential backoff, until it runs out of attempts.
+
+import json
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+from traceback import format_exception_only
+from typing import Callable, Dict, List
+from flask import current_app
+from util.metrics import metrics
+from util.prefork import after_fork
+from util.sqlite_local import LocalConnections
+
+
+class JobQueue:
+    def __init__(self,
+                 database: str,
+                 workers: int = 2,
+                 max_attempts: int = 5,
+                 backoff: float = 2.0,
+                 lease: float = 300,
+                 poll_interval: float = 5,
+                 retention: int = 24 * 60 * 60):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease  # Running jobs of a crashed process are retried after this
+        self.poll_interval = poll_interval
+        self.retention = retention  # Seconds to keep finished jobs around
+        self.handlers: Dict[str, Callable] = {}
+        self.threads: List[Thread] = []
+        self.lock = Lock()
+        self.wake = Event()
+        self.last_sweep = 0
+        self.connections = LocalConnections(database, """
+            CREATE TABLE IF NOT EXISTS Jobs (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_after REAL NOT NULL,
+                locked_until REAL,
+                last_error TEXT,
+                created REAL NOT NULL,
+                finished REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_pending ON Jobs(status, run_after);
+        """, autocommit=True)
+        after_fork(self._forget_after_fork)
+
+    def _forget_after_fork(self):  # Worker threads are per process
+        self.threads = []
+        self.lock = Lock()
+        self.wake = Event()
+
+    def handler(self, name: str):  # Decorator to register the function running a job
+        def register(function: Callable):
+            self.handlers[name] = function
+            return function
+        return register
+
+    def start(self):
+        # Started on first use, so the threads are never inherited by forked workers
+        with self.lock:
+            if not self.threads:
+                self.threads = [Thread(target=self._run, name=f"job-worker-{n}", daemon=True)
+                                for n in range(self.workers)]
+                for thread in self.threads:
+                    thread.start()
+
+    def enqueue(self, name: str, **payload):
+        if name not in self.handlers:
+            raise ValueError(f"Unknown job '{name}'!")
+
+        now = time()
+        self.connections.get().execute(
+            "INSERT INTO Jobs (name, payload, run_after, created) VALUES (?, ?, ?, ?)",
+            (name, json.dumps(payload), now, now))
+        metrics.increment("jobs.enqueued")
+        self.start()
+        self.wake.set()
+
+    def _claim(self):  # Takes the next due job, or None
+        now = time()
+        return self.connections.get().execute("""
+            UPDATE Jobs SET
+                status = 'running',
+                attempts = attempts + 1,
+                locked_until = ?
+            WHERE id = (
+                SELECT id FROM Jobs
+                WHERE status = 'queued' AND run_after <= ?
+                ORDER BY run_after
+                LIMIT 1
+            )
+            RETURNING id, name, payload, attempts
+        """, (now + self.lease, now)).fetchone()
+
+    def _finish(self, job_id: int):
+        self.connections.get().execute(
+            "UPDATE Jobs SET status = 'done', finished = ?, last_error = NULL WHERE id = ?",
+            (time(), job_id))
+        metrics.increment("jobs.completed")
+
+    def _fail(self, job_id: int, attempts: int, err: Exception):
+        error = "".join(format_exception_only(type(err), err)).strip()
+        if attempts >= self.max_attempts:
+            self.connections.get().execute(
+                "UPDATE Jobs SET status = 'failed', finished = ?, last_error = ? WHERE id = ?",
+                (time(), error, job_id))
+            metrics.increment("jobs.failed")
+        else:
+            # Backoff doubles on every attempt: 2, 4, 8... seconds
+            self.connections.get().execute(
+                "UPDATE Jobs SET status = 'queued', run_after = ?, last_error = ? WHERE id = ?",
+                (time() + self.backoff ** attempts, error, job_id))
+            metrics.increment("jobs.retried")
+
+    def _sweep(self):
+        # Requeue jobs of crashed processes and forget old finished jobs
+        now = time()
+        if now - self.last_sweep < self.poll_interval:
+            return
+        self.last_sweep = now
+        connection = self.connections.get()
+        connection.execute(
+            "UPDATE Jobs SET status = 'queued' WHERE status = 'running' AND locked_until < ?",
+            (now,))
+        connection.execute(
+            "DELETE FROM Jobs WHERE status IN ('done', 'failed') AND finished < ?",
+            (now - self.retention,))
+
+    def run_pending(self) -> int:  # Runs due jobs until there are none, returns the amount
+        ran = 0
+        self._sweep()
+        while True:
+            job = self._claim()
+            if job is None:
+                return ran
+
+            job_id, name, payload, attempts = job
+            start = perf_counter()
+            try:
+                self.handlers[name](**json.loads(payload))
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                print(f"Job {name} ({job_id}) failed:", err)
+                self._fail(job_id, attempts, err)
+            else:
+                self._finish(job_id)
+            metrics.observe(f"jobs.{name}.seconds", perf_counter() - start)
+            ran += 1
+
+    def _run(self):
+        while True:
+            try:
+                self.run_pending()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                print("Job worker error:", err)
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+
+    def status(self) -> dict:  # For the admin status page
+        connection = self.connections.get()
+        counts = dict(connection.execute(
+            "SELECT status, COUNT(*) FROM Jobs GROUP BY status").fetchall())
+        failed = [
+            {"id": job_id, "name": name, "payload": json.loads(payload),
+             "attempts": attempts, "error": error, "finished": finished}
+            for job_id, name, payload, attempts, error, finished in connection.execute("""
+                SELECT id, name, payload, attempts, last_error, finished FROM Jobs
+                WHERE status = 'failed' ORDER BY finished DESC LIMIT 20
+            """)
+        ]
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "recent_failures": failed
+        }
+
+
+def get_job_queue() -> JobQueue:  # Job queue of the app in Flask context
+    return current_app.extensions["job_queue"]
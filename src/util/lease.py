@@ -0,0 +1,45 @@
+# Background jobs that only one process per database should run
+# Every worker process starts the job's thread, but only the one holding the lease (an
+# exclusive lock on a file next to the database) does the work, the others check again on
+# their next round. The lock goes away with the process, a crashed holder leaves nothing stale.
+
+from threading import Lock
+from util.prefork import after_fork
+
+try:
+    from fcntl import LOCK_EX, LOCK_NB, flock
+except ImportError:  # Not on Windows, every process runs the job there
+    flock = None
+
+
+class FileLease:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.lock = Lock()
+        after_fork(self._forget_file)
+
+    def _forget_file(self):
+        # The child shares the parent's lock through the inherited file, it must take its own
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.lock = Lock()
+
+    def acquire(self) -> bool:  # True while this process holds the lease, never waits
+        if flock is None:
+            return True
+        with self.lock:
+            if self.file is None:
+                file = open(self.path, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+                try:
+                    flock(file.fileno(), LOCK_EX | LOCK_NB)
+                except OSError:  # Held by another process
+                    file.close()
+                    return False
+                self.file = file
+            return True
+
+
+def lease_path(database: str, job: str) -> str:
+    return f"{database}.{job}.lock"
@@ -0,0 +1,50 @@
+# Simple in-process metrics: counters, gauges and timings
+
+from threading import Lock
+from typing import Dict, List
+from util.prefork import after_fork
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.timings: Dict[str, List[float]] = {}  # [count, total, max]
+
+    def forget_lock(self):  # Another thread of the parent may have held it while forking
+        self.lock = Lock()
+
+    def increment(self, name: str, amount: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": {
+                    name: {
+                        "count": count,
+                        "avg": total / count if count else 0,
+                        "max": maximum
+                    } for name, (count, total, maximum) in self.timings.items()
+                }
+            }
+
+
+# Metrics of this worker process
+metrics = Metrics()
+after_fork(metrics.forget_lock)
@@ -0,0 +1,23 @@
+# Pre-fork serving: read-only state is loaded once in the master process and shared
+# by the forked workers (copy-on-write), while threads, locks and SQLite connections
+# are never carried over a fork. Each owner forgets them in the child, see after_fork().
+
+import os
+from typing import Callable, List
+
+after_fork_callbacks: List[Callable[[], None]] = []
+
+
+def after_fork(callback: Callable[[], None]) -> Callable[[], None]:
+    # Registers a function run in every forked child, before it does anything else
+    after_fork_callbacks.append(callback)
+    return callback
+
+
+def _run_after_fork_callbacks():
+    for callback in after_fork_callbacks:
+        callback()
+
+
+if hasattr(os, "register_at_fork"):  # Not on Windows, which never forks
+    os.register_at_fork(after_in_child=_run_after_fork_callbacks)
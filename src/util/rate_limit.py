@@ -0,0 +1,116 @@
+# Token bucket rate limiting, used to throttle login attempts before any expensive work
+
+from abc import ABC, abstractmethod
+from threading import Lock
+from time import time
+from typing import Dict, Tuple
+from flask import current_app
+from util.metrics import metrics
+from util.sqlite_local import LocalConnections
+
+
+class RateLimiter(ABC):  # Base for rate limiter backends
+    def __init__(self, name: str, capacity: float, refill_rate: float):
+        self.name = name
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # Tokens per second
+
+    def _refill(self, tokens: float, updated: float, now: float) -> float:
+        return min(self.capacity, tokens + (now - updated) * self.refill_rate)
+
+    @abstractmethod
+    def _take(self, key: str, cost: float) -> bool:
+        pass
+
+    def allow(self, key: str, cost: float = 1) -> bool:
+        allowed = self._take(key, cost)
+        metrics.increment(f"{self.name}.{'allowed' if allowed else 'rejected'}")
+        return allowed
+
+
+class LocalRateLimiter(RateLimiter):  # Per process
+    def __init__(self, name: str, capacity: float, refill_rate: float, max_keys: int = 100000):
+        super().__init__(name, capacity, refill_rate)
+        self.max_keys = max_keys
+        self.buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, updated)
+        self.lock = Lock()
+
+    def _take(self, key, cost):
+        now = time()
+        with self.lock:
+            # Full buckets carry no state, drop them when there are too many keys
+            if len(self.buckets) >= self.max_keys:
+                self.buckets = {
+                    k: (tokens, updated) for k, (tokens, updated) in self.buckets.items()
+                    if self._refill(tokens, updated, now) < self.capacity
+                }
+
+            tokens, updated = self.buckets.get(key, (self.capacity, now))
+            tokens = self._refill(tokens, updated, now)
+            allowed = tokens >= cost
+            self.buckets[key] = (tokens - cost if allowed else tokens, now)
+            return allowed
+
+
+class SqliteRateLimiter(RateLimiter):  # Shared by all worker processes
+    def __init__(self,
+                 name: str,
+                 capacity: float,
+                 refill_rate: float,
+                 database: str,
+                 sweep_interval: int = 60):
+        super().__init__(name, capacity, refill_rate)
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        # Autocommit mode, transactions are handled by hand
+        self.connections = LocalConnections(database, """
+            CREATE TABLE IF NOT EXISTS RateLimits (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """, autocommit=True)
+
+    def _take(self, key, cost):
+        now = time()
+        bucket_key = f"{self.name}:{key}"
+        connection = self.connections.get()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM RateLimits WHERE key = ?",
+                                     (bucket_key,)).fetchone()
+            tokens = self._refill(*row, now) if row else self.capacity
+            allowed = tokens >= cost
+            connection.execute("""
+                INSERT INTO RateLimits (key, tokens, updated) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = excluded.tokens,
+                    updated = excluded.updated
+            """, (bucket_key, tokens - cost if allowed else tokens, now))
+
+            # Every once in a while, drop buckets that have had time to refill completely
+            if now - self.last_sweep >= self.sweep_interval:
+                self.last_sweep = now
+                connection.execute("DELETE FROM RateLimits WHERE key LIKE ? AND updated < ?",
+                                   (f"{self.name}:%", now - self.capacity / self.refill_rate))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return allowed
+
+
+def create_rate_limiter(backend: str,
+                        name: str,
+                        capacity: float,
+                        refill_rate: float,
+                        database: str) -> RateLimiter:
+    if backend == "local":
+        return LocalRateLimiter(name, capacity, refill_rate)
+    if backend == "sqlite":
+        return SqliteRateLimiter(name, capacity, refill_rate, database)
+    raise ValueError(f"Unknown rate limiter backend '{backend}'!")
+
+
+def get_rate_limiter(name: str) -> RateLimiter:  # Rate limiter of the app in Flask context
+    return current_app.extensions["rate_limiters"][name]
@@ -0,0 +1,260 @@
+# Server-side sessions: the cookie only carries a session id, the data stays on the server
+
+import json
+from abc import ABC, abstractmethod
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+from secrets import token_urlsafe
+from threading import Lock
+from time import time
+from typing import Dict, Optional, Set, Tuple
+from flask import current_app
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from util.sqlite_local import LocalConnections
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, session_id=None, new=False, stored=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.session_id = session_id
+        self.new = new  # The client has no cookie for this id yet
+        self.stored = stored  # The data is kept in the store
+        self.modified = False
+
+        # Used to rotate the session id when the logged in user changes
+        self.opened_user_id = self["user"]["id"] if "user" in self else None
+
+
+anonymous_keys = {"request_token"}  # Sessions holding only these are not stored
+
+
+def anonymous_data(session_id: str) -> dict:
+    # The request token of a session that is not stored follows from its id, so it stays
+    # the same on every request without a row on the server (and does not reveal the id)
+    digest = sha256(f"request_token:{session_id}".encode()).digest()
+    return {"request_token": urlsafe_b64encode(digest[:16]).decode().rstrip("=")}
+
+
+class SessionStore(ABC):  # Base for session storage backends
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def save(self, session_id: str, data: dict):
+        pass
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        pass
+
+    @abstractmethod
+    def invalidate_user(self, user_id: int):  # Drop every session of the user
+        pass
+
+    @abstractmethod
+    def refresh_user(self, user_id: int, user: dict):  # Replace the cached user record
+        pass
+
+
+class MemorySessionStore(SessionStore):  # Per process, for single worker deployments
+    def __init__(self, ttl: int, sweep_interval: int = 60):
+        super().__init__(ttl)
+        self.sweep_interval = sweep_interval
+        self.sessions: Dict[str, Tuple[float, dict]] = {}
+        self.user_sessions: Dict[int, Set[str]] = {}
+        self.lock = Lock()
+        self.last_sweep = time()
+
+    def _sweep(self, now: float):  # Evict expired sessions, holding the lock
+        if now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+        for session_id in [s for s, (expires, _) in self.sessions.items() if expires < now]:
+            self._remove(session_id)
+
+    def _remove(self, session_id: str):
+        _, data = self.sessions.pop(session_id, (0, {}))
+        if "user" in data:
+            self.user_sessions.get(data["user"]["id"], set()).discard(session_id)
+
+    def load(self, session_id):
+        now = time()
+        with self.lock:
+            self._sweep(now)
+            expires, data = self.sessions.get(session_id, (0, None))
+            if expires < now:
+                return None
+            self.sessions[session_id] = (now + self.ttl, data)  # Kept alive while in use
+            return dict(data)
+
+    def save(self, session_id, data):
+        with self.lock:
+            self._remove(session_id)
+            self.sessions[session_id] = (time() + self.ttl, dict(data))
+            if "user" in data:
+                self.user_sessions.setdefault(
+                    data["user"]["id"], set()).add(session_id)
+
+    def delete(self, session_id):
+        with self.lock:
+            self._remove(session_id)
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for session_id in list(self.user_sessions.pop(user_id, set())):
+                self.sessions.pop(session_id, None)
+
+    def refresh_user(self, user_id, user):
+        with self.lock:
+            for session_id in self.user_sessions.get(user_id, set()):
+                self.sessions[session_id][1]["user"] = user
+
+
+class SqliteSessionStore(SessionStore):  # Shared by all worker processes
+    def __init__(self, ttl: int, database: str, sweep_interval: int = 60):
+        super().__init__(ttl)
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        self.connections = LocalConnections(database, """
+            CREATE TABLE IF NOT EXISTS Sessions (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                data TEXT NOT NULL,
+                expires INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_user_id ON Sessions(user_id)
+            WHERE user_id IS NOT NULL;
+        """)
+
+    def load(self, session_id):
+        now = int(time())
+        connection = self.connections.get()
+        row = connection.execute(
+            "SELECT data, expires FROM Sessions WHERE id = ? AND expires >= ?",
+            (session_id, now)).fetchone()
+        if row is None:
+            return None
+
+        # Sessions in use are kept alive, at most one write per sweep interval
+        if row[1] < now + self.ttl - self.sweep_interval:
+            with connection:
+                connection.execute("UPDATE Sessions SET expires = ? WHERE id = ?",
+                                   (now + self.ttl, session_id))
+        return json.loads(row[0])
+
+    def save(self, session_id, data):
+        now = int(time())
+        connection = self.connections.get()
+        with connection:
+            connection.execute("""
+                INSERT INTO Sessions (id, user_id, data, expires) VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    user_id = excluded.user_id,
+                    data = excluded.data,
+                    expires = excluded.expires
+            """, (session_id,
+                  data["user"]["id"] if "user" in data else None,
+                  json.dumps(data),
+                  now + self.ttl))
+
+            # Evict expired sessions every once in a while
+            if now - self.last_sweep >= self.sweep_interval:
+                self.last_sweep = now
+                connection.execute("DELETE FROM Sessions WHERE expires < ?", (now,))
+
+    def delete(self, session_id):
+        connection = self.connections.get()
+        with connection:
+            connection.execute("DELETE FROM Sessions WHERE id = ?", (session_id,))
+
+    def invalidate_user(self, user_id):
+        connection = self.connections.get()
+        with connection:
+            connection.execute("DELETE FROM Sessions WHERE user_id = ?", (user_id,))
+
+    def refresh_user(self, user_id, user):
+        connection = self.connections.get()
+        with connection:
+            connection.execute("""
+                UPDATE Sessions SET data = json_set(data, '$.user', json(?))
+                WHERE user_id = ?
+            """, (json.dumps(user), user_id))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, store: SessionStore):
+        self.store = store
+
+    def open_session(self, app, request):
+        session_id = request.cookies.get(self.get_cookie_name(app))
+        if session_id:
+            data = self.store.load(session_id)
+            if data is not None:
+                return ServerSideSession(data, session_id, stored=True)
+            return ServerSideSession(anonymous_data(session_id), session_id)
+        session_id = token_urlsafe(32)
+        return ServerSideSession(anonymous_data(session_id), session_id, new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # Emptied session (logout), forget it completely
+        if not session:
+            if session.modified and session.stored:
+                self.store.delete(session.session_id)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Visitors without anything but their request token only get the cookie,
+        # a row is stored once the session holds more (e.g. after login)
+        if not session.stored and session.keys() <= anonymous_keys:
+            if session.new:
+                self._set_cookie(app, session, response)
+            return
+
+        if session.stored and not session.modified:
+            return
+
+        # Issue a new id when the logged in user changes (no session fixation),
+        # or when the id came from a cookie the store never issued
+        user_id = session["user"]["id"] if "user" in session else None
+        if not session.new and (not session.stored or user_id != session.opened_user_id):
+            if session.stored:
+                self.store.delete(session.session_id)
+            session.session_id = token_urlsafe(32)
+
+        self.store.save(session.session_id, dict(session))
+        session.stored = True
+        self._set_cookie(app, session, response)
+
+    def _set_cookie(self, app, session, response):
+        response.set_cookie(self.get_cookie_name(app),
+                            session.session_id,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=self.get_cookie_domain(app),
+                            path=self.get_cookie_path(app),
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+def create_session_store(backend: str, ttl: int, database: str) -> SessionStore:
+    if backend == "memory":
+        return MemorySessionStore(ttl)
+    if backend == "sqlite":
+        return SqliteSessionStore(ttl, database)
+    raise ValueError(f"Unknown session backend '{backend}'!")
+
+
+def get_session_store() -> SessionStore:  # Session store of the app in Flask context
+    return current_app.session_interface.store
@@ -0,0 +1,31 @@
+# Per-thread SQLite connections for the small stores shared by all worker processes
+# (sessions, rate limits, jobs). SQLite connections are bound to their thread,
+# and connections of the parent process are never used after a fork.
+
+from sqlite3 import Connection, connect
+from threading import local
+from util.prefork import after_fork
+
+
+class LocalConnections:
+    def __init__(self, database: str, schema: str, autocommit: bool = False):
+        self.database = database
+        self.schema = schema  # Run once by every new connection, CREATE ... IF NOT EXISTS
+        self.autocommit = autocommit  # Transactions are then handled by hand
+        self.local = local()
+        after_fork(self.forget)
+
+    def forget(self):
+        self.local = local()
+
+    def get(self) -> Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.autocommit:
+                connection = connect(self.database, timeout=10, isolation_level=None)
+            else:
+                connection = connect(self.database, timeout=10)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.executescript(self.schema)
+            self.local.connection = connection
+        return connection
@@ -0,0 +1,97 @@
+# Static files of the public directory, fingerprinted and precompressed at startup
+# Fingerprinted URLs change whenever the content does, so browsers may keep them forever.
+# Text files are compressed once here, instead of on every request.
+
+import gzip
+import mimetypes
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, Optional
+from flask import Request, Response
+from util.metrics import metrics
+
+try:
+    import brotli
+except ImportError:  # Optional, gzip only without it
+    brotli = None
+
+# Content types worth compressing, images are compressed already
+compressible_types = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class StaticFile:
+    __slots__ = ("name", "fingerprinted_name", "content_type", "etag", "encodings")
+
+    def __init__(self, name: str, fingerprinted_name: str, content_type: str, etag: str,
+                 encodings: Dict[str, bytes]):
+        self.name = name
+        self.fingerprinted_name = fingerprinted_name
+        self.content_type = content_type
+        self.etag = etag
+        self.encodings = encodings  # "identity", and "br" / "gzip" when smaller
+
+
+class StaticAssets:
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.files: Dict[str, StaticFile] = {}  # By plain and fingerprinted name
+        self.build()
+
+    def build(self):
+        files = {}
+        for path in sorted(self.directory.iterdir()):
+            if not path.is_file():
+                continue
+            value = path.read_bytes()
+            digest = sha256(value).hexdigest()[:12]
+            content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+            if content_type.startswith("text/") or content_type.endswith("javascript"):
+                content_type += "; charset=utf-8"
+
+            encodings = {"identity": value}
+            if content_type.startswith(compressible_types):
+                compressed = gzip.compress(value, compresslevel=9, mtime=0)
+                if len(compressed) < len(value):
+                    encodings["gzip"] = compressed
+                if brotli is not None:
+                    compressed = brotli.compress(value, quality=11)
+                    if len(compressed) < len(value):
+                        encodings["br"] = compressed
+
+            static_file = StaticFile(path.name, f"{path.stem}.{digest}{path.suffix}",
+                                     content_type, digest, encodings)
+            files[static_file.name] = static_file
+            files[static_file.fingerprinted_name] = static_file
+        self.files = files
+
+    def url(self, name: str) -> str:  # For templates: {{ static_url("main.css") }}
+        static_file = self.files.get(name)
+        if static_file is None:
+            return f"/public/{name}"
+        return f"/public/{static_file.fingerprinted_name}"
+
+    def response(self, name: str, request: Request) -> Optional[Response]:
+        # None for files that are not in the public directory
+        static_file = self.files.get(name)
+        if static_file is None:
+            return None
+
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in static_file.encodings and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        metrics.increment(f"static.{encoding}")
+
+        response = Response(static_file.encodings[encoding], content_type=static_file.content_type)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        response.set_etag(f"{static_file.etag}-{encoding}")
+
+        if name == static_file.fingerprinted_name:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            # Plain names may change under the same URL, so they are revalidated
+            response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
@@ -0,0 +1,46 @@
+# Streamed page rendering: the head and header are sent before the rest is rendered
+# Jinja yields tiny pieces, so they are gathered into larger chunks before sending.
+# {{ flush() }} in a template sends everything gathered so far right away.
+
+from traceback import print_exception
+from typing import Iterator
+from flask import Response, g, stream_template
+from markupsafe import Markup
+
+flush_marker = Markup("<!--flush-->")
+
+
+def flush() -> str:  # Template global, nothing when the page is not streamed
+    return flush_marker if g.get("streaming") else ""
+
+
+def _gather(chunks: Iterator[str], chunk_size: int) -> Iterator[str]:
+    buffer, size = [], 0
+    try:
+        for chunk in chunks:
+            if flush_marker in chunk:
+                before, _, after = chunk.partition(flush_marker)
+                buffer.append(before)
+                yield "".join(buffer)
+                buffer, size = [after], len(after)
+                continue
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                yield "".join(buffer)
+                buffer, size = [], 0
+        yield "".join(buffer)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # Headers are sent already, so the error handlers can not answer anymore
+        print("Error while streaming a page")
+        print_exception(e)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def stream_page(template_name: str, chunk_size: int = 4096, **context) -> Response:
+    # Load the data before calling, errors in queries still reach the error handlers
+    g.streaming = True
+    return Response(_gather(stream_template(template_name, **context), chunk_size),
+                    mimetype="text/html")
@@ -0,0 +1,110 @@
+# Upload pipeline: size limits, content sniffing and bounded images
+# Uploads stay in werkzeug's spooled temporary files (on disk when large)
+# and are streamed from there into the asset store.
+
+from io import BytesIO
+from typing import BinaryIO, Optional, Tuple
+from flask import current_app
+from werkzeug.datastructures import FileStorage
+from util.filetype import sniff_image_type
+from util.metrics import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional, images are stored as uploaded without Pillow
+    Image = None
+
+# Variants served from /a/<id>/<variant>, named after their size on the page
+# Made at twice the size, so they stay sharp on high density screens
+image_variants = {
+    "20": (40, 40),
+    "64": (128, 128)
+}
+use_original = ""  # Stored content type of a variant Pillow could not make (not an image)
+variants_enabled = Image is not None  # Without Pillow every variant is the original
+
+
+class UploadRejectedException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class Upload:  # A checked upload, ready for create_asset_from_stream
+    __slots__ = ("filename", "content_type", "stream", "size")
+
+    def __init__(self, filename: str, content_type: str, stream: BinaryIO, size: int):
+        self.filename = filename
+        self.content_type = content_type
+        self.stream = stream
+        self.size = size
+
+
+def _measure(file: FileStorage, max_bytes: int) -> Tuple[BinaryIO, int]:
+    stream = file.stream
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(0)
+    if size > max_bytes:
+        raise UploadRejectedException(f"File is too large (max {max_bytes // 1024} KiB).")
+    return stream, size
+
+
+def _reencode(stream: BinaryIO, max_size: Tuple[int, int]) -> Tuple[BinaryIO, int, str]:
+    with Image.open(stream) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(max_size)
+
+        # Keep transparency, everything else becomes a (much smaller) JPEG
+        output = BytesIO()
+        if image.mode in ("RGBA", "LA", "P"):
+            image.save(output, "WEBP", quality=85)
+            content_type = "image/webp"
+        else:
+            image.convert("RGB").save(output, "JPEG", quality=85, optimize=True)
+            content_type = "image/jpeg"
+    size = output.tell()
+    output.seek(0)
+    return output, size, content_type
+
+
+def prepare_image(file: FileStorage, kind: str) -> Upload:
+    # kind is "avatar" or "banner", bounded by UPLOAD_AVATAR_SIZE / UPLOAD_BANNER_SIZE
+    stream, size = _measure(file, current_app.config["UPLOAD_MAX_IMAGE_BYTES"])
+    content_type = sniff_image_type(stream.read(16))
+    stream.seek(0)
+    if content_type is None:
+        raise UploadRejectedException("Unsupported image type.")
+
+    if Image is not None:
+        original_size = size
+        try:
+            stream, size, content_type = _reencode(
+                stream, current_app.config[f"UPLOAD_{kind.upper()}_SIZE"])
+        except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as err:
+            raise UploadRejectedException("Image could not be read.") from err
+        metrics.increment("uploads.image_bytes_saved", original_size - size)
+
+    metrics.increment("uploads.images")
+    return Upload(file.filename, content_type, stream, size)
+
+
+def prepare_script(file: FileStorage) -> Upload:
+    stream, size = _measure(file, current_app.config["UPLOAD_MAX_SCRIPT_BYTES"])
+    filename = file.filename if file.filename.endswith(".js") else file.filename + ".js"
+
+    # Never served as anything but text, whatever the content is
+    metrics.increment("uploads.scripts")
+    return Upload(filename, "text/plain; charset=utf-8", stream, size)
+
+
+def make_variant(value: bytes, variant: str) -> Optional[Tuple[bytes, str]]:
+    # Downscaled copy of a stored image, None when the original has to do
+    if Image is None or sniff_image_type(value[:16]) is None:
+        return None
+    try:
+        output, _, content_type = _reencode(BytesIO(value), image_variants[variant])
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as err:
+        print("Image variant could not be made:", err)
+        return None
+    metrics.increment("uploads.variants")
+    return output.read(), content_type